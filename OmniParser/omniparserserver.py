@@ -5,11 +5,17 @@ import sys, os
 import sys
 import os
 import time
-from fastapi import FastAPI
+import asyncio
+import json
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from typing import Optional
 import argparse
 import uvicorn
 from util.omniparser import Omniparser
+from util.parse_deadline import ParseDeadline, ParseCancelled, acquire_before
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(root_dir)
 
@@ -19,6 +25,13 @@ def parse_arguments():
     parser.add_argument('--caption_model_name', type=str, default='florence2', help='Name of the caption model')
     parser.add_argument('--caption_model_path', type=str, default='./weights/icon_caption_florence', help='Path to the caption model')
     parser.add_argument('--device', type=str, default='cpu', help='Device to run the model')
+    parser.add_argument('--caption_preset', type=str, default=None, choices=['greedy', 'greedy_short', 'beam', 'blip2_beam'], help='Caption generation preset, defaults to greedy for florence and blip2_beam otherwise')
+    parser.add_argument('--caption_skip_policy', type=json.loads, default=None, help='JSON caption skip rules, e.g. \'{"min_area": 100, "dedupe_crops": true, "ocr_coverage": 0.5}\'')
+    parser.add_argument('--max_elements', type=int, default=None, help='Keep only the top K elements per screen by score')
+    parser.add_argument('--score_budget', type=float, default=None, help='Keep the fewest top elements covering this fraction (0-1] of the total element score')
+    parser.add_argument('--caption_batch_size', type=str, default='auto', help="Caption batch size, or 'auto' to size it from free memory")
+    parser.add_argument('--batch_size_cache', type=str, default=None, help='Where auto-tuned caption batch sizes are remembered, defaults to ~/.cache/omniparser')
+    parser.add_argument('--caption_cache_size', type=int, default=4096, help='Icon crops whose captions are kept for reuse across parses, 0 to turn off')
     parser.add_argument('--BOX_TRESHOLD', type=float, default=0.05, help='Threshold for box detection')
     parser.add_argument('--host', type=str, default='127.0.0.1', help='Host for the API')
     parser.add_argument('--port', type=int, default=8000, help='Port for the API')
@@ -33,19 +46,72 @@ omniparser = Omniparser(config)
 
 class ParseRequest(BaseModel):
     base64_image: str
+    # parses with the same session_id get persistent element track_ids, used as the SoM labels
+    session_id: Optional[str] = None
+    # seconds the client waits for the result, a parse still queued or running after that is dropped
+    timeout: Optional[float] = None
+
+class SessionRequest(BaseModel):
+    session_id: str
+
+# parses run one at a time in a worker thread, so the event loop stays free to answer /probe/ with the queue depth
+parse_lock = asyncio.Lock()
+parse_queue_depth = 0
+parse_stats = {"parsed": 0, "skipped": 0, "cancelled": 0}
+# how often a running parse checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+
+async def run_parse(parse_request: ParseRequest, request: Request, deadline: ParseDeadline):
+    """Parse in a worker thread, cancelling it (at its next stage) when the client disconnects."""
+    task = asyncio.ensure_future(run_in_threadpool(omniparser.parse, parse_request.base64_image, parse_request.session_id, deadline))
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if not task.done() and not deadline.cancelled.is_set() and await request.is_disconnected():
+            deadline.cancel('client disconnected')
+    return task.result()
+
+def skipped_response(deadline: ParseDeadline):
+    parse_stats["skipped"] += 1
+    print(f'skipped a parse that waited {time.time() - deadline.start:.2f}s in the queue')
+    return JSONResponse(status_code=504, content={"detail": "deadline passed before the parse started"})
 
 @app.post("/parse/")
-async def parse(parse_request: ParseRequest):
+async def parse(parse_request: ParseRequest, request: Request):
+    global parse_queue_depth
     print('start parsing...')
-    start = time.time()
-    dino_labled_img, parsed_content_list = omniparser.parse(parse_request.base64_image)
+    deadline = ParseDeadline(parse_request.timeout)
+    parse_queue_depth += 1
+    try:
+        # a queued request stops waiting once its deadline has passed, nobody would read its result
+        if not await acquire_before(parse_lock, deadline):
+            return skipped_response(deadline)
+        try:
+            if deadline.expired() or await request.is_disconnected():
+                return skipped_response(deadline)
+            start = time.time()
+            dino_labled_img, parsed_content_list = await run_parse(parse_request, request, deadline)
+        finally:
+            parse_lock.release()
+    except ParseCancelled as e:
+        parse_stats["cancelled"] += 1
+        print(f'parse cancelled after {time.time() - start:.2f}s: {e}')
+        return JSONResponse(status_code=504, content={"detail": f"parse cancelled: {e}"})
+    finally:
+        parse_queue_depth -= 1
+    parse_stats["parsed"] += 1
     latency = time.time() - start
     print('time:', latency)
     return {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, 'latency': latency}
 
+@app.post("/reset_session/")
+async def reset_session(session_request: SessionRequest):
+    omniparser.element_trackers.reset(session_request.session_id)
+    return {"message": "session reset"}
+
 @app.get("/probe/")
 async def root():
-    return {"message": "Omniparser API ready"}
+    # parses waiting or running, clients with several servers send new parses to the least busy one
+    return {"message": "Omniparser API ready", "queue_depth": parse_queue_depth, **parse_stats}
 
 if __name__ == "__main__":
     uvicorn.run("omniparserserver:app", host=args.host, port=args.port, reload=False)
\ No newline at end of file
@@ -4,6 +4,18 @@ from computer_use_agent import ComputerUseAgent
 
 load_dotenv()
 
+def _env_flag(name):
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes')
+
+def agent_options():
+    """Prompt options for the reasoner from the environment (or .env), see AIReasoner"""
+    budget = os.getenv('ELEMENT_TOKEN_BUDGET')
+    return {
+        "element_token_budget": int(budget) if budget else None,
+        "element_coordinates": _env_flag('ELEMENT_COORDINATES'),
+        "element_delta": _env_flag('ELEMENT_DELTA'),
+    }
+
 def print_result(result):
     """Print formatted result"""
     print("\n" + "=" * 50)
@@ -36,9 +48,9 @@ def main():
         if not api_key:
             print("API key is required to run the agent")
             return
-        agent = ComputerUseAgent(gemini_api_key=api_key)
+        agent = ComputerUseAgent(gemini_api_key=api_key, **agent_options())
     else:
-        agent = ComputerUseAgent()
+        agent = ComputerUseAgent(**agent_options())
     
     while True:
         print("\nChoose an option:")
@@ -3,6 +3,11 @@ from agent_state import AgentState
 
 class ActionExecutor:
     """Handles execution of actions on screen elements"""
+
+    def __init__(self, pause: float = 1.0):
+        # pyautogui sleeps `pause` seconds after every mouse/keyboard call; the setting is process-wide
+        pyautogui.FAILSAFE = True
+        pyautogui.PAUSE = pause
     
     def execute_action(self, state: AgentState) -> AgentState:
         """Execute the planned action using actual coordinates"""
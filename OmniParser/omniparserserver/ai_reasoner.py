@@ -1,43 +1,21 @@
 import json
 import google.generativeai as genai
 import os
+import sys
 from agent_state import AgentState
+# OmniParser/, for the util package shared with the parse server and the omnitool agents
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+from util.element_serializer import serialize_elements, element_center, estimate_tokens, ELEMENT_LINE
+from util.element_diff import ElementDiffer
 
-class AIReasoner:
-    """Handles AI reasoning using Gemini LLM"""
-    
-    def __init__(self, gemini_api_key: str = None):
-        api_key = gemini_api_key or os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            raise ValueError("Gemini API key is required. Set GEMINI_API_KEY environment variable or pass it as parameter.")
-        
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
-    
-    def reason_and_plan(self, state: AgentState) -> AgentState:
-        """Use Gemini LLM to analyze screen content and decide on action"""
-        print("Analyzing screen and planning action with Gemini LLM...")
-        
-        try:
-            # Prepare the prompt for the LLM
-            screen_elements = "\n".join([
-                f"Element {elem['id']}: {elem['content']}" 
-                for elem in state["parsed_elements"]
-            ])
-            
-            # Include context about what has been done so far
-            progress_info = ""
-            if state["steps_completed"]:
-                progress_info = f"\nSteps already completed: {', '.join(state['steps_completed'])}"
-            
-            prompt = f"""
-You are a computer use agent helping a user complete a multi-step task. Analyze the current screen and decide the NEXT action needed.
-
-ORIGINAL TASK: {state['original_task']}
-CURRENT STEP: {state['step_count'] + 1}/{state['max_steps']}{progress_info}
+ELEMENTS_FULL_HEADER = "CURRENT SCREEN ELEMENTS (IDs stay the same across steps while an element stays on screen):\n"
+ELEMENTS_DELTA_HEADER = "SCREEN CHANGES SINCE THE PREVIOUS STEP (elements not listed are unchanged and keep their IDs):\n"
 
-CURRENT SCREEN ELEMENTS:
-{screen_elements}
+REASONER_INSTRUCTIONS = """
+You are a computer use agent helping a user complete a multi-step task. Analyze the current screen and decide the NEXT action needed.
+The original task, the current step and the elements on the current screen are given at the end.
 
 Instructions:
 1. Consider the original task and what steps have already been completed
@@ -47,36 +25,119 @@ Instructions:
 5. If no suitable element exists for the next step, set target_element_id to null
 
 Respond in this JSON format:
-{{
+{
     "target_element_id": <number or null>,
     "reasoning": "<your reasoning about what step to take next>",
     "action": "<click/type/etc>",
     "step_description": "<brief description of this step>",
     "completed": <true/false - true if the entire original task is now complete>,
     "confidence": "<high/medium/low>"
-}}
+}
 
 Example response:
-{{
+{
     "target_element_id": 15,
     "reasoning": "New tab has been opened. Now I need to navigate to google.com. I can see the address bar at element 15.",
     "action": "click",
     "step_description": "Click address bar to search google.com",
     "completed": false,
     "confidence": "high"
-}}
+}
 
 Only respond with the JSON object, nothing else.
 """
 
-            # Generate response using Gemini
-            response = self.model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.1,
-                    max_output_tokens=400,
+class AIReasoner:
+    """Handles AI reasoning using Gemini LLM"""
+    
+    def __init__(self, gemini_api_key: str = None, element_token_budget: int = None, element_coordinates: bool = False, element_delta: bool = False):
+        api_key = gemini_api_key or os.getenv('GEMINI_API_KEY')
+        if not api_key:
+            raise ValueError("Gemini API key is required. Set GEMINI_API_KEY environment variable or pass it as parameter.")
+        
+        # GEMINI_API_ENDPOINT points the client at another server, e.g. omnitool/loadtest/mock_llm_server.py
+        endpoint = os.getenv('GEMINI_API_ENDPOINT')
+        if endpoint:
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+        else:
+            genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        # screen elements are ranked and cut to this many estimated tokens per prompt (None keeps all)
+        self.element_token_budget = element_token_budget
+        self.element_coordinates = element_coordinates
+        self.last_action_point = None
+        self.element_token_usage = []
+        # element_delta: stable IDs across steps, and only the screen changes are sent within one Gemini chat
+        self.element_differ = ElementDiffer(line_format=ELEMENT_LINE, full_header=ELEMENTS_FULL_HEADER, delta_header=ELEMENTS_DELTA_HEADER) if element_delta else None
+        self.chat = None
+    
+    def reason_and_plan(self, state: AgentState) -> AgentState:
+        """Use Gemini LLM to analyze screen content and decide on action"""
+        print("Analyzing screen and planning action with Gemini LLM...")
+        
+        try:
+            # Prepare the prompt for the LLM
+            element_diff = None
+            if self.element_differ is not None:
+                if state["step_count"] == 0:
+                    self.element_differ.reset()
+                    self.chat = None
+                element_diff = self.element_differ.update(state["parsed_elements"])
+                if self.chat is None:
+                    element_diff["full"] = True
+                    self.element_differ.steps_since_full = 0
+                screen_elements = self.element_differ.describe(
+                    state["parsed_elements"], element_diff, self.element_token_budget, self.element_coordinates
+                ).rstrip("\n")
+                listed = len(element_diff["ids"]) if element_diff["full"] else len(element_diff["added"]) + len(element_diff["changed"])
+                element_stats = {"total": len(element_diff["ids"]), "kept": listed, "tokens": estimate_tokens(screen_elements),
+                                 "budget": self.element_token_budget, "delta": not element_diff["full"]}
+            elif self.element_token_budget is not None or self.element_coordinates:
+                screen_elements, element_stats = serialize_elements(
+                    state["parsed_elements"], self.element_token_budget, self.last_action_point, self.element_coordinates, ELEMENT_LINE
                 )
+                screen_elements = "CURRENT SCREEN ELEMENTS:\n" + screen_elements.rstrip("\n")
+            else:
+                # without a budget the elements are listed as they always were, full contents in list order
+                screen_elements = "\n".join([
+                    f"Element {elem['id']}: {elem['content']}"
+                    for elem in state["parsed_elements"]
+                ])
+                element_stats = {"total": len(state["parsed_elements"]), "kept": len(state["parsed_elements"]),
+                                 "tokens": estimate_tokens(screen_elements), "budget": None}
+                screen_elements = "CURRENT SCREEN ELEMENTS:\n" + screen_elements
+            self.element_token_usage.append(element_stats)
+            print(f"Screen elements in prompt: {element_stats['kept']}/{element_stats['total']}, ~{element_stats['tokens']} tokens")
+            
+            # Include context about what has been done so far
+            progress_info = ""
+            if state["steps_completed"]:
+                progress_info = f"\nSteps already completed: {', '.join(state['steps_completed'])}"
+            
+            # static instructions and the task first, so consecutive prompts share a cacheable prefix;
+            # everything that changes per step goes at the end
+            step_info = f"""
+CURRENT STEP: {state['step_count'] + 1}/{state['max_steps']}{progress_info}
+
+{screen_elements}
+"""
+            generation_config = genai.types.GenerationConfig(
+                temperature=0.1,
+                max_output_tokens=400,
             )
+
+            # Generate response using Gemini
+            if element_diff is None:
+                prompt = REASONER_INSTRUCTIONS + f"\nORIGINAL TASK: {state['original_task']}\n" + step_info
+                response = self.model.generate_content(prompt, generation_config=generation_config)
+            else:
+                if element_diff["full"]:
+                    # a full list restarts the conversation, so the chat history doesn't grow without bound
+                    self.chat = self.model.start_chat()
+                    prompt = REASONER_INSTRUCTIONS + f"\nORIGINAL TASK: {state['original_task']}\n" + step_info
+                else:
+                    prompt = step_info
+                response = self.chat.send_message(prompt, generation_config=generation_config)
             
             llm_response = response.text.strip()
             print(f"Gemini Response: {llm_response}")
@@ -99,14 +160,21 @@ Only respond with the JSON object, nothing else.
                 
                 if decision.get("target_element_id") is not None:
                     element_id = decision["target_element_id"]
-                    # Find the element with this ID
-                    target_element = next(
-                        (elem for elem in state["parsed_elements"] if elem["id"] == element_id),
-                        None
-                    )
+                    if element_diff is not None:
+                        # stable ID back to the element's position in parsed_elements
+                        index = self.element_differ.index_of(element_id)
+                        target_element = state["parsed_elements"][index] if index is not None else None
+                    else:
+                        # Find the element with this ID
+                        target_element = next(
+                            (elem for elem in state["parsed_elements"] if elem["id"] == element_id),
+                            None
+                        )
                     
                     if target_element:
                         state["target_element"] = target_element
+                        if target_element.get("bbox"):
+                            self.last_action_point = element_center(target_element)
                         state["reasoning"] = decision.get("reasoning", "Gemini analysis completed")
                         
                         # Mark as completed AFTER we set up the action
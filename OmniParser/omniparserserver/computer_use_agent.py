@@ -5,8 +5,11 @@ from workflow_manager import WorkflowManager
 class ComputerUseAgent:
     """Main Computer Use Agent class"""
     
-    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000", gemini_api_key: str = None):
-        self.workflow_manager = WorkflowManager(omniparser_url, gemini_api_key)
+    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000", gemini_api_key: str = None, track_elements: bool = False,
+                 element_token_budget: int = None, element_coordinates: bool = False, element_delta: bool = False):
+        self.workflow_manager = WorkflowManager(omniparser_url, gemini_api_key, track_elements,
+                                                element_token_budget=element_token_budget, element_coordinates=element_coordinates,
+                                                element_delta=element_delta)
     
     def execute_task(self, task: str, max_steps: int = 5) -> Dict[str, Any]:
         """Execute a complete multi-step task"""
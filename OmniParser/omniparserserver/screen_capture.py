@@ -2,20 +2,36 @@ import pyautogui
 import base64
 import time
 import io
+from PIL import ImageChops, ImageStat
 from agent_state import AgentState
 
+def wait_until_screen_stable(timeout: float = 3.0, interval: float = 0.15, threshold: float = 1.0, stable_frames: int = 2) -> bool:
+    """Poll small grayscale captures until consecutive frames stop changing, or timeout. Returns whether it settled."""
+    start = time.time()
+    previous = pyautogui.screenshot().convert('L').resize((160, 100))
+    matches = 0
+    while time.time() - start < timeout:
+        time.sleep(interval)
+        current = pyautogui.screenshot().convert('L').resize((160, 100))
+        difference = ImageStat.Stat(ImageChops.difference(previous, current)).mean[0]
+        matches = matches + 1 if difference <= threshold else 0
+        if matches >= stable_frames:
+            return True
+        previous = current
+    return False
+
 class ScreenCapture:
     """Handles screenshot capture and conversion to base64"""
-    def __init__(self):
-        pyautogui.FAILSAFE = True
-        pyautogui.PAUSE = 1.0
     
     def take_screenshot(self, state: AgentState) -> AgentState:
         """Take a screenshot and convert to base64"""
         print(f"Taking screenshot (Step {state['step_count'] + 1}/{state['max_steps']})...")
         
         try:
-            time.sleep(1)
+            # capture as soon as the previous action has finished redrawing the screen
+            start = time.time()
+            stable = wait_until_screen_stable()
+            print(f"Screen {'settled' if stable else 'still changing'} after {time.time() - start:.2f}s")
             screenshot = pyautogui.screenshot()
             buffer = io.BytesIO()
             screenshot.save(buffer, format='PNG')
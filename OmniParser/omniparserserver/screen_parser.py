@@ -1,28 +1,57 @@
+import os
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from agent_state import AgentState
+# OmniParser/, for the util package shared with the parse server and the omnitool agents
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+from util.parser_pool import ParserPool
 
 class ScreenParser:
     """Handles communication with OmniParser server"""
     
-    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000"):
-        self.omniparser_url = omniparser_url
+    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000", pool_size: int = 4, retries: int = 2, timeout: float = 30, session_id: str = None, hedge: bool = True):
+        # several comma separated urls are load balanced by a ParserPool, with failover and hedged parses
+        urls = [url.strip() for url in omniparser_url.split(",") if url.strip()]
+        self.omniparser_url = urls[0]
+        self.timeout = timeout
+        # with a session_id the server tracks elements across parses, their track_id becomes the element id
+        self.session_id = session_id
+        # keep-alive session so every step reuses the connection to the server; only connection errors are retried
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.2))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ParserPool(urls, http=self.session, retries=retries, timeout=timeout, hedge=hedge) if len(urls) > 1 else None
     
     def parse_screen(self, state: AgentState) -> AgentState:
         """Send screenshot to OmniParser server"""
         print("Parsing screen content...")
         
         try:
-            payload = {"base64_image": state["screenshot_base64"]}
+            # the server gives up on the parse once this client has stopped waiting for it
+            payload = {"base64_image": state["screenshot_base64"], "timeout": self.timeout}
+            if self.session_id is not None:
+                payload["session_id"] = self.session_id
             
-            response = requests.post(
-                f"{self.omniparser_url}/parse/",
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=30
-            )
+            if self.pool is not None:
+                # raises once every replica it tried failed
+                status_code, result = 200, self.pool.parse(payload)
+            else:
+                response = self.session.post(
+                    f"{self.omniparser_url}/parse/",
+                    json=payload,
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout
+                )
+                status_code = response.status_code
             
-            if response.status_code == 200:
-                result = response.json()
+            if status_code == 200:
+                if self.pool is None:
+                    result = response.json()
                 
                 if "parsed_content_list" in result:
                     state["parsed_content"] = result["parsed_content_list"]
@@ -33,7 +62,7 @@ class ScreenParser:
                             # Full element data is available
                             state["parsed_elements"] = []
                             for i, element_data in enumerate(state["parsed_content"]):
-                                element = {"id": i}
+                                element = {"id": element_data.get("track_id", i)}
                                 element.update(element_data)  # Merge all element data including bbox
                                 state["parsed_elements"].append(element)
                         else:
@@ -51,7 +80,7 @@ class ScreenParser:
                 print(f"Found {len(state['parsed_content'])} elements on screen")
                     
             else:
-                state["error"] = f"OmniParser error: {response.status_code}"
+                state["error"] = f"OmniParser error: {status_code}"
                 
         except Exception as e:
             state["error"] = f"Failed to parse screen: {str(e)}"
@@ -1,3 +1,4 @@
+import uuid
 from langgraph.graph import StateGraph, END
 from agent_state import AgentState
 from screen_capture import ScreenCapture
@@ -9,11 +10,14 @@ from IPython.display import Image, display
 class WorkflowManager:
     """Manages the workflow graph and orchestrates all components"""
     
-    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000", gemini_api_key: str = None):
+    def __init__(self, omniparser_url: str = "http://127.0.0.1:8000", gemini_api_key: str = None, track_elements: bool = False,
+                 element_token_budget: int = None, element_coordinates: bool = False, element_delta: bool = False):
         # Initialize all components
         self.screen_capture = ScreenCapture()
-        self.screen_parser = ScreenParser(omniparser_url)
-        self.ai_reasoner = AIReasoner(gemini_api_key)
+        # track_elements: the parse server keeps element ids stable across this agent's screens
+        self.screen_parser = ScreenParser(omniparser_url, session_id=uuid.uuid4().hex if track_elements else None)
+        self.ai_reasoner = AIReasoner(gemini_api_key, element_token_budget=element_token_budget, element_coordinates=element_coordinates,
+                                      element_delta=element_delta)
         self.action_executor = ActionExecutor()
         
         # Build the workflow graph
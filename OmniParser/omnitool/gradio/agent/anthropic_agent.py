@@ -25,6 +25,7 @@ from anthropic.types import TextBlock
 from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock
 
 from tools import ComputerTool, ToolCollection, ToolResult
+from tools.computer import VM_URL
 
 from PIL import Image
 from io import BytesIO
@@ -54,6 +55,7 @@ class AnthropicActor:
         max_tokens: int = 4096,
         only_n_most_recent_images: int | None = None,
         print_usage: bool = True,
+        vm_url: str = VM_URL,
     ):
         self.model = model
         self.provider = provider
@@ -62,7 +64,7 @@ class AnthropicActor:
         self.max_tokens = max_tokens
         self.only_n_most_recent_images = only_n_most_recent_images
         
-        self.tool_collection = ToolCollection(ComputerTool())
+        self.tool_collection = ToolCollection(ComputerTool(vm_url=vm_url))
 
         self.system = SYSTEM_PROMPT
         
@@ -0,0 +1,79 @@
+import os
+import base64
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+OUTPUT_DIR = "./tmp/outputs"
+
+
+def screenshot_path(screenshot_uuid: str, som: bool = False, output_dir: str = OUTPUT_DIR) -> str:
+    """Path under which a step's screenshot (or its SoM image) is referenced in messages and saved."""
+    prefix = "screenshot_som_" if som else "screenshot_"
+    return f"{output_dir}/{prefix}{screenshot_uuid}.png"
+
+
+class ArtifactStore:
+    """
+    In-memory screenshots keyed by path, holding each image's base64 encoding so it is computed once
+    and shared by the parser client and the LLM clients. The agents put the same paths into messages,
+    so encode_image() finds the images here instead of reading the files back.
+
+    With persist=True the files are still written, on a background thread. Evicted entries fall back
+    to those files, so with persist=False max_items must cover every image still in the message history.
+    """
+
+    def __init__(self, max_items: int = 256, persist: bool = True):
+        self.max_items = max_items
+        self.persist = persist
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = []
+
+    @staticmethod
+    def key(path) -> str:
+        return os.path.normpath(str(path))
+
+    def put(self, path, data: bytes | None = None, base64_data: str | None = None) -> str:
+        """Store an image from its bytes or its base64 encoding and return the base64 string."""
+        if base64_data is None:
+            base64_data = base64.b64encode(data).decode("utf-8")
+        with self.lock:
+            self.items[self.key(path)] = base64_data
+            self.items.move_to_end(self.key(path))
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+            if self.persist:
+                self._queue_write(path, data, base64_data)
+        return base64_data
+
+    def save(self, path, data: bytes | None = None, base64_data: str | None = None):
+        """Write a file on the background thread without keeping it in memory, for copies nobody reads back."""
+        with self.lock:
+            self._queue_write(path, data, base64_data)
+
+    def _queue_write(self, path, data, base64_data):
+        self.pending_writes = [f for f in self.pending_writes if not f.done()]
+        self.pending_writes.append(self.writer.submit(self._write, path, data, base64_data))
+
+    def get_base64(self, path) -> str | None:
+        with self.lock:
+            return self.items.get(self.key(path))
+
+    def _write(self, path, data, base64_data):
+        if data is None:
+            data = base64.b64decode(base64_data)
+        os.makedirs(os.path.dirname(str(path)) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def flush(self):
+        """Block until every queued file write has finished."""
+        with self.lock:
+            pending, self.pending_writes = self.pending_writes, []
+        for future in pending:
+            future.result()
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,21 @@
+"""
+Token-budgeted serialization of the parsed screen elements for the planner prompt. The implementation is
+OmniParser/util/element_serializer.py, shared with the CUA app; the planner uses its "ID: 3, Text: ..." lines.
+"""
+import os
+import sys
+
+# OmniParser/, for the util package shared with the parse server and the CUA app
+OMNIPARSER_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
+if OMNIPARSER_ROOT not in sys.path:
+    sys.path.append(OMNIPARSER_ROOT)
+
+from util.element_serializer import (  # noqa: E402
+    estimate_tokens,
+    element_center,
+    element_id,
+    element_index,
+    element_priority,
+    format_element,
+    serialize_elements,
+)
@@ -0,0 +1,15 @@
+"""
+Element diffs between consecutive parses, for describing the screen as a delta instead of the full list.
+The implementation is OmniParser/util/element_diff.py, shared with the CUA app; its default line layout and
+headers are the planner's.
+"""
+from .element_budget import OMNIPARSER_ROOT  # noqa: F401, puts OmniParser/ on sys.path
+
+from util.element_diff import (  # noqa: E402
+    DELTA_HEADER,
+    FULL_HEADER,
+    ElementDiffer,
+    box_iou,
+    content_similarity,
+    match_elements,
+)
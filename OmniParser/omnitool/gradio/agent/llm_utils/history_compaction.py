@@ -0,0 +1,134 @@
+"""
+History compaction for the orchestrated agent, whose history is the task, the plan, then one ledger and one
+response message per step: [task, plan, response, ledger, response, ledger, response, ...].
+
+Steps older than a window are folded into a single rolling action log (one line per action, the ledgers are
+dropped since the latest one supersedes them). Folding happens `chunk` steps at a time, so between folds the
+history only grows at the end and the provider's cached prompt prefix stays valid.
+"""
+from .element_budget import estimate_tokens
+from .utils import is_image_path
+
+ACTION_LOG_HEADER = "Actions taken in earlier steps (oldest first):\n"
+# rough cost of one screenshot in the request, for the history size estimate
+IMAGE_TOKENS = 1000
+MAX_REASONING_CHARS = 120
+
+
+def _block_text(block) -> str:
+    if isinstance(block, str):
+        return block
+    if isinstance(block, dict):
+        return str(block.get("text") or block.get("input") or "")
+    if getattr(block, "type", None) == "text":
+        return block.text
+    if getattr(block, "type", None) == "tool_use":
+        return str(block.input)
+    return str(block)
+
+
+def message_tokens(message: dict) -> int:
+    """Estimated tokens of one history message, screenshots at a flat IMAGE_TOKENS each."""
+    content = message["content"] if isinstance(message["content"], list) else [message["content"]]
+    tokens = 0
+    for block in content:
+        if isinstance(block, str) and is_image_path(block):
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += estimate_tokens(_block_text(block))
+    return tokens
+
+
+def history_tokens(messages: list) -> int:
+    return sum(message_tokens(message) for message in messages)
+
+
+def is_response(message: dict) -> bool:
+    """Planner responses appended by the executor hold content blocks, plans and ledgers hold plain text."""
+    content = message.get("content")
+    return message.get("role") == "assistant" and isinstance(content, list) and any(not isinstance(block, str) for block in content)
+
+
+def summarize_response(message: dict) -> str:
+    """One action log line from a planner response: the action, its target and the start of the reasoning."""
+    text = next((block.text for block in message["content"] if getattr(block, "type", None) == "text"), "")
+    reasoning, *fields = text.split("\n")
+    details = {}
+    for field in fields:
+        key, _, value = field.partition(": ")
+        details[key] = value
+    line = details.get("Next Action", "unknown action")
+    if "Box ID" in details:
+        line += f" on box {details['Box ID']}"
+    if "value" in details:
+        line += f" with {details['value']!r}"
+    reasoning = reasoning.strip()
+    if len(reasoning) > MAX_REASONING_CHARS:
+        reasoning = reasoning[:MAX_REASONING_CHARS - 3] + "..."
+    return f"{line} ({reasoning})" if reasoning else line
+
+
+class HistoryCompactor:
+    """
+    Keeps the last `window` steps of the history verbatim and folds older ones into the action log, `chunk`
+    steps at a time. With token_budget, more steps are folded (down to the latest one) while the estimated
+    history is above it. The action log keeps the last max_log_lines actions.
+    """
+
+    def __init__(self, window: int = 3, chunk: int = 4, token_budget: int | None = None, max_log_lines: int = 30):
+        self.window = max(1, window)
+        self.chunk = max(1, chunk)
+        self.token_budget = token_budget
+        self.max_log_lines = max_log_lines
+        self.log_lines = []
+        self.omitted = 0
+        self.log_message = None
+        self.usage = []
+
+    def reset(self):
+        self.log_lines, self.omitted, self.log_message = [], 0, None
+
+    def compact(self, messages: list, start: int) -> bool:
+        """
+        Compact messages[start + 1:] in place, messages[:start + 1] (the task and plan) are kept as is.
+        Returns whether anything was folded.
+        """
+        before = history_tokens(messages)
+        responses = [i for i in range(start + 1, len(messages)) if is_response(messages[i])]
+        folded = False
+        if len(responses) - self.window >= self.chunk:
+            self._fold(messages, start, responses[-self.window])
+            folded = True
+        # over the budget: fold one more step at a time, down to the latest one
+        while self.token_budget is not None and history_tokens(messages) > self.token_budget:
+            responses = [i for i in range(start + 1, len(messages)) if is_response(messages[i])]
+            if len(responses) <= 1:
+                break
+            self._fold(messages, start, responses[1])
+            folded = True
+        after = history_tokens(messages)
+        self.usage.append({"before": before, "after": after, "messages": len(messages), "folded": folded})
+        print(f"history: ~{after} tokens in {len(messages)} messages" + (f" (~{before} before compaction)" if folded else ""))
+        return folded
+
+    def _fold(self, messages: list, start: int, first_kept: int):
+        """Replace messages[start + 1:cut] with the action log, where cut keeps the ledger before first_kept."""
+        cut = first_kept
+        previous = messages[cut - 1]
+        if cut - 1 > start and previous is not self.log_message and previous.get("role") == "assistant" and not is_response(previous):
+            cut -= 1
+        for message in messages[start + 1:cut]:
+            if message is self.log_message:
+                continue
+            if is_response(message):
+                self.log_lines.append(summarize_response(message))
+        if len(self.log_lines) > self.max_log_lines:
+            self.omitted += len(self.log_lines) - self.max_log_lines
+            self.log_lines = self.log_lines[-self.max_log_lines:]
+        text = ACTION_LOG_HEADER
+        if self.omitted:
+            text += f"({self.omitted} earlier actions omitted)\n"
+        text += "".join(f"{self.omitted + i + 1}. {line}\n" for i, line in enumerate(self.log_lines))
+        # a list like the other history messages, run_oai_interleaved iterates the content
+        self.log_message = {"role": "assistant", "content": [text]}
+        messages[start + 1:cut] = [self.log_message]
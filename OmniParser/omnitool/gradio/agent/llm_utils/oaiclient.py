@@ -2,23 +2,57 @@ import os
 import logging
 import base64
 import requests
-from .utils import is_image_path, encode_image
+from tools import http_pool
+from .utils import is_image_path, encode_image, encode_history_image
 
-def run_oai_interleaved(messages: list, system: str, model_name: str, api_key: str, max_tokens=256, temperature=0, provider_base_url: str = "https://api.openai.com/v1"):    
+# when set, every OpenAI-compatible request goes here instead of the provider, e.g. omnitool/loadtest/mock_llm_server.py
+OAI_BASE_URL = os.environ.get("OAI_BASE_URL")
+
+def run_oai_interleaved(messages: list, system: str, model_name: str, api_key: str, max_tokens=256, temperature=0, provider_base_url: str = "https://api.openai.com/v1", history_image_quality: int | None = None, history_image_max_side: int | None = None):    
     headers = {"Content-Type": "application/json",
                "Authorization": f"Bearer {api_key}"}
+    payload = build_oai_payload(messages, system, model_name, max_tokens, history_image_quality, history_image_max_side)
+
+    try:
+        response = http_pool.post(
+            f"{OAI_BASE_URL or provider_base_url}/chat/completions", headers=headers, json=payload,
+            timeout=http_pool.llm_timeout(),
+        )
+    except requests.exceptions.Timeout as e:
+        print(f"Error in interleaved openAI: {e}. No answer within llm_read_timeout={http_pool.HTTP_CONFIG['llm_read_timeout']}s, raise it with http_pool.configure_http.")
+        raise
+
+
+    try:
+        text = response.json()['choices'][0]['message']['content']
+        token_usage = int(response.json()['usage']['total_tokens'])
+        return text, token_usage
+    except Exception as e:
+        print(f"Error in interleaved openAI: {e}. This may due to your invalid API key. Please check the response: {response.json()} ")
+        return response.json()
+
+def build_oai_payload(messages: list, system: str, model_name: str, max_tokens=256, history_image_quality: int | None = None, history_image_max_side: int | None = None):
+    """
+    Chat completions request body for run_oai_interleaved. Images in the last message are sent as is.
+    With history_image_quality and/or history_image_max_side, images in earlier messages are sent as
+    (downscaled) JPEGs instead; all encodings are cached across steps.
+    """
     final_messages = [{"role": "system", "content": system}]
 
     if type(messages) == list:
-        for item in messages:
+        for i, item in enumerate(messages):
+            is_history = i < len(messages) - 1
             contents = []
             if isinstance(item, dict):
                 for cnt in item["content"]:
                     if isinstance(cnt, str):
                         if is_image_path(cnt) and 'o3-mini' not in model_name:
                             # 03 mini does not support images
-                            base64_image = encode_image(cnt)
-                            content = {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                            if is_history and (history_image_quality or history_image_max_side):
+                                base64_image, media_type = encode_history_image(cnt, quality=history_image_quality or 60, max_side=history_image_max_side)
+                            else:
+                                base64_image, media_type = encode_image(cnt), "image/jpeg"
+                            content = {"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{base64_image}"}}
                         else:
                             content = {"type": "text", "text": cnt}
                     else:
@@ -47,16 +81,4 @@ def run_oai_interleaved(messages: list, system: str, model_name: str, api_key: s
         payload['max_completion_tokens'] = max_tokens
     else:
         payload['max_tokens'] = max_tokens
-
-    response = requests.post(
-        f"{provider_base_url}/chat/completions", headers=headers, json=payload
-    )
-
-
-    try:
-        text = response.json()['choices'][0]['message']['content']
-        token_usage = int(response.json()['usage']['total_tokens'])
-        return text, token_usage
-    except Exception as e:
-        print(f"Error in interleaved openAI: {e}. This may due to your invalid API key. Please check the response: {response.json()} ")
-        return response.json()
\ No newline at end of file
+    return payload
@@ -1,44 +1,165 @@
-import requests
-import base64
-from pathlib import Path
-from tools.screen_capture import get_screenshot
-from agent.llm_utils.utils import encode_image
-
-OUTPUT_DIR = "./tmp/outputs"
+import asyncio
+from io import BytesIO
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from tools import http_pool
+from tools.screen_capture import VM_URL, get_screenshot, wait_for_screen_stable, fetch_screenshot, fetch_screenshot_async, wait_for_screen_stable_async, frame_stream_running, screen_fingerprint
+from agent.llm_utils.artifact_store import OUTPUT_DIR, artifact_store, screenshot_path
+from agent.llm_utils.parser_pool import ParserPool, parse_response_json
 
 class OmniParserClient:
     def __init__(self, 
-                 url: str) -> None:
+                 url: str,
+                 session_id: str | None = None,
+                 vm_url: str = VM_URL,
+                 output_dir: str = OUTPUT_DIR,
+                 pool: ParserPool | None = None) -> None:
         self.url = url
+        # with a pool, parses are balanced over several servers and url is not used
+        self.pool = pool
+        # with a session_id the server tracks elements across this client's parses and returns stable track_ids
+        self.session_id = session_id
+        # the VM the screenshots come from and where they are saved, so clients of different sessions don't mix
+        self.vm_url = vm_url
+        self.output_dir = output_dir
+        # background capture+parse of the next screen, see speculate()
+        self.speculation = None
+        self.speculation_pool = ThreadPoolExecutor(max_workers=1)
+        self.speculation_hits, self.speculation_misses = 0, 0
+
+    def speculate(self):
+        """
+        Start capturing and parsing the next screen in the background, right after the step's actions ran,
+        so it overlaps whatever happens before the next parse is needed (UI updates, the ledger LLM call).
+        """
+        # a tracked parse advances the server's element tracker even when the speculation is discarded
+        if self.speculation is None and self.session_id is None:
+            self.speculation = self.speculation_pool.submit(self._speculative_parse)
+
+    def close(self):
+        """Stop the speculation worker thread when the session ends, dropping a speculative parse that has not started."""
+        self.speculation = None
+        self.speculation_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _speculative_parse(self):
+        wait_for_screen_stable(vm_url=self.vm_url)
+        # straight from the VM rather than the frame stream, so the fingerprint is taken from the very grab that is parsed
+        data, params = fetch_screenshot(fingerprint=True, vm_url=self.vm_url)
+        return params["fingerprint"], self._parse(Image.open(BytesIO(data)), data)
+
+    def _take_speculation(self, fingerprint, parsed):
+        """Return the speculative parse if the screen still matches the frame it was captured from."""
+        if fingerprint is None:
+            self.speculation_misses += 1
+            print("speculative parse discarded, the VM server sent no fingerprint")
+            return None
+        try:
+            current = screen_fingerprint(vm_url=self.vm_url)
+        except Exception as e:
+            print(f"speculative parse discarded, fingerprint failed: {e}")
+            current = None
+        if current == fingerprint:
+            self.speculation_hits += 1
+            print(f"speculative parse reused ({self.speculation_hits} hits, {self.speculation_misses} misses)")
+            return parsed
+        self.speculation_misses += 1
+        print(f"speculative parse discarded, screen changed ({self.speculation_hits} hits, {self.speculation_misses} misses)")
+        return None
 
     def __call__(self,):
-        screenshot, screenshot_path = get_screenshot()
-        screenshot_path = str(screenshot_path)
-        image_base64 = encode_image(screenshot_path)
-        response = requests.post(self.url, json={"base64_image": image_base64})
-        response_json = response.json()
-        print('omniparser latency:', response_json['latency'])
+        if self.speculation is not None:
+            speculation, self.speculation = self.speculation, None
+            try:
+                parsed = self._take_speculation(*speculation.result())
+            except Exception as e:
+                print(f"speculative parse failed: {e}")
+                parsed = None
+            if parsed is not None:
+                return parsed
+        # the previous step's actions may still be redrawing the screen
+        wait_for_screen_stable(vm_url=self.vm_url)
+        return self._capture_and_parse()
+
+    def _capture(self):
+        """Screenshot as (image, png bytes), from the VM or the frame stream without going through disk."""
+        if frame_stream_running(self.vm_url):
+            screenshot, _ = get_screenshot(save=False, vm_url=self.vm_url)
+            buffer = BytesIO()
+            screenshot.save(buffer, format="PNG")
+            return screenshot, buffer.getvalue()
+        data, _ = fetch_screenshot(vm_url=self.vm_url)
+        return Image.open(BytesIO(data)), data
 
-        som_image_data = base64.b64decode(response_json['som_image_base64'])
-        screenshot_path_uuid = Path(screenshot_path).stem.replace("screenshot_", "")
-        som_screenshot_path = f"{OUTPUT_DIR}/screenshot_som_{screenshot_path_uuid}.png"
-        with open(som_screenshot_path, "wb") as f:
-            f.write(som_image_data)
+    def _capture_and_parse(self):
+        return self._parse(*self._capture())
+
+    def _parse(self, screenshot, data: bytes):
+        screenshot_uuid = uuid4().hex
+        image_base64 = artifact_store.put(screenshot_path(screenshot_uuid, output_dir=self.output_dir), data)
+        return self._finish(self._post(image_base64), screenshot, screenshot_uuid, image_base64)
+
+    def _post(self, image_base64: str) -> dict:
+        if self.pool is not None:
+            return self.pool.parse(self._payload(image_base64))
+        # a 504 means the server dropped the parse once its deadline passed
+        return parse_response_json(http_pool.post(self.url, json=self._payload(image_base64)))
+
+    def _payload(self, image_base64: str):
+        # the server drops the parse once the read timeout has passed and this client stopped waiting;
+        # a pool caps it at its own timeout and sends each attempt only the time left of that deadline
+        payload = {"base64_image": image_base64, "timeout": http_pool.HTTP_CONFIG["read_timeout"]}
+        if self.session_id is not None:
+            payload["session_id"] = self.session_id
+        return payload
+
+    def _finish(self, response_json: dict, screenshot, screenshot_uuid: str, image_base64: str):
+        print('omniparser latency:', response_json['latency'])
+        # kept as the base64 the server sent; it is only decoded if the store persists it
+        artifact_store.put(screenshot_path(screenshot_uuid, som=True, output_dir=self.output_dir), base64_data=response_json['som_image_base64'])
         
         response_json['width'] = screenshot.size[0]
         response_json['height'] = screenshot.size[1]
         response_json['original_screenshot_base64'] = image_base64
-        response_json['screenshot_uuid'] = screenshot_path_uuid
+        response_json['screenshot_uuid'] = screenshot_uuid
         response_json = self.reformat_messages(response_json)
         return response_json
+
+    async def parse_async(self):
+        """Awaitable __call__; screenshot and parse requests go through the shared async client."""
+        if self.speculation is not None:
+            speculation, self.speculation = self.speculation, None
+            try:
+                fingerprint, parsed = await asyncio.wrap_future(speculation)
+                parsed = await asyncio.to_thread(self._take_speculation, fingerprint, parsed)
+            except Exception as e:
+                print(f"speculative parse failed: {e}")
+                parsed = None
+            if parsed is not None:
+                return parsed
+        await wait_for_screen_stable_async(vm_url=self.vm_url)
+        if frame_stream_running(self.vm_url):
+            screenshot, data = await asyncio.to_thread(self._capture)
+        else:
+            data, _ = await fetch_screenshot_async(vm_url=self.vm_url)
+            screenshot = Image.open(BytesIO(data))
+        screenshot_uuid = uuid4().hex
+        image_base64 = artifact_store.put(screenshot_path(screenshot_uuid, output_dir=self.output_dir), data)
+        if self.pool is not None:
+            response_json = await asyncio.to_thread(self.pool.parse, self._payload(image_base64))
+        else:
+            response_json = parse_response_json(await http_pool.get_async_client().post(self.url, json=self._payload(image_base64)))
+        return self._finish(response_json, screenshot, screenshot_uuid, image_base64)
     
     def reformat_messages(self, response_json: dict):
         screen_info = ""
         for idx, element in enumerate(response_json["parsed_content_list"]):
             element['idx'] = idx
+            # tracked elements are shown by their stable track_id, which is also the SoM label
+            element_id = element.get('track_id', idx)
             if element['type'] == 'text':
-                screen_info += f'ID: {idx}, Text: {element["content"]}\n'
+                screen_info += f'ID: {element_id}, Text: {element["content"]}\n'
             elif element['type'] == 'icon':
-                screen_info += f'ID: {idx}, Icon: {element["content"]}\n'
+                screen_info += f'ID: {element_id}, Icon: {element["content"]}\n'
         response_json['screen_info'] = screen_info
         return response_json
\ No newline at end of file
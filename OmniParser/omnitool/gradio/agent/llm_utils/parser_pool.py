@@ -0,0 +1,25 @@
+"""
+Client-side load balancing over several OmniParser servers. The ParserPool is OmniParser/util/parser_pool.py,
+shared with the CUA app; here its parses go through the shared http_pool connections, and one pool per set
+of urls is shared by every client in the process.
+"""
+import threading
+
+from tools import http_pool
+from .element_budget import OMNIPARSER_ROOT  # noqa: F401, puts OmniParser/ on sys.path
+
+from util.parser_pool import ParserPool, ParserReplica, ParseDeadlineExceeded, parse_response_json  # noqa: E402, F401
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_parser_pool(urls: list, **kwargs) -> ParserPool:
+    """The pool for these urls, shared by every client in the process so their outstanding parses are counted together."""
+    key = tuple(url.rstrip("/") for url in urls)
+    kwargs.setdefault("http", http_pool)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ParserPool(list(key), **kwargs)
+        return _pools[key]
@@ -0,0 +1,41 @@
+"""
+Prompt layout for provider prompt caching: providers reuse the longest byte-identical prefix of a request,
+so the static system prompt and the append-only history go first and the per-step screen state last.
+"""
+
+SCREEN_INFO_HEADER = "Here is the list of all detected bounding boxes by IDs on the current screen and their description:\n"
+
+
+def with_screen_state(messages: list, screen_info: str) -> list:
+    """
+    Request messages with the screen element list appended to the end of the last message.
+    The history itself is not modified, so this step's element list does not leak into later prefixes.
+    """
+    last = dict(messages[-1])
+    content = last["content"] if isinstance(last["content"], list) else [last["content"]]
+    last["content"] = content + [SCREEN_INFO_HEADER + screen_info]
+    return messages[:-1] + [last]
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    # binary search on slice equality, requests carry megabytes of base64 images
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def prefix_stability_report(requests: list[str]) -> list[dict]:
+    """
+    For consecutive serialized requests, how much of each one is a byte-identical prefix of the previous
+    request, i.e. what a prefix cache could serve.
+    """
+    report = []
+    for step, request in enumerate(requests):
+        stable = common_prefix_length(requests[step - 1], request) if step else 0
+        report.append({"step": step + 1, "chars": len(request), "stable_prefix": stable, "cacheable_fraction": stable / len(request) if request else 0.0})
+    return report
@@ -1,4 +1,15 @@
+import os
 import base64
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from PIL import Image
+from .artifact_store import artifact_store
+
+# bounded cache of base64 encodings, keyed by path + mtime (+ re-encode settings) so edited files are re-read
+ENCODE_CACHE_SIZE = 128
+_encode_cache = OrderedDict()
+_encode_cache_lock = threading.Lock()
 
 def is_image_path(text):
     image_extensions = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".tif")
@@ -7,7 +18,51 @@ def is_image_path(text):
     else:
         return False
 
+def _cache_key(image_path, stored, *settings):
+    """stored: the artifact store held the image when the caller looked it up."""
+    # stored screenshots never change under their path, files on disk are keyed by their mtime as well;
+    # an image evicted from a store that does not persist has neither, its key is that of the stored one
+    mtime = None
+    if not stored:
+        try:
+            mtime = os.path.getmtime(image_path)
+        except FileNotFoundError:
+            pass
+    return (os.path.normpath(str(image_path)), mtime) + settings
+
+def _cached(key, encode):
+    with _encode_cache_lock:
+        if key in _encode_cache:
+            _encode_cache.move_to_end(key)
+            return _encode_cache[key]
+    value = encode()
+    with _encode_cache_lock:
+        _encode_cache[key] = value
+        while len(_encode_cache) > ENCODE_CACHE_SIZE:
+            _encode_cache.popitem(last=False)
+    return value
+
 def encode_image(image_path):
-    """Encode image file to base64."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
\ No newline at end of file
+    """Encode image file to base64, reusing the encoding held in the artifact store when there is one."""
+    cached = artifact_store.get_base64(image_path)
+    if cached is not None:
+        return cached
+    def encode():
+        with open(image_path, "rb") as image_file:
+            return base64.b64encode(image_file.read()).decode("utf-8")
+    return _cached(_cache_key(image_path, False), encode)
+
+def encode_history_image(image_path, quality=60, max_side=None):
+    """
+    JPEG re-encoding of an older image in the conversation, optionally downscaled so its longest side is
+    at most max_side. Returns (base64, media type); cached like encode_image.
+    """
+    stored = artifact_store.get_base64(image_path)
+    def encode():
+        image = Image.open(BytesIO(base64.b64decode(stored if stored is not None else encode_image(image_path)))).convert("RGB")
+        if max_side and max(image.size) > max_side:
+            image.thumbnail((max_side, max_side))
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        return base64.b64encode(buffer.getvalue()).decode("utf-8"), "image/jpeg"
+    return _cached(_cache_key(image_path, stored is not None, quality, max_side), encode)
@@ -13,6 +13,9 @@ from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock, B
 from agent.llm_utils.oaiclient import run_oai_interleaved
 from agent.llm_utils.groqclient import run_groq_interleaved
 from agent.llm_utils.utils import is_image_path
+from agent.llm_utils.element_budget import serialize_elements, estimate_tokens, element_index
+from agent.llm_utils.prompt_layout import with_screen_state
+from agent.llm_utils.element_diff import ElementDiffer
 import time
 import re
 
@@ -38,6 +41,13 @@ class VLMAgent:
         max_tokens: int = 4096,
         only_n_most_recent_images: int | None = None,
         print_usage: bool = True,
+        history_image_quality: int | None = None,
+        history_image_max_side: int | None = None,
+        element_token_budget: int | None = None,
+        element_coordinates: bool = False,
+        image_removal_chunk: int = 1,
+        element_delta: bool = False,
+        output_dir: str = OUTPUT_DIR,
     ):
         if model == "omniparser + gpt-4o":
             self.model = "gpt-4o-2024-11-20"
@@ -59,8 +69,22 @@ class VLMAgent:
         self.max_tokens = max_tokens
         self.only_n_most_recent_images = only_n_most_recent_images
         self.output_callback = output_callback
+        # where the parse client saved this session's screenshots, the messages reference them by path
+        self.output_dir = output_dir
 
         self.print_usage = print_usage
+        # older screenshots in the conversation are re-encoded as smaller JPEGs, see run_oai_interleaved
+        self.history_image_quality = history_image_quality
+        self.history_image_max_side = history_image_max_side
+        # screen elements in the prompt are ranked and cut to this many (estimated) tokens, see element_budget
+        self.element_token_budget = element_token_budget
+        self.element_coordinates = element_coordinates
+        self.last_action_point = None
+        self.element_token_usage = []
+        # drop old screenshots this many at a time, larger values keep the cached prompt prefix valid for longer
+        self.image_removal_chunk = image_removal_chunk
+        # element_delta: IDs stay stable across steps and only the changes since the last step are sent
+        self.element_differ = ElementDiffer() if element_delta else None
         self.total_token_usage = 0
         self.total_cost = 0
         self.step_count = 0
@@ -76,29 +100,52 @@ class VLMAgent:
         screenshot_uuid = parsed_screen['screenshot_uuid']
         screen_width, screen_height = parsed_screen['width'], parsed_screen['height']
 
-        boxids_and_labels = parsed_screen["screen_info"]
-        system = self._get_system_prompt(boxids_and_labels)
+        if self.element_differ is not None:
+            element_diff = self.element_differ.update(parsed_screen["parsed_content_list"])
+            boxids_and_labels = self.element_differ.describe(parsed_screen["parsed_content_list"], element_diff, self.element_token_budget, self.element_coordinates)
+            listed = len(element_diff["ids"]) if element_diff["full"] else len(element_diff["added"]) + len(element_diff["changed"])
+            element_stats = {"total": len(element_diff["ids"]), "kept": listed, "tokens": estimate_tokens(boxids_and_labels), "budget": self.element_token_budget, "delta": not element_diff["full"]}
+        elif self.element_token_budget is not None or self.element_coordinates:
+            boxids_and_labels, element_stats = serialize_elements(parsed_screen["parsed_content_list"], self.element_token_budget, self.last_action_point, self.element_coordinates)
+        else:
+            boxids_and_labels = parsed_screen["screen_info"]
+            element_stats = {"total": len(parsed_screen["parsed_content_list"]), "kept": len(parsed_screen["parsed_content_list"]), "tokens": estimate_tokens(boxids_and_labels), "budget": None}
+        self.element_token_usage.append(element_stats)
+        print(f"screen elements in prompt: {element_stats['kept']}/{element_stats['total']}, ~{element_stats['tokens']} tokens")
+        # static, so it and the history form a prefix the provider can cache; the elements go last
+        system = self._get_system_prompt()
 
         # drop looping actions msg, byte image etc
         planner_messages = messages
         _remove_som_images(planner_messages)
-        _maybe_filter_to_n_most_recent_images(planner_messages, self.only_n_most_recent_images)
+        _maybe_filter_to_n_most_recent_images(planner_messages, self.only_n_most_recent_images, self.image_removal_chunk)
 
         if isinstance(planner_messages[-1], dict):
             if not isinstance(planner_messages[-1]["content"], list):
                 planner_messages[-1]["content"] = [planner_messages[-1]["content"]]
-            planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_{screenshot_uuid}.png")
-            planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_som_{screenshot_uuid}.png")
+            planner_messages[-1]["content"].append(f"{self.output_dir}/screenshot_{screenshot_uuid}.png")
+            tracked = any("track_id" in element for element in parsed_screen["parsed_content_list"])
+            if self.element_differ is None or tracked:
+                # untracked SoM labels are list indices, which don't match the stable IDs of the delta mode
+                planner_messages[-1]["content"].append(f"{self.output_dir}/screenshot_som_{screenshot_uuid}.png")
+        if self.element_differ is not None:
+            # a delta only makes sense next to the earlier lists, so it stays in the history
+            planner_messages[-1]["content"].append(boxids_and_labels)
+            request_messages = planner_messages
+        else:
+            request_messages = with_screen_state(planner_messages, boxids_and_labels)
 
         start = time.time()
         if "gpt" in self.model or "o1" in self.model or "o3-mini" in self.model:
             vlm_response, token_usage = run_oai_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
                 max_tokens=self.max_tokens,
                 provider_base_url="https://api.openai.com/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
             print(f"oai token usage: {token_usage}")
@@ -111,7 +158,7 @@ class VLMAgent:
                 self.total_cost += (token_usage * 1.1 / 1000000)  # https://openai.com/api/pricing/
         elif "r1" in self.model:
             vlm_response, token_usage = run_groq_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
@@ -122,12 +169,14 @@ class VLMAgent:
             self.total_cost += (token_usage * 0.99 / 1000000)
         elif "qwen" in self.model:
             vlm_response, token_usage = run_oai_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
                 max_tokens=min(2048, self.max_tokens),
                 provider_base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
             print(f"qwen token usage: {token_usage}")
@@ -149,23 +198,37 @@ class VLMAgent:
         img_to_show_base64 = parsed_screen["som_image_base64"]
         if "Box ID" in vlm_response_json:
             try:
-                bbox = parsed_screen["parsed_content_list"][int(vlm_response_json["Box ID"])]["bbox"]
+                box_id = int(vlm_response_json["Box ID"])
+            except (TypeError, ValueError):
+                box_id = None
+            if box_id is None:
+                box_index = None
+            elif self.element_differ is not None:
+                box_index = self.element_differ.index_of(box_id)
+            else:
+                box_index = element_index(parsed_screen["parsed_content_list"], box_id)
+            if box_index is None:
+                # an ID the model made up, or one of an element that is no longer on the screen
+                print(f"Box ID {vlm_response_json['Box ID']} not found on the screen: {vlm_response_json}")
+            else:
+                bbox = parsed_screen["parsed_content_list"][box_index]["bbox"]
                 vlm_response_json["box_centroid_coordinate"] = [int((bbox[0] + bbox[2]) / 2 * screen_width), int((bbox[1] + bbox[3]) / 2 * screen_height)]
-                img_to_show_data = base64.b64decode(img_to_show_base64)
-                img_to_show = Image.open(BytesIO(img_to_show_data))
-
-                draw = ImageDraw.Draw(img_to_show)
-                x, y = vlm_response_json["box_centroid_coordinate"] 
-                radius = 10
-                draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill='red')
-                draw.ellipse((x - radius*3, y - radius*3, x + radius*3, y + radius*3), fill=None, outline='red', width=2)
-
-                buffered = BytesIO()
-                img_to_show.save(buffered, format="PNG")
-                img_to_show_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            except:
-                print(f"Error parsing: {vlm_response_json}")
-                pass
+                self.last_action_point = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+                try:
+                    img_to_show_data = base64.b64decode(img_to_show_base64)
+                    img_to_show = Image.open(BytesIO(img_to_show_data))
+
+                    draw = ImageDraw.Draw(img_to_show)
+                    x, y = vlm_response_json["box_centroid_coordinate"] 
+                    radius = 10
+                    draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill='red')
+                    draw.ellipse((x - radius*3, y - radius*3, x + radius*3, y + radius*3), fill=None, outline='red', width=2)
+
+                    buffered = BytesIO()
+                    img_to_show.save(buffered, format="PNG")
+                    img_to_show_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+                except Exception as e:
+                    print(f"Error marking the target on the screenshot: {e}")
         self.output_callback(f'<img src="data:image/png;base64,{img_to_show_base64}">', sender="bot")
         self.output_callback(
                     f'<details>'
@@ -207,7 +270,11 @@ class VLMAgent:
     def _api_response_callback(self, response: APIResponse):
         self.api_response_callback(response)
 
-    def _get_system_prompt(self, screen_info: str = ""):
+    def _get_system_prompt(self):
+        if self.element_differ is None:
+            boxes_section = "The list of all detected bounding boxes by IDs on the screen and their description is given at the end of the latest message."
+        else:
+            boxes_section = "The detected bounding boxes by IDs on the screen and their description are given at the end of the latest message, either as a full list or as the changes since the previous step. An ID refers to the same element for as long as it stays on screen."
         main_section = f"""
 You are using a Windows device.
 You are able to use a mouse and keyboard to interact with the computer based on the given task and screenshot.
@@ -216,7 +283,7 @@ You can only interact with the desktop GUI (no terminal or application menu acce
 You may be given some history plan and actions, this is the response from the previous loop.
 You should carefully consider your plan base on the task, screenshot, and history actions.
 
-Here is the list of all detected bounding boxes by IDs on the screen and their description:{screen_info}
+{boxes_section}
 
 Your available "Next Action" only include:
 - type: types a string of text.
@@ -226,7 +293,7 @@ Your available "Next Action" only include:
 - hover: move mouse to box id.
 - scroll_up: scrolls the screen up to view previous content.
 - scroll_down: scrolls the screen down, when the desired button is not visible, or you need to see more content. 
-- wait: waits for 1 second for the device to load or respond.
+- wait: waits until the screen stops changing, for the device to load or respond.
 
 Based on the visual information from the screenshot image and the detected bounding boxes, please determine the next action, the Box ID you should operate on (if action is one of 'type', 'hover', 'scroll_up', 'scroll_down', 'wait', there should be no Box ID field), and the value (if the action is 'type') in order to complete the task.
 
@@ -311,7 +378,8 @@ def _maybe_filter_to_n_most_recent_images(
     """
     With the assumption that images are screenshots that are of diminishing value as
     the conversation progresses, remove all but the final `images_to_keep` tool_result
-    images in place
+    images in place. Images are removed in multiples of `min_removal_threshold`, so the
+    history (and the provider's cached prompt prefix) stays unchanged in between.
     """
     if images_to_keep is None:
         return messages
@@ -327,6 +395,7 @@ def _maybe_filter_to_n_most_recent_images(
                         total_images += 1
 
     images_to_remove = total_images - images_to_keep
+    images_to_remove -= images_to_remove % min_removal_threshold
     
     for msg in messages:
         msg_content = msg["content"]
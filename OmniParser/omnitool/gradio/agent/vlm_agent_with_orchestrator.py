@@ -6,6 +6,7 @@ from PIL import Image, ImageDraw
 import base64
 from io import BytesIO
 import copy
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from anthropic import APIResponse
@@ -15,6 +16,11 @@ from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock, B
 from agent.llm_utils.oaiclient import run_oai_interleaved
 from agent.llm_utils.groqclient import run_groq_interleaved
 from agent.llm_utils.utils import is_image_path
+from agent.llm_utils.artifact_store import artifact_store
+from agent.llm_utils.element_budget import serialize_elements, estimate_tokens, element_index
+from agent.llm_utils.prompt_layout import with_screen_state
+from agent.llm_utils.element_diff import ElementDiffer
+from agent.llm_utils.history_compaction import HistoryCompactor, history_tokens
 import time
 import re
 import os
@@ -74,6 +80,18 @@ class VLMOrchestratedAgent:
         only_n_most_recent_images: int | None = None,
         print_usage: bool = True,
         save_folder: str = None,
+        history_image_quality: int | None = None,
+        history_image_max_side: int | None = None,
+        element_token_budget: int | None = None,
+        element_coordinates: bool = False,
+        image_removal_chunk: int = 1,
+        element_delta: bool = False,
+        history_window: int | None = None,
+        history_compaction_chunk: int = 4,
+        history_token_budget: int | None = None,
+        parallel_ledger: bool = False,
+        ledger_every: int = 1,
+        output_dir: str = OUTPUT_DIR,
     ):
         if model == "omniparser + gpt-4o" or model == "omniparser + gpt-4o-orchestrated":
             self.model = "gpt-4o-2024-11-20"
@@ -95,9 +113,32 @@ class VLMOrchestratedAgent:
         self.max_tokens = max_tokens
         self.only_n_most_recent_images = only_n_most_recent_images
         self.output_callback = output_callback
+        # where the parse client saved this session's screenshots, the messages reference them by path
+        self.output_dir = output_dir
         self.save_folder = save_folder
         
         self.print_usage = print_usage
+        # older screenshots in the conversation are re-encoded as smaller JPEGs, see run_oai_interleaved
+        self.history_image_quality = history_image_quality
+        self.history_image_max_side = history_image_max_side
+        # screen elements in the prompt are ranked and cut to this many (estimated) tokens, see element_budget
+        self.element_token_budget = element_token_budget
+        self.element_coordinates = element_coordinates
+        self.last_action_point = None
+        self.element_token_usage = []
+        # drop old screenshots this many at a time, larger values keep the cached prompt prefix valid for longer
+        self.image_removal_chunk = image_removal_chunk
+        # element_delta: IDs stay stable across steps and only the changes since the last step are sent
+        self.element_differ = ElementDiffer() if element_delta else None
+        # history_window: steps older than this are folded into an action log, see history_compaction
+        self.history_compactor = HistoryCompactor(history_window, history_compaction_chunk, history_token_budget) if history_window else None
+        self.plan_message = None
+        self.history_token_usage = []
+        # parallel_ledger: the ledger update runs concurrently with planning, which then sees the previous ledger.
+        # ledger_every: update the ledger every N steps only, and whenever a loop is suspected
+        self.ledger_pool = ThreadPoolExecutor(max_workers=1) if parallel_ledger else None
+        self.ledger_every = max(1, ledger_every)
+        self.recent_actions = []
         self.total_token_usage = 0
         self.total_cost = 0
         self.step_count = 0
@@ -110,56 +151,85 @@ class VLMOrchestratedAgent:
             plan = self._initialize_task(messages)
             self.output_callback(f'-- Plan: {plan} --', )
             # update messages with the plan
-            messages.append({"role": "assistant", "content": plan})
+            self.plan_message = {"role": "assistant", "content": plan}
+            messages.append(self.plan_message)
+            ledger_future = None
         else:
-            updated_ledger = self._update_ledger(messages)
-            self.output_callback(
-                f'<details>'
-                f'  <summary><strong>Task Progress Ledger (click to expand)</strong></summary>'
-                f'  <div style="padding: 10px; background-color: #f8f9fa; border-radius: 5px; margin-top: 5px;">'
-                f'    <pre>{updated_ledger}</pre>'
-                f'  </div>'
-                f'</details>',
-            )
-            # update messages with the ledger
-            messages.append({"role": "assistant", "content": updated_ledger})
-            self.ledger = updated_ledger
+            self._compact_history(messages)
+            # this step's message: the ledger, then the screenshot and screen state appended below
+            step_message = {"role": "assistant", "content": []}
+            ledger_future = None
+            ledger_start = time.time()
+            if not self._ledger_due():
+                print(f"ledger update skipped at step {self.step_count + 1}")
+            elif self.ledger_pool is not None:
+                # snapshot now, the history is modified in place while the ledger call runs
+                ledger_future = self.ledger_pool.submit(self._update_ledger, copy.deepcopy(messages))
+            else:
+                self._record_ledger(self._update_ledger(messages), step_message)
+            messages.append(step_message)
+
+        if callable(parsed_screen):
+            # OmniParserClient passed in speculative mode, its background parse ran while the ledger was updated
+            parsed_screen = parsed_screen()
 
         self.step_count += 1
-        # save the image to the output folder
-        with open(f"{self.save_folder}/screenshot_{self.step_count}.png", "wb") as f:
-            f.write(base64.b64decode(parsed_screen['original_screenshot_base64']))
-        with open(f"{self.save_folder}/som_screenshot_{self.step_count}.png", "wb") as f:
-            f.write(base64.b64decode(parsed_screen['som_image_base64']))
+        # save the image to the output folder, written in the background while this step's LLM call runs
+        artifact_store.save(f"{self.save_folder}/screenshot_{self.step_count}.png", base64_data=parsed_screen['original_screenshot_base64'])
+        artifact_store.save(f"{self.save_folder}/som_screenshot_{self.step_count}.png", base64_data=parsed_screen['som_image_base64'])
 
         latency_omniparser = parsed_screen['latency']
         screen_info = str(parsed_screen['screen_info'])
         screenshot_uuid = parsed_screen['screenshot_uuid']
         screen_width, screen_height = parsed_screen['width'], parsed_screen['height']
 
-        boxids_and_labels = parsed_screen["screen_info"]
-        system = self._get_system_prompt(boxids_and_labels)
+        if self.element_differ is not None:
+            element_diff = self.element_differ.update(parsed_screen["parsed_content_list"])
+            boxids_and_labels = self.element_differ.describe(parsed_screen["parsed_content_list"], element_diff, self.element_token_budget, self.element_coordinates)
+            listed = len(element_diff["ids"]) if element_diff["full"] else len(element_diff["added"]) + len(element_diff["changed"])
+            element_stats = {"total": len(element_diff["ids"]), "kept": listed, "tokens": estimate_tokens(boxids_and_labels), "budget": self.element_token_budget, "delta": not element_diff["full"]}
+        elif self.element_token_budget is not None or self.element_coordinates:
+            boxids_and_labels, element_stats = serialize_elements(parsed_screen["parsed_content_list"], self.element_token_budget, self.last_action_point, self.element_coordinates)
+        else:
+            boxids_and_labels = parsed_screen["screen_info"]
+            element_stats = {"total": len(parsed_screen["parsed_content_list"]), "kept": len(parsed_screen["parsed_content_list"]), "tokens": estimate_tokens(boxids_and_labels), "budget": None}
+        self.element_token_usage.append(element_stats)
+        print(f"screen elements in prompt: {element_stats['kept']}/{element_stats['total']}, ~{element_stats['tokens']} tokens")
+        # static, so it and the history form a prefix the provider can cache; the elements go last
+        system = self._get_system_prompt()
 
         # drop looping actions msg, byte image etc
         planner_messages = messages
         _remove_som_images(planner_messages)
-        _maybe_filter_to_n_most_recent_images(planner_messages, self.only_n_most_recent_images)
+        _maybe_filter_to_n_most_recent_images(planner_messages, self.only_n_most_recent_images, self.image_removal_chunk)
 
         if isinstance(planner_messages[-1], dict):
             if not isinstance(planner_messages[-1]["content"], list):
                 planner_messages[-1]["content"] = [planner_messages[-1]["content"]]
-            planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_{screenshot_uuid}.png")
-            planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_som_{screenshot_uuid}.png")
+            planner_messages[-1]["content"].append(f"{self.output_dir}/screenshot_{screenshot_uuid}.png")
+            tracked = any("track_id" in element for element in parsed_screen["parsed_content_list"])
+            if self.element_differ is None or tracked:
+                # untracked SoM labels are list indices, which don't match the stable IDs of the delta mode
+                planner_messages[-1]["content"].append(f"{self.output_dir}/screenshot_som_{screenshot_uuid}.png")
+        if self.element_differ is not None:
+            # a delta only makes sense next to the earlier lists, so it stays in the history
+            planner_messages[-1]["content"].append(boxids_and_labels)
+            request_messages = planner_messages
+        else:
+            request_messages = with_screen_state(planner_messages, boxids_and_labels)
+        self.history_token_usage.append(history_tokens(request_messages))
 
         start = time.time()
         if "gpt" in self.model or "o1" in self.model or "o3-mini" in self.model:
             vlm_response, token_usage = run_oai_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
                 max_tokens=self.max_tokens,
                 provider_base_url="https://api.openai.com/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
             print(f"oai token usage: {token_usage}")
@@ -172,7 +242,7 @@ class VLMOrchestratedAgent:
                 self.total_cost += (token_usage * 1.1 / 1000000)  # https://openai.com/api/pricing/
         elif "r1" in self.model:
             vlm_response, token_usage = run_groq_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
@@ -183,12 +253,14 @@ class VLMOrchestratedAgent:
             self.total_cost += (token_usage * 0.99 / 1000000)
         elif "qwen" in self.model:
             vlm_response, token_usage = run_oai_interleaved(
-                messages=planner_messages,
+                messages=request_messages,
                 system=system,
                 model_name=self.model,
                 api_key=self.api_key,
                 max_tokens=min(2048, self.max_tokens),
                 provider_base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
             print(f"qwen token usage: {token_usage}")
@@ -197,6 +269,10 @@ class VLMOrchestratedAgent:
         else:
             raise ValueError(f"Model {self.model} not supported")
         latency_vlm = time.time() - start
+        if ledger_future is not None:
+            # added after this step's screen state, so the next request still shares this one's prefix
+            self._record_ledger(ledger_future.result(), step_message)
+            print(f"ledger: {time.time() - ledger_start:.2f}s, overlapped with parsing and planning")
         
         # Update step counter with both latencies
         self.output_callback(f'<i>Step {self.step_count} | OmniParser: {latency_omniparser:.2f}s | LLM: {latency_vlm:.2f}s</i>', )
@@ -208,27 +284,42 @@ class VLMOrchestratedAgent:
         
         vlm_response_json = extract_data(vlm_response, "json")
         vlm_response_json = json.loads(vlm_response_json)
+        self.recent_actions = (self.recent_actions + [(vlm_response_json.get("Next Action"), vlm_response_json.get("Box ID"), vlm_response_json.get("value"))])[-3:]
 
         img_to_show_base64 = parsed_screen["som_image_base64"]
         if "Box ID" in vlm_response_json:
             try:
-                bbox = parsed_screen["parsed_content_list"][int(vlm_response_json["Box ID"])]["bbox"]
+                box_id = int(vlm_response_json["Box ID"])
+            except (TypeError, ValueError):
+                box_id = None
+            if box_id is None:
+                box_index = None
+            elif self.element_differ is not None:
+                box_index = self.element_differ.index_of(box_id)
+            else:
+                box_index = element_index(parsed_screen["parsed_content_list"], box_id)
+            if box_index is None:
+                # an ID the model made up, or one of an element that is no longer on the screen
+                print(f"Box ID {vlm_response_json['Box ID']} not found on the screen: {vlm_response_json}")
+            else:
+                bbox = parsed_screen["parsed_content_list"][box_index]["bbox"]
                 vlm_response_json["box_centroid_coordinate"] = [int((bbox[0] + bbox[2]) / 2 * screen_width), int((bbox[1] + bbox[3]) / 2 * screen_height)]
-                img_to_show_data = base64.b64decode(img_to_show_base64)
-                img_to_show = Image.open(BytesIO(img_to_show_data))
-
-                draw = ImageDraw.Draw(img_to_show)
-                x, y = vlm_response_json["box_centroid_coordinate"] 
-                radius = 10
-                draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill='red')
-                draw.ellipse((x - radius*3, y - radius*3, x + radius*3, y + radius*3), fill=None, outline='red', width=2)
-
-                buffered = BytesIO()
-                img_to_show.save(buffered, format="PNG")
-                img_to_show_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            except:
-                print(f"Error parsing: {vlm_response_json}")
-                pass
+                self.last_action_point = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+                try:
+                    img_to_show_data = base64.b64decode(img_to_show_base64)
+                    img_to_show = Image.open(BytesIO(img_to_show_data))
+
+                    draw = ImageDraw.Draw(img_to_show)
+                    x, y = vlm_response_json["box_centroid_coordinate"] 
+                    radius = 10
+                    draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill='red')
+                    draw.ellipse((x - radius*3, y - radius*3, x + radius*3, y + radius*3), fill=None, outline='red', width=2)
+
+                    buffered = BytesIO()
+                    img_to_show.save(buffered, format="PNG")
+                    img_to_show_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+                except Exception as e:
+                    print(f"Error marking the target on the screenshot: {e}")
         self.output_callback(f'<img src="data:image/png;base64,{img_to_show_base64}">', )
         
         # Display screen info in a collapsible dropdown
@@ -286,10 +377,54 @@ class VLMOrchestratedAgent:
 
         return response_message, vlm_response_json
 
+    def close(self):
+        """Stop the ledger worker thread when the session ends; a ledger update still running is left to finish."""
+        if self.ledger_pool is not None:
+            self.ledger_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _record_ledger(self, updated_ledger: str, step_message: dict):
+        self.output_callback(
+            f'<details>'
+            f'  <summary><strong>Task Progress Ledger (click to expand)</strong></summary>'
+            f'  <div style="padding: 10px; background-color: #f8f9fa; border-radius: 5px; margin-top: 5px;">'
+            f'    <pre>{updated_ledger}</pre>'
+            f'  </div>'
+            f'</details>',
+        )
+        step_message["content"].append(updated_ledger)
+        self.ledger = updated_ledger
+
+    def _ledger_due(self) -> bool:
+        """Every ledger_every steps, or early when the last two actions repeat or the last ledger saw a loop or no progress."""
+        if self.step_count % self.ledger_every == 0:
+            return True
+        if len(self.recent_actions) >= 2 and self.recent_actions[-1] == self.recent_actions[-2]:
+            return True
+        try:
+            ledger = json.loads(self.ledger)
+            return bool(ledger["is_in_loop"]["answer"]) or not ledger["is_progress_being_made"]["answer"]
+        except (TypeError, ValueError, KeyError):
+            return False
+
+    def _compact_history(self, messages: list):
+        """Fold steps beyond the history window into the action log, keeping the task and plan."""
+        if self.history_compactor is None:
+            return
+        start = next((i for i, message in enumerate(messages) if message is self.plan_message), None)
+        if start is None:
+            return
+        if self.history_compactor.compact(messages, start) and self.element_differ is not None:
+            # the earlier element lists the deltas build on may have been folded away
+            self.element_differ.request_full()
+
     def _api_response_callback(self, response: APIResponse):
         self.api_response_callback(response)
 
-    def _get_system_prompt(self, screen_info: str = ""):
+    def _get_system_prompt(self):
+        if self.element_differ is None:
+            boxes_section = "The list of all detected bounding boxes by IDs on the screen and their description is given at the end of the latest message."
+        else:
+            boxes_section = "The detected bounding boxes by IDs on the screen and their description are given at the end of the latest message, either as a full list or as the changes since the previous step. An ID refers to the same element for as long as it stays on screen."
         main_section = f"""
 You are using a Windows device.
 You are able to use a mouse and keyboard to interact with the computer based on the given task and screenshot.
@@ -298,7 +433,7 @@ You can only interact with the desktop GUI (no terminal or application menu acce
 You may be given some history plan and actions, this is the response from the previous loop.
 You should carefully consider your plan base on the task, screenshot, and history actions.
 
-Here is the list of all detected bounding boxes by IDs on the screen and their description:{screen_info}
+{boxes_section}
 
 Your available "Next Action" only include:
 - type: types a string of text.
@@ -308,7 +443,7 @@ Your available "Next Action" only include:
 - hover: move mouse to box id.
 - scroll_up: scrolls the screen up to view previous content.
 - scroll_down: scrolls the screen down, when the desired button is not visible, or you need to see more content. 
-- wait: waits for 1 second for the device to load or respond.
+- wait: waits until the screen stops changing, for the device to load or respond.
 
 Based on the visual information from the screenshot image and the detected bounding boxes, please determine the next action, the Box ID you should operate on (if action is one of 'type', 'hover', 'scroll_up', 'scroll_down', 'wait', there should be no Box ID field), and the value (if the action is 'type') in order to complete the task.
 
@@ -388,6 +523,8 @@ IMPORTANT NOTES:
                 api_key=self.api_key,
                 max_tokens=self.max_tokens,
                 provider_base_url="https://api.openai.com/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
         plan = extract_data(vlm_response, "json")
@@ -420,6 +557,8 @@ IMPORTANT NOTES:
                 api_key=self.api_key,
                 max_tokens=self.max_tokens,
                 provider_base_url="https://api.openai.com/v1",
+                history_image_quality=self.history_image_quality,
+                history_image_max_side=self.history_image_max_side,
                 temperature=0,
             )
         updated_ledger = extract_data(vlm_response, "json")
@@ -456,7 +595,8 @@ def _maybe_filter_to_n_most_recent_images(
     """
     With the assumption that images are screenshots that are of diminishing value as
     the conversation progresses, remove all but the final `images_to_keep` tool_result
-    images in place
+    images in place. Images are removed in multiples of `min_removal_threshold`, so the
+    history (and the provider's cached prompt prefix) stays unchanged in between.
     """
     if images_to_keep is None:
         return messages
@@ -472,6 +612,7 @@ def _maybe_filter_to_n_most_recent_images(
                         total_images += 1
 
     images_to_remove = total_images - images_to_keep
+    images_to_remove -= images_to_remove % min_removal_threshold
     
     for msg in messages:
         msg_content = msg["content"]
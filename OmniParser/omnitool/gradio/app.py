@@ -5,6 +5,7 @@ python app.py --windows_host_url localhost:8006 --omniparser_server_url localhos
 import os
 from datetime import datetime
 from enum import StrEnum
+from contextlib import aclosing
 from functools import partial
 from pathlib import Path
 from typing import cast
@@ -16,7 +17,9 @@ from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock
 from anthropic.types.tool_use_block import ToolUseBlock
 from loop import (
     APIProvider,
-    sampling_loop_sync,
+    sampling_loop_async,
+    add_agent_arguments,
+    agent_options,
 )
 from tools import ToolResult
 import requests
@@ -36,7 +39,8 @@ def parse_arguments():
 
     parser = argparse.ArgumentParser(description="Gradio App")
     parser.add_argument("--windows_host_url", type=str, default='localhost:8006')
-    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000")
+    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000", help="host:port, or several separated by commas to balance parses over them")
+    add_agent_arguments(parser)
     return parser.parse_args()
 args = parse_arguments()
 
@@ -190,7 +194,9 @@ def valid_params(user_input, state):
     """Validate all requirements and return a list of error messages."""
     errors = []
     
-    for server_name, url in [('Windows Host', 'localhost:5000'), ('OmniParser Server', args.omniparser_server_url)]:
+    # several comma separated parse servers are load balanced, each of them is checked
+    parse_servers = [('OmniParser Server', url.strip()) for url in args.omniparser_server_url.split(',')]
+    for server_name, url in [('Windows Host', 'localhost:5000')] + parse_servers:
         try:
             url = f'http://{url}/probe'
             response = requests.get(url, timeout=3)
@@ -207,7 +213,7 @@ def valid_params(user_input, state):
     
     return errors
 
-def process_input(user_input, state):
+async def process_input(user_input, state):
     # Reset the stop flag
     if state["stop"]:
         state["stop"] = False
@@ -231,8 +237,9 @@ def process_input(user_input, state):
     print("state")
     print(state)
 
-    # Run sampling_loop_sync with the chatbot_output_callback
-    for loop_msg in sampling_loop_sync(
+    # Run sampling_loop_async with the chatbot_output_callback
+    # aclosing: a break closes the loop right away, which waits for its pending UI callbacks and file writes
+    async with aclosing(sampling_loop_async(
         model=state["model"],
         provider=state["provider"],
         messages=state["messages"],
@@ -242,14 +249,16 @@ def process_input(user_input, state):
         api_key=state["api_key"],
         only_n_most_recent_images=state["only_n_most_recent_images"],
         max_tokens=16384,
-        omniparser_url=args.omniparser_server_url
-    ):  
-        if loop_msg is None or state.get("stop"):
-            yield state['chatbot_messages']
-            print("End of task. Close the loop.")
-            break
+        omniparser_url=args.omniparser_server_url,
+        **agent_options(args)
+    )) as loop_messages:
+        async for loop_msg in loop_messages:
+            if loop_msg is None or state.get("stop"):
+                yield state['chatbot_messages']
+                print("End of task. Close the loop.")
+                break
             
-        yield state['chatbot_messages']  # Yield the updated chatbot_messages to update the chatbot UI
+            yield state['chatbot_messages']  # Yield the updated chatbot_messages to update the chatbot UI
 
 def stop_app(state):
     state["stop"] = True
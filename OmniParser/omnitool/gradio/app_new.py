@@ -11,6 +11,7 @@ import shutil
 import mimetypes
 from datetime import datetime
 from enum import StrEnum
+from contextlib import aclosing
 from functools import partial
 from pathlib import Path
 from typing import cast, List, Optional
@@ -22,7 +23,9 @@ from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock
 from anthropic.types.tool_use_block import ToolUseBlock
 from loop import (
     APIProvider,
-    sampling_loop_sync,
+    sampling_loop_async,
+    add_agent_arguments,
+    agent_options,
 )
 from tools import ToolResult
 import requests
@@ -44,8 +47,9 @@ INTRO_TEXT = '''
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Gradio App")
     parser.add_argument("--windows_host_url", type=str, default='localhost:8006')
-    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000")
+    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000", help="host:port, or several separated by commas to balance parses over them")
     parser.add_argument("--run_folder", type=str, default="./tmp/outputs")
+    add_agent_arguments(parser)
     return parser.parse_args()
 args = parse_arguments()
 
@@ -223,7 +227,9 @@ def valid_params(user_input, state):
     """Validate all requirements and return a list of error messages."""
     errors = []
     
-    for server_name, url in [('Windows Host', 'localhost:5000'), ('OmniParser Server', args.omniparser_server_url)]:
+    # several comma separated parse servers are load balanced, each of them is checked
+    parse_servers = [('OmniParser Server', url.strip()) for url in args.omniparser_server_url.split(',')]
+    for server_name, url in [('Windows Host', 'localhost:5000')] + parse_servers:
         try:
             url = f'http://{url}/probe'
             response = requests.get(url, timeout=3)
@@ -240,7 +246,7 @@ def valid_params(user_input, state):
     
     return errors
 
-def process_input(user_input, state):
+async def process_input(user_input, state):
     # Reset the stop flag
     if state["stop"]:
         state["stop"] = False
@@ -264,8 +270,9 @@ def process_input(user_input, state):
     print("state")
     print(state)
 
-    # Run sampling_loop_sync with the chatbot_output_callback
-    for loop_msg in sampling_loop_sync(
+    # Run sampling_loop_async with the chatbot_output_callback
+    # aclosing: a break closes the loop right away, which waits for its pending UI callbacks and file writes
+    async with aclosing(sampling_loop_async(
         model=state["model"],
         provider=state["provider"],
         messages=state["messages"],
@@ -276,16 +283,18 @@ def process_input(user_input, state):
         only_n_most_recent_images=state["only_n_most_recent_images"],
         max_tokens=16384,
         omniparser_url=args.omniparser_server_url,
-        save_folder=str(RUN_FOLDER)
-    ):  
-        if loop_msg is None or state.get("stop"):
-            # Detect and add new files to the state
-            file_choices_update = detect_new_files(state)
-            yield state['chatbot_messages'], file_choices_update
-            print("End of task. Close the loop.")
-            break
+        save_folder=str(RUN_FOLDER),
+        **agent_options(args)
+    )) as loop_messages:
+        async for loop_msg in loop_messages:
+            if loop_msg is None or state.get("stop"):
+                # Detect and add new files to the state
+                file_choices_update = detect_new_files(state)
+                yield state['chatbot_messages'], file_choices_update
+                print("End of task. Close the loop.")
+                break
             
-        yield state['chatbot_messages'], gr.update()  # Yield the updated chatbot_messages to update the chatbot UI
+            yield state['chatbot_messages'], gr.update()  # Yield the updated chatbot_messages to update the chatbot UI
     
     # Final detection of new files
     file_choices_update = detect_new_files(state)
@@ -23,7 +23,10 @@ from requests.exceptions import RequestException
 
 from loop import (
     APIProvider,
-    sampling_loop_sync,
+    sampling_loop_async,
+    add_agent_arguments,
+    agent_options,
+    iterate_async,
 )
 from tools import ToolResult
 
@@ -41,8 +44,9 @@ class Sender(StrEnum):
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Streamlit App")
     parser.add_argument("--windows_host_url", type=str, default='localhost:8006')
-    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000")
+    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000", help="host:port, or several separated by commas to balance parses over them")
     parser.add_argument("--upload_folder", type=str, default="./uploads")
+    add_agent_arguments(parser)
     return parser.parse_known_args()[0]
 
 def initialize_session_state():
@@ -409,8 +413,8 @@ def main():
             # Add user message to state
             st.session_state.messages.append({"role": "user", "content": user_input})
             
-            # Process the message through sampling_loop_sync
-            for loop_msg in sampling_loop_sync(
+            # Process the message through sampling_loop_async, driven from streamlit's synchronous script
+            for loop_msg in iterate_async(sampling_loop_async(
                 model=st.session_state.model,
                 provider=st.session_state.provider,
                 messages=[{"role": "user", "content": [TextBlock(type="text", text=msg["content"])]} for msg in st.session_state.messages],
@@ -421,8 +425,9 @@ def main():
                 only_n_most_recent_images=st.session_state.only_n_most_recent_images,
                 max_tokens=16384,
                 omniparser_url=args.omniparser_server_url,
-                save_folder=str(UPLOAD_FOLDER)
-            ):
+                save_folder=str(UPLOAD_FOLDER),
+                **agent_options(args)
+            )):
                 if loop_msg is None or st.session_state.stop:
                     break
                 st.rerun()
@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of the per-step network overhead of the agent loop: bare requests calls (a new TCP
+connection each) against the shared keep-alive pool in tools/http_pool.py.
+
+A step is modelled as one screenshot GET, `--actions` action POSTs and one parse POST. Without --url a local
+HTTP server with empty responses is started, so only connection and request overhead is measured.
+
+    python benchmark_http.py --steps 200
+    python benchmark_http.py --url http://localhost:5000/probe
+"""
+import argparse
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from tools import http_pool
+
+
+class EmptyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def start_local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EmptyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/probe"
+
+
+def run_steps(get, post, url, steps, actions):
+    timings = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        get(url)
+        for _ in range(actions):
+            post(url, json={"action": "click"})
+        post(url, json={"base64_image": ""})
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:>10}: mean {statistics.mean(timings) * 1000:7.2f} ms/step, p50 {statistics.median(timings) * 1000:7.2f} ms, p95 {p95 * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-step HTTP overhead: bare requests vs pooled session")
+    parser.add_argument("--url", default=None, help="endpoint to hit; starts a local empty server when omitted")
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--actions", type=int, default=3, help="action requests per step")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_local_server()
+    print(f"{args.steps} steps of {args.actions + 2} requests against {url}")
+
+    # warm up both paths once so DNS and imports are not counted
+    run_steps(requests.get, requests.post, url, 1, args.actions)
+    run_steps(http_pool.get, http_pool.post, url, 1, args.actions)
+
+    bare = run_steps(requests.get, requests.post, url, args.steps, args.actions)
+    pooled = run_steps(http_pool.get, http_pool.post, url, args.steps, args.actions)
+    report("bare", bare)
+    report("pooled", pooled)
+    print(f"saved {(statistics.mean(bare) - statistics.mean(pooled)) * 1000:.2f} ms/step")
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Local harness for prompt prefix stability: runs the real VLMAgent / VLMOrchestratedAgent step logic for a
+few synthetic screens with the LLM call stubbed out, captures each planner request exactly as it would be
+sent, and reports how much of every request is a byte-identical prefix of the previous one (what provider
+prompt caching can reuse). Nothing is sent over the network.
+
+    python benchmark_prompt_prefix.py --steps 8
+    python benchmark_prompt_prefix.py --agent orchestrated --only_n_images 2 --image_removal_chunk 4
+    python benchmark_prompt_prefix.py --agent orchestrated --steps 30 --history_window 3
+    python benchmark_prompt_prefix.py --agent orchestrated --llm_latency 0.5 --parallel_ledger
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+import agent.vlm_agent as vlm_agent_module
+import agent.vlm_agent_with_orchestrator as orchestrator_module
+from agent.llm_utils.artifact_store import artifact_store, screenshot_path
+from agent.llm_utils.oaiclient import build_oai_payload
+from agent.llm_utils.omniparserclient import OmniParserClient
+from agent.llm_utils.prompt_layout import prefix_stability_report
+
+STUB_RESPONSE = '```json\n{"Reasoning": "stub", "Next Action": "left_click", "Box ID": 0}\n```'
+
+
+def synthetic_screen(step: int, n_elements: int, client: OmniParserClient):
+    """A parsed screen shaped like the omniparser server response, with a stored screenshot."""
+    rng = random.Random(step)
+    uuid = f"prefixcheck{step:04d}"
+    for som in (False, True):
+        buffer = BytesIO()
+        Image.new("RGB", (320, 200), (rng.randrange(256), rng.randrange(256), rng.randrange(256))).save(buffer, format="PNG")
+        artifact_store.put(screenshot_path(uuid, som=som), buffer.getvalue())
+    # most of the screen stays the same between steps, a few elements are new each step
+    elements = []
+    for i in range(n_elements):
+        source = rng if i >= n_elements - 5 else random.Random(i)
+        x, y = source.random() * 0.9, source.random() * 0.9
+        elements.append({"type": source.choice(["text", "icon"]), "bbox": [x, y, x + 0.05, y + 0.03], "interactivity": True,
+                         "content": f"element {source.randrange(1000)}", "source": "box_ocr_content_ocr"})
+    return client.reformat_messages({
+        "parsed_content_list": elements, "latency": 0.0, "width": 1920, "height": 1080, "screenshot_uuid": uuid,
+        "original_screenshot_base64": artifact_store.get_base64(screenshot_path(uuid)),
+        "som_image_base64": artifact_store.get_base64(screenshot_path(uuid, som=True)),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the cacheable prompt prefix across agent steps")
+    parser.add_argument("--agent", choices=["vlm", "orchestrated"], default="vlm")
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--elements", type=int, default=60, help="screen elements per synthetic step")
+    parser.add_argument("--only_n_images", type=int, default=2)
+    parser.add_argument("--image_removal_chunk", type=int, default=1)
+    parser.add_argument("--element_delta", action="store_true", help="send element deltas between steps")
+    parser.add_argument("--history_window", type=int, default=None, help="orchestrated agent: compact the history beyond this many steps")
+    parser.add_argument("--parallel_ledger", action="store_true", help="orchestrated agent: update the ledger while planning")
+    parser.add_argument("--ledger_every", type=int, default=1, help="orchestrated agent: update the ledger every N steps")
+    parser.add_argument("--llm_latency", type=float, default=0.0, help="seconds every stubbed LLM call takes, for step timings")
+    args = parser.parse_args()
+
+    artifact_store.persist = False
+    requests = []
+
+    def stub_llm(messages, system, model_name, api_key, max_tokens=256, temperature=0, provider_base_url=None, history_image_quality=None, history_image_max_side=None):
+        time.sleep(args.llm_latency)
+        # the orchestrator's plan and ledger calls have no system prompt, only planner requests are measured
+        if system:
+            requests.append(json.dumps(build_oai_payload(messages, system, model_name, max_tokens, history_image_quality, history_image_max_side)))
+        return STUB_RESPONSE, 0
+
+    vlm_agent_module.run_oai_interleaved = stub_llm
+    orchestrator_module.run_oai_interleaved = stub_llm
+
+    common = dict(provider="openai", api_key="", output_callback=lambda *a, **k: None, api_response_callback=lambda *a, **k: None,
+                  only_n_most_recent_images=args.only_n_images, print_usage=False, image_removal_chunk=args.image_removal_chunk,
+                  element_delta=args.element_delta)
+    if args.agent == "vlm":
+        actor = vlm_agent_module.VLMAgent(model="omniparser + gpt-4o", **common)
+    else:
+        actor = orchestrator_module.VLMOrchestratedAgent(model="omniparser + gpt-4o-orchestrated", save_folder=tempfile.mkdtemp(), history_window=args.history_window,
+                                                         parallel_ledger=args.parallel_ledger, ledger_every=args.ledger_every, **common)
+
+    client = OmniParserClient(url="")
+    messages = [{"role": "user", "content": ["Open the settings app and turn on dark mode"]}]
+    step_times = []
+    for step in range(args.steps):
+        screen = synthetic_screen(step, args.elements, client)
+        start = time.time()
+        response, _ = actor(messages=messages, parsed_screen=screen)
+        step_times.append(time.time() - start)
+        # what AnthropicExecutor appends after running the actions
+        messages.append({"role": "assistant", "content": response.content})
+
+    report = prefix_stability_report(requests)
+    for row in report:
+        print(f"step {row['step']:>3}: {row['chars']:>9} chars, stable prefix {row['stable_prefix']:>9} ({row['cacheable_fraction']:.1%})")
+    if len(report) > 1:
+        mean = sum(row["cacheable_fraction"] for row in report[1:]) / (len(report) - 1)
+        print(f"mean cacheable fraction after the first step: {mean:.1%}")
+    if args.llm_latency:
+        print(f"mean agent step time after the first step: {sum(step_times[1:]) / max(len(step_times) - 1, 1):.2f}s")
+    if args.agent == "orchestrated":
+        print("estimated history tokens per step: " + ", ".join(str(tokens) for tokens in actor.history_token_usage))
+    print("estimated element tokens per step: " + ", ".join(str(stats["tokens"]) for stats in actor.element_token_usage))
+
+
+if __name__ == "__main__":
+    main()
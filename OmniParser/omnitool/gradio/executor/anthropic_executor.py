@@ -13,6 +13,8 @@ from anthropic.types.beta import (
 from anthropic.types import TextBlock
 from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock
 from tools import ComputerTool, ToolCollection, ToolResult
+from tools.computer import VM_URL
+from tools.base import ToolError, ToolFailure
 
 
 class AnthropicExecutor:
@@ -20,57 +22,110 @@ class AnthropicExecutor:
         self, 
         output_callback: Callable[[BetaContentBlockParam], None], 
         tool_output_callback: Callable[[Any, str], None],
+        batch_actions: bool = True,
+        vm_url: str = VM_URL,
     ):
+        # with batch_actions, the computer actions of one step go to the VM in a single request
+        self.computer = ComputerTool(batch_actions=batch_actions, vm_url=vm_url)
         self.tool_collection = ToolCollection(
-            ComputerTool()
+            self.computer
         )
         self.output_callback = output_callback
         self.tool_output_callback = tool_output_callback
 
     def __call__(self, response: BetaMessage, messages: list[BetaMessageParam]):
-        new_message = {
-            "role": "assistant",
-            "content": cast(list[BetaContentBlockParam], response.content),
-        }
-        if new_message not in messages:
-            messages.append(new_message)
-        else:
-            print("new_message already in messages, there are duplicates.")
+        self._append_response(response, messages)
         
         tool_result_content: list[BetaToolResultBlockParam] = []
-        for content_block in cast(list[BetaContentBlock], response.content):
-            self.output_callback(content_block, sender="bot")
-            # Execute the tool
-            if content_block.type == "tool_use":
-                # Run the asynchronous tool execution in a synchronous context
-                result = asyncio.run(self.tool_collection.run(
-                    name=content_block.name,
-                    tool_input=cast(dict[str, Any], content_block.input),
-                ))
+        try:
+            for content_block in cast(list[BetaContentBlock], response.content):
+                self.output_callback(content_block, sender="bot")
+                # Execute the tool
+                if content_block.type == "tool_use":
+                    # Run the asynchronous tool execution in a synchronous context
+                    result = asyncio.run(self.tool_collection.run(
+                        name=content_block.name,
+                        tool_input=cast(dict[str, Any], content_block.input),
+                    ))
                 
-                self.output_callback(result, sender="bot")
+                    self.output_callback(result, sender="bot")
                 
-                tool_result_content.append(
-                    _make_api_tool_result(result, content_block.id)
-                )
-                # self.tool_output_callback(result, content_block.id)
+                    tool_result_content.append(
+                        _make_api_tool_result(result, content_block.id)
+                    )
+                    # self.tool_output_callback(result, content_block.id)
 
-            # Craft messages based on the content_block
-            # Note: to display the messages in the gradio, you should organize the messages in the following way (user message, bot message)
+                # Craft messages based on the content_block
+                # Note: to display the messages in the gradio, you should organize the messages in the following way (user message, bot message)
             
-            display_messages = _message_display_callback(messages)
-            # display_messages = []
+                display_messages = _message_display_callback(messages)
+                # display_messages = []
             
-            # Send the messages to the gradio
-            for user_msg, bot_msg in display_messages:
-                # yield [user_msg, bot_msg], tool_result_content
-                yield [None, None], tool_result_content
+                # Send the messages to the gradio
+                for user_msg, bot_msg in display_messages:
+                    # yield [user_msg, bot_msg], tool_result_content
+                    yield [None, None], tool_result_content
+
+            self._flush_step(tool_result_content)
+        finally:
+            # a consumer that stops early (stop button, max_steps) skips _flush_step, its queued actions must not run later
+            self.discard_actions()
 
         if not tool_result_content:
             return messages
         
         return tool_result_content
 
+    async def run_async(self, response: BetaMessage, messages: list[BetaMessageParam]):
+        """
+        Async generator version of __call__ for sampling_loop_async. The tools are awaited on the caller's
+        event loop (ComputerTool does its blocking HTTP in a worker thread), so the loop keeps running the
+        UI callbacks and file writes meanwhile.
+        """
+        self._append_response(response, messages)
+
+        tool_result_content: list[BetaToolResultBlockParam] = []
+        try:
+            for content_block in cast(list[BetaContentBlock], response.content):
+                self.output_callback(content_block, sender="bot")
+                if content_block.type == "tool_use":
+                    result = await self.tool_collection.run(
+                        name=content_block.name,
+                        tool_input=cast(dict[str, Any], content_block.input),
+                    )
+                    self.output_callback(result, sender="bot")
+                    tool_result_content.append(
+                        _make_api_tool_result(result, content_block.id)
+                    )
+                yield [None, None], tool_result_content
+
+            await asyncio.to_thread(self._flush_step, tool_result_content)
+        finally:
+            self.discard_actions()
+
+    def _append_response(self, response: BetaMessage, messages: list[BetaMessageParam]):
+        new_message = {
+            "role": "assistant",
+            "content": cast(list[BetaContentBlockParam], response.content),
+        }
+        if new_message not in messages:
+            messages.append(new_message)
+        else:
+            print("new_message already in messages, there are duplicates.")
+
+    def discard_actions(self):
+        """Drop actions queued by an unfinished step; after _flush_step there are none left."""
+        self.computer.discard_actions()
+
+    def _flush_step(self, tool_result_content: list[BetaToolResultBlockParam]):
+        try:
+            self.computer.flush_actions()
+        except ToolError as e:
+            # the queued actions belong to this step's tool calls, report the failure on the last one
+            self.output_callback(ToolFailure(error=e.message), sender="bot")
+            if tool_result_content:
+                tool_result_content[-1] = _make_api_tool_result(ToolFailure(error=e.message), tool_result_content[-1]["tool_use_id"])
+
 def _message_display_callback(messages):
     display_messages = []
     for msg in messages:
@@ -1,8 +1,10 @@
 """
 Agentic sampling loop that calls the Anthropic API and local implenmentation of anthropic-defined computer use tools.
 """
+import asyncio
 from collections.abc import Callable
 from enum import StrEnum
+from uuid import uuid4
 
 from anthropic import APIResponse
 from anthropic.types import (
@@ -13,9 +15,12 @@ from anthropic.types.beta import (
     BetaMessage,
     BetaMessageParam
 )
-from tools import ToolResult
+from tools import ToolResult, http_pool
+from tools.screen_capture import VM_URL, OUTPUT_DIR, start_frame_stream
 
 from agent.llm_utils.omniparserclient import OmniParserClient
+from agent.llm_utils.artifact_store import artifact_store
+from agent.llm_utils.parser_pool import get_parser_pool
 from agent.anthropic_agent import AnthropicActor
 from agent.vlm_agent import VLMAgent
 from agent.vlm_agent_with_orchestrator import VLMOrchestratedAgent
@@ -37,26 +42,37 @@ PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
     APIProvider.OPENAI: "gpt-4o",
 }
 
-def sampling_loop_sync(
-    *,
-    model: str,
-    provider: APIProvider | None,
-    messages: list[BetaMessageParam],
-    output_callback: Callable[[BetaContentBlock], None],
-    tool_output_callback: Callable[[ToolResult, str], None],
-    api_response_callback: Callable[[APIResponse[BetaMessage]], None],
-    api_key: str,
-    only_n_most_recent_images: int | None = 2,
-    max_tokens: int = 4096,
-    omniparser_url: str,
-    save_folder: str = "./uploads"
-):
-    """
-    Synchronous agentic sampling loop for the assistant/tool interaction of computer use.
-    """
-    print('in sampling_loop_sync, model:', model)
-    omniparser_client = OmniParserClient(url=f"http://{omniparser_url}/parse/")
-    if model == "claude-3-5-sonnet-20241022":
+ANTHROPIC_MODELS = {"claude-3-5-sonnet-20241022"}
+OMNIPARSER_MODELS = {"omniparser + gpt-4o", "omniparser + o1", "omniparser + o3-mini", "omniparser + R1", "omniparser + qwen2.5vl"}
+ORCHESTRATED_MODELS = {"omniparser + gpt-4o-orchestrated", "omniparser + o1-orchestrated", "omniparser + o3-mini-orchestrated", "omniparser + R1-orchestrated", "omniparser + qwen2.5vl-orchestrated"}
+
+# options of the VLM agents that the sampling loops pass through, see VLMAgent and VLMOrchestratedAgent
+AGENT_OPTIONS = (
+    "history_image_quality", "history_image_max_side", "element_token_budget", "element_coordinates", "element_delta",
+    "history_window", "history_compaction_chunk", "history_token_budget", "parallel_ledger", "ledger_every",
+)
+# only VLMOrchestratedAgent takes these
+ORCHESTRATOR_OPTIONS = ("history_window", "history_compaction_chunk", "history_token_budget", "parallel_ledger", "ledger_every")
+
+def add_agent_arguments(parser):
+    """Command line flags for the VLM agents' options, read back as sampling loop kwargs with agent_options(args)."""
+    parser.add_argument("--history_image_quality", type=int, default=None, help="re-encode older screenshots in the conversation as JPEGs of this quality")
+    parser.add_argument("--history_image_max_side", type=int, default=None, help="shrink older screenshots in the conversation to at most this many pixels per side")
+    parser.add_argument("--element_token_budget", type=int, default=None, help="rank the screen elements in the prompt and cut them to about this many tokens")
+    parser.add_argument("--element_coordinates", action="store_true", help="list each screen element with its center point")
+    parser.add_argument("--element_delta", action="store_true", help="keep element IDs stable across steps and send only the screen changes")
+    parser.add_argument("--history_window", type=int, default=None, help="orchestrated agents: fold steps older than this many into a rolling action log")
+    parser.add_argument("--history_compaction_chunk", type=int, default=4, help="orchestrated agents: fold this many steps at a time")
+    parser.add_argument("--history_token_budget", type=int, default=None, help="orchestrated agents: fold further while the history is estimated above this many tokens")
+    parser.add_argument("--parallel_ledger", action="store_true", help="orchestrated agents: update the ledger while the next action is planned")
+    parser.add_argument("--ledger_every", type=int, default=1, help="orchestrated agents: update the ledger every N steps, and whenever a loop is suspected")
+    return parser
+
+def agent_options(args) -> dict:
+    return {name: getattr(args, name) for name in AGENT_OPTIONS}
+
+def _build_actor(model, provider, api_key, api_response_callback, output_callback, max_tokens, only_n_most_recent_images, save_folder, vm_url=VM_URL, output_dir=OUTPUT_DIR, **options):
+    if model in ANTHROPIC_MODELS:
         # Register Actor and Executor
         actor = AnthropicActor(
             model=model, 
@@ -64,9 +80,10 @@ def sampling_loop_sync(
             api_key=api_key, 
             api_response_callback=api_response_callback,
             max_tokens=max_tokens,
-            only_n_most_recent_images=only_n_most_recent_images
+            only_n_most_recent_images=only_n_most_recent_images,
+            vm_url=vm_url
         )
-    elif model in set(["omniparser + gpt-4o", "omniparser + o1", "omniparser + o3-mini", "omniparser + R1", "omniparser + qwen2.5vl"]):
+    elif model in OMNIPARSER_MODELS:
         actor = VLMAgent(
             model=model,
             provider=provider,
@@ -74,9 +91,11 @@ def sampling_loop_sync(
             api_response_callback=api_response_callback,
             output_callback=output_callback,
             max_tokens=max_tokens,
-            only_n_most_recent_images=only_n_most_recent_images
+            only_n_most_recent_images=only_n_most_recent_images,
+            output_dir=output_dir,
+            **{name: value for name, value in options.items() if name not in ORCHESTRATOR_OPTIONS}
         )
-    elif model in set(["omniparser + gpt-4o-orchestrated", "omniparser + o1-orchestrated", "omniparser + o3-mini-orchestrated", "omniparser + R1-orchestrated", "omniparser + qwen2.5vl-orchestrated"]):
+    elif model in ORCHESTRATED_MODELS:
         actor = VLMOrchestratedAgent(
             model=model,
             provider=provider,
@@ -85,43 +104,300 @@ def sampling_loop_sync(
             output_callback=output_callback,
             max_tokens=max_tokens,
             only_n_most_recent_images=only_n_most_recent_images,
-            save_folder=save_folder
+            save_folder=save_folder,
+            output_dir=output_dir,
+            **options
         )
     else:
         raise ValueError(f"Model {model} not supported")
+    return actor
+
+def parse_server_urls(omniparser_url):
+    """Base urls of the parse servers in omniparser_url, one host:port or several separated by commas."""
+    return [f"http://{url.strip()}" for url in omniparser_url.split(",") if url.strip()]
+
+def _omniparser_client(omniparser_url, track_elements, vm_url, output_dir):
+    """Client for one parse server, or for a pool shared by all clients when omniparser_url lists several."""
+    urls = parse_server_urls(omniparser_url)
+    return OmniParserClient(
+        url=f"{urls[0]}/parse/",
+        session_id=uuid4().hex if track_elements else None,
+        vm_url=vm_url,
+        output_dir=output_dir,
+        pool=get_parser_pool(urls) if len(urls) > 1 else None,
+    )
+
+def _speculation_enabled(speculative_parse, model, track_elements):
+    """
+    Speculation only pays off for the orchestrated agents, whose ledger LLM call runs between the actions and
+    the parse they need; the other agents would take the speculation right after starting it. Tracked parses
+    are never speculated, a discarded one would already have advanced the server's element tracker.
+    """
+    if not speculative_parse:
+        return False
+    if track_elements:
+        print("speculative_parse is off, it does not combine with track_elements")
+        return False
+    return model in ORCHESTRATED_MODELS
+
+class _BackgroundCallbacks:
+    """
+    Runs UI callbacks as a task on the event loop, in the order they were made, so the parse, the LLM call
+    and the tools go on while the UI renders. The wrapped callbacks can be called from worker threads.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.task = self.loop.create_task(self._run())
+
+    def wrap(self, callback):
+        def deferred(*args, **kwargs):
+            try:
+                on_loop = asyncio.get_running_loop() is self.loop
+            except RuntimeError:
+                on_loop = False
+            if on_loop:
+                self.queue.put_nowait((callback, args, kwargs))
+            else:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, (callback, args, kwargs))
+        return deferred
+
+    async def _run(self):
+        while True:
+            callback, args, kwargs = await self.queue.get()
+            try:
+                callback(*args, **kwargs)
+            except Exception as e:
+                print(f"output callback failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        """Wait until every callback made so far has run."""
+        await self.queue.join()
+
+    async def aclose(self):
+        await self.drain()
+        self.task.cancel()
+
+
+def _close_session(actor, omniparser_client):
+    """Shut down the worker threads owned by the session's agent and parse client."""
+    close = getattr(actor, "close", None)
+    if close is not None:
+        close()
+    omniparser_client.close()
+
+def _screen_info_message(parsed_screen):
+    screen_info_block = TextBlock(text='Below is the structured accessibility information of the current UI screen, which includes text and icons you can operate on, take these information into account when you are making the prediction for the next action. Note you will still need to take screenshot to get the image: \n' + parsed_screen['screen_info'], type='text')
+    return {"role": "user", "content": [screen_info_block]}
+
+def sampling_loop_sync(
+    *,
+    model: str,
+    provider: APIProvider | None,
+    messages: list[BetaMessageParam],
+    output_callback: Callable[[BetaContentBlock], None],
+    tool_output_callback: Callable[[ToolResult, str], None],
+    api_response_callback: Callable[[APIResponse[BetaMessage]], None],
+    api_key: str,
+    only_n_most_recent_images: int | None = 2,
+    max_tokens: int = 4096,
+    omniparser_url: str,
+    save_folder: str = "./uploads",
+    stream_frames: bool = False,
+    speculative_parse: bool = False,
+    track_elements: bool = False,
+    vm_url: str = VM_URL,
+    output_dir: str = OUTPUT_DIR,
+    history_image_quality: int | None = None,
+    history_image_max_side: int | None = None,
+    element_token_budget: int | None = None,
+    element_coordinates: bool = False,
+    element_delta: bool = False,
+    history_window: int | None = None,
+    history_compaction_chunk: int = 4,
+    history_token_budget: int | None = None,
+    parallel_ledger: bool = False,
+    ledger_every: int = 1,
+):
+    """
+    Synchronous agentic sampling loop for the assistant/tool interaction of computer use.
+    With stream_frames, screenshots come from a background /frames stream of VM screen changes.
+    With speculative_parse, the next screen is captured and parsed in the background as soon as a step's
+    actions have run, and reused if the screen has not changed by the time it is needed (orchestrated models only).
+    With track_elements, the parse server keeps element IDs stable across the session's screens.
+    vm_url and output_dir pick the VM to drive and where screenshots go, so several loops can run side by side.
+    The remaining options go to the VLM agents, see AGENT_OPTIONS; the Anthropic actor ignores them.
+    """
+    print('in sampling_loop_sync, model:', model)
+    if stream_frames:
+        start_frame_stream(vm_url)
+    omniparser_client = _omniparser_client(omniparser_url, track_elements, vm_url, output_dir)
+    actor = _build_actor(
+        model, provider, api_key, api_response_callback, output_callback, max_tokens, only_n_most_recent_images, save_folder, vm_url, output_dir,
+        history_image_quality=history_image_quality,
+        history_image_max_side=history_image_max_side,
+        element_token_budget=element_token_budget,
+        element_coordinates=element_coordinates,
+        element_delta=element_delta,
+        history_window=history_window,
+        history_compaction_chunk=history_compaction_chunk,
+        history_token_budget=history_token_budget,
+        parallel_ledger=parallel_ledger,
+        ledger_every=ledger_every,
+    )
     executor = AnthropicExecutor(
         output_callback=output_callback,
         tool_output_callback=tool_output_callback,
+        vm_url=vm_url,
     )
+    speculative_parse = _speculation_enabled(speculative_parse, model, track_elements)
     print(f"Model Inited: {model}, Provider: {provider}")
     
     tool_result_content = None
     
     print(f"Start the message loop. User messages: {messages}")
     
-    if model == "claude-3-5-sonnet-20241022": # Anthropic loop
-        while True:
-            parsed_screen = omniparser_client() # parsed_screen: {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, "screen_info"}
-            screen_info_block = TextBlock(text='Below is the structured accessibility information of the current UI screen, which includes text and icons you can operate on, take these information into account when you are making the prediction for the next action. Note you will still need to take screenshot to get the image: \n' + parsed_screen['screen_info'], type='text')
-            screen_info_dict = {"role": "user", "content": [screen_info_block]}
-            messages.append(screen_info_dict)
-            tools_use_needed = actor(messages=messages)
+    try:
+        if model in ANTHROPIC_MODELS: # Anthropic loop
+            while True:
+                parsed_screen = omniparser_client() # parsed_screen: {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, "screen_info"}
+                messages.append(_screen_info_message(parsed_screen))
+                tools_use_needed = actor(messages=messages)
 
-            for message, tool_result_content in executor(tools_use_needed, messages):
-                yield message
+                for message, tool_result_content in executor(tools_use_needed, messages):
+                    yield message
         
-            if not tool_result_content:
-                return messages
+                if not tool_result_content:
+                    return messages
 
-            messages.append({"content": tool_result_content, "role": "user"})
+                messages.append({"content": tool_result_content, "role": "user"})
     
-    elif model in set(["omniparser + gpt-4o", "omniparser + o1", "omniparser + o3-mini", "omniparser + R1", "omniparser + qwen2.5vl", "omniparser + gpt-4o-orchestrated", "omniparser + o1-orchestrated", "omniparser + o3-mini-orchestrated", "omniparser + R1-orchestrated", "omniparser + qwen2.5vl-orchestrated"]):
+        elif model in OMNIPARSER_MODELS | ORCHESTRATED_MODELS:
+            while True:
+                # a speculative parse is resolved by the orchestrator after its ledger update
+                parsed_screen = omniparser_client if speculative_parse else omniparser_client()
+                tools_use_needed, vlm_response_json = actor(messages=messages, parsed_screen=parsed_screen)
+
+                for message, tool_result_content in executor(tools_use_needed, messages):
+                    yield message
+        
+                if not tool_result_content:
+                    return messages
+                if speculative_parse:
+                    omniparser_client.speculate()
+    finally:
+        _close_session(actor, omniparser_client)
+
+
+async def sampling_loop_async(
+    *,
+    model: str,
+    provider: APIProvider | None,
+    messages: list[BetaMessageParam],
+    output_callback: Callable[[BetaContentBlock], None],
+    tool_output_callback: Callable[[ToolResult, str], None],
+    api_response_callback: Callable[[APIResponse[BetaMessage]], None],
+    api_key: str,
+    only_n_most_recent_images: int | None = 2,
+    max_tokens: int = 4096,
+    omniparser_url: str,
+    save_folder: str = "./uploads",
+    stream_frames: bool = False,
+    speculative_parse: bool = False,
+    track_elements: bool = False,
+    vm_url: str = VM_URL,
+    output_dir: str = OUTPUT_DIR,
+    history_image_quality: int | None = None,
+    history_image_max_side: int | None = None,
+    element_token_budget: int | None = None,
+    element_coordinates: bool = False,
+    element_delta: bool = False,
+    history_window: int | None = None,
+    history_compaction_chunk: int = 4,
+    history_token_budget: int | None = None,
+    parallel_ledger: bool = False,
+    ledger_every: int = 1,
+):
+    """
+    Asyncio version of sampling_loop_sync, consumed with `async for`. Screenshot capture and parsing are
+    awaited on the shared async HTTP client and the blocking actors run in worker threads. The output
+    callbacks run as a background task and the screenshots are written by the artifact store's writer,
+    both alongside the next parse or LLM call instead of between them.
+    """
+    print('in sampling_loop_async, model:', model)
+    if stream_frames:
+        start_frame_stream(vm_url)
+    callbacks = _BackgroundCallbacks()
+    output_callback = callbacks.wrap(output_callback)
+    api_response_callback = callbacks.wrap(api_response_callback)
+    omniparser_client = _omniparser_client(omniparser_url, track_elements, vm_url, output_dir)
+    actor = _build_actor(
+        model, provider, api_key, api_response_callback, output_callback, max_tokens, only_n_most_recent_images, save_folder, vm_url, output_dir,
+        history_image_quality=history_image_quality,
+        history_image_max_side=history_image_max_side,
+        element_token_budget=element_token_budget,
+        element_coordinates=element_coordinates,
+        element_delta=element_delta,
+        history_window=history_window,
+        history_compaction_chunk=history_compaction_chunk,
+        history_token_budget=history_token_budget,
+        parallel_ledger=parallel_ledger,
+        ledger_every=ledger_every,
+    )
+    executor = AnthropicExecutor(
+        output_callback=output_callback,
+        tool_output_callback=tool_output_callback,
+        vm_url=vm_url,
+    )
+    speculative_parse = _speculation_enabled(speculative_parse, model, track_elements)
+    print(f"Model Inited: {model}, Provider: {provider}")
+    print(f"Start the message loop. User messages: {messages}")
+
+    try:
         while True:
-            parsed_screen = omniparser_client()
-            tools_use_needed, vlm_response_json = actor(messages=messages, parsed_screen=parsed_screen)
+            tool_result_content = None
+            if model in ANTHROPIC_MODELS:
+                parsed_screen = await omniparser_client.parse_async()
+                messages.append(_screen_info_message(parsed_screen))
+                tools_use_needed = await asyncio.to_thread(actor, messages=messages)
+            else:
+                parsed_screen = omniparser_client if speculative_parse else await omniparser_client.parse_async()
+                tools_use_needed, vlm_response_json = await asyncio.to_thread(actor, messages=messages, parsed_screen=parsed_screen)
 
-            for message, tool_result_content in executor(tools_use_needed, messages):
+            async for message, tool_result_content in executor.run_async(tools_use_needed, messages):
+                # the UI reads its state on every yield, so it shows what the callbacks rendered so far
+                await callbacks.drain()
                 yield message
-        
+
             if not tool_result_content:
-                return messages
\ No newline at end of file
+                return
+            if speculative_parse:
+                omniparser_client.speculate()
+
+            if model in ANTHROPIC_MODELS:
+                messages.append({"content": tool_result_content, "role": "user"})
+    finally:
+        _close_session(actor, omniparser_client)
+        await callbacks.aclose()
+        # the run's screenshots are on disk once the loop is done
+        await asyncio.to_thread(artifact_store.flush)
+
+
+def iterate_async(agen):
+    """Drive an async generator such as sampling_loop_async from synchronous code (e.g. streamlit)."""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+        # the loop's pooled connections can't be used by the next run's loop
+        loop.run_until_complete(http_pool.aclose_async_client())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
@@ -0,0 +1,205 @@
+"""
+Runs many agent sessions concurrently, each against its own VM and all sharing one OmniParser server.
+Every session gets its own output folder (screenshots, orchestrator trajectory, session.json), a VM is
+used by one session at a time, and at most --max_concurrent sessions run at once. At the end the
+throughput over the whole run (tasks/hour, actions/sec) is printed and written to summary.json.
+
+    python session_runner.py --tasks tasks.txt --vm_urls http://10.0.0.5:5000 http://10.0.0.6:5000 \
+        --omniparser_server_url 10.0.0.2:8000 --model "omniparser + gpt-4o" --max_steps 20
+
+Several comma separated parse servers are load balanced by one ParserPool shared by all sessions.
+tasks.txt holds one task per line; with --repeat every task is run that many times. Offline, the fake VMs
+and the mock LLM provider in omnitool/loadtest stand in for real desktops and providers.
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from anthropic.types import TextBlock
+
+from loop import APIProvider, sampling_loop_sync, parse_server_urls, add_agent_arguments, agent_options
+from tools import ToolResult, http_pool
+from agent.llm_utils.artifact_store import artifact_store
+from agent.llm_utils.parser_pool import get_parser_pool
+
+# screenshots kept in memory per running session, the store is shared by all sessions
+ARTIFACTS_PER_SESSION = 64
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class SessionManager:
+    """
+    Runs tasks on a pool of VMs. A session takes a free VM, runs the sampling loop until the agent stops or
+    max_steps actions were executed, and gives the VM back. loop_kwargs go to sampling_loop_sync as is.
+    """
+
+    def __init__(self, vm_urls: list, omniparser_url: str, model: str, provider: str, api_key: str,
+                 output_root: str = "./tmp/sessions", max_concurrent: int | None = None, max_steps: int = 20, **loop_kwargs):
+        if not vm_urls:
+            raise ValueError("at least one VM url is needed")
+        self.vm_urls = list(vm_urls)
+        self.omniparser_url = omniparser_url
+        self.model = model
+        self.provider = provider
+        self.api_key = api_key
+        self.output_root = output_root
+        # more sessions than VMs would only wait for a free VM
+        self.max_concurrent = min(max_concurrent or len(self.vm_urls), len(self.vm_urls))
+        self.max_steps = max_steps
+        self.loop_kwargs = loop_kwargs
+        self.free_vms = queue.Queue()
+        for vm_url in self.vm_urls:
+            self.free_vms.put(vm_url)
+        self.results = []
+        self.lock = threading.Lock()
+
+    def run(self, tasks: list) -> dict:
+        """Run every task and return the throughput summary, also written to output_root/summary.json."""
+        os.makedirs(self.output_root, exist_ok=True)
+        # every session keeps connections to its VM, the parse server and the LLM open at the same time
+        if http_pool.HTTP_CONFIG["pool_size"] < 2 * self.max_concurrent:
+            http_pool.configure_http(pool_size=2 * self.max_concurrent)
+        artifact_store.max_items = max(artifact_store.max_items, ARTIFACTS_PER_SESSION * self.max_concurrent)
+        print(f"running {len(tasks)} tasks on {len(self.vm_urls)} VMs, {self.max_concurrent} at a time")
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="session") as pool:
+            futures = [pool.submit(self._run_session, index, task) for index, task in enumerate(tasks)]
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                print(f"[{done}/{len(tasks)}] session {result['session']} on {result['vm_url']}: {result['status']}, "
+                      f"{result['steps']} actions in {result['duration']:.1f}s")
+        summary = self.summarize(time.time() - start)
+        urls = parse_server_urls(self.omniparser_url)
+        if len(urls) > 1:
+            summary["parse_servers"] = get_parser_pool(urls).summary()
+            print(f"parse servers: {summary['parse_servers']}")
+        with open(os.path.join(self.output_root, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def _run_session(self, index: int, task: str) -> dict:
+        vm_url = self.free_vms.get()
+        try:
+            return self.run_session(index, task, vm_url)
+        finally:
+            self.free_vms.put(vm_url)
+
+    def run_session(self, index: int, task: str, vm_url: str) -> dict:
+        """One task on one VM; the result is kept for the summary and written to the session's folder."""
+        session_dir = os.path.join(self.output_root, f"session_{index:04d}")
+        os.makedirs(session_dir, exist_ok=True)
+        result = {"session": index, "task": task, "vm_url": vm_url, "output_dir": session_dir, "steps": 0, "error": None}
+        messages = [{"role": "user", "content": [TextBlock(type="text", text=task)]}]
+
+        def output_callback(message, sender="bot"):
+            # every executed tool call is reported with its ToolResult
+            if isinstance(message, ToolResult):
+                result["steps"] += 1
+
+        start = time.time()
+        status = "done"
+        loop = sampling_loop_sync(
+            model=self.model,
+            provider=self.provider,
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=lambda *args, **kwargs: None,
+            api_response_callback=lambda *args, **kwargs: None,
+            api_key=self.api_key,
+            omniparser_url=self.omniparser_url,
+            save_folder=session_dir,
+            vm_url=vm_url,
+            output_dir=session_dir,
+            **self.loop_kwargs,
+        )
+        try:
+            for _ in loop:
+                if result["steps"] >= self.max_steps:
+                    status = "max_steps"
+                    break
+        except Exception as e:
+            status, result["error"] = "error", f"{type(e).__name__}: {e}"
+            print(f"session {index} failed: {result['error']}")
+        finally:
+            loop.close()
+        result["status"] = status
+        result["duration"] = time.time() - start
+        with open(os.path.join(session_dir, "session.json"), "w") as f:
+            json.dump(result, f, indent=2)
+        with self.lock:
+            self.results.append(result)
+        return result
+
+    def summarize(self, wall_time: float) -> dict:
+        """Aggregate throughput of the finished sessions over the wall time of the run."""
+        with self.lock:
+            results = list(self.results)
+        durations = [r["duration"] for r in results]
+        steps = sum(r["steps"] for r in results)
+        by_status = {}
+        for r in results:
+            by_status[r["status"]] = by_status.get(r["status"], 0) + 1
+        per_vm = {vm_url: sum(1 for r in results if r["vm_url"] == vm_url) for vm_url in self.vm_urls}
+        summary = {
+            "tasks": len(results),
+            "status": by_status,
+            "wall_time": wall_time,
+            "max_concurrent": self.max_concurrent,
+            "tasks_per_hour": len(results) / wall_time * 3600 if wall_time else 0.0,
+            "actions": steps,
+            "actions_per_sec": steps / wall_time if wall_time else 0.0,
+            "session_duration": {"mean": sum(durations) / len(durations) if durations else 0.0,
+                                 "p50": percentile(durations, 0.5), "p95": percentile(durations, 0.95)},
+            "tasks_per_vm": per_vm,
+        }
+        print(f"{summary['tasks']} tasks in {wall_time:.1f}s ({by_status}): {summary['tasks_per_hour']:.1f} tasks/hour, "
+              f"{summary['actions_per_sec']:.2f} actions/s, session p50 {summary['session_duration']['p50']:.1f}s "
+              f"p95 {summary['session_duration']['p95']:.1f}s")
+        return summary
+
+
+def load_tasks(path: str, repeat: int = 1) -> list:
+    with open(path) as f:
+        tasks = [line.strip() for line in f if line.strip()]
+    return [task for task in tasks for _ in range(repeat)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run agent sessions concurrently against several VMs")
+    parser.add_argument("--tasks", type=str, required=True, help="text file with one task per line")
+    parser.add_argument("--repeat", type=int, default=1, help="run every task this many times")
+    parser.add_argument("--vm_urls", type=str, nargs="+", default=["http://localhost:5000"])
+    parser.add_argument("--omniparser_server_url", type=str, default="localhost:8000", help="host:port, or several separated by commas")
+    parser.add_argument("--model", type=str, default="omniparser + gpt-4o")
+    parser.add_argument("--provider", type=str, default=APIProvider.OPENAI.value)
+    parser.add_argument("--api_key", type=str, default=os.environ.get("OPENAI_API_KEY", ""))
+    parser.add_argument("--max_concurrent", type=int, default=None, help="sessions at a time, one per VM if omitted")
+    parser.add_argument("--max_steps", type=int, default=20, help="actions before a session is stopped")
+    parser.add_argument("--output_root", type=str, default="./tmp/sessions")
+    parser.add_argument("--only_n_most_recent_images", type=int, default=2)
+    parser.add_argument("--track_elements", action="store_true", help="stable element IDs from the parse server")
+    parser.add_argument("--speculative_parse", action="store_true")
+    add_agent_arguments(parser)
+    args = parser.parse_args()
+
+    manager = SessionManager(
+        args.vm_urls, args.omniparser_server_url, args.model, args.provider, args.api_key,
+        output_root=args.output_root, max_concurrent=args.max_concurrent, max_steps=args.max_steps,
+        only_n_most_recent_images=args.only_n_most_recent_images, track_elements=args.track_elements,
+        speculative_parse=args.speculative_parse, **agent_options(args),
+    )
+    manager.run(load_tasks(args.tasks, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import time
 from enum import StrEnum
@@ -8,11 +9,12 @@ from PIL import Image
 from anthropic.types.beta import BetaToolComputerUse20241022Param
 
 from .base import BaseAnthropicTool, ToolError, ToolResult
-from .screen_capture import get_screenshot
+from .screen_capture import fetch_screenshot, wait_for_screen_stable, require_newer_frame
+from . import http_pool
 import requests
-import re
 
 OUTPUT_DIR = "./tmp/outputs"
+VM_URL = "http://localhost:5000"
 
 TYPING_DELAY_MS = 12
 TYPING_GROUP_SIZE = 50
@@ -88,14 +90,19 @@ class ComputerTool(BaseAnthropicTool):
     def to_params(self) -> BetaToolComputerUse20241022Param:
         return {"name": self.name, "type": self.api_type, **self.options}
 
-    def __init__(self, is_scaling: bool = False):
+    def __init__(self, is_scaling: bool = False, batch_actions: bool = False, vm_url: str = VM_URL):
         super().__init__()
+        # every request of this tool goes to this VM, so tools for different VMs can run side by side
+        self.vm_url = vm_url
 
         # Get screen width and height using Windows command
         self.display_num = None
         self.offset_x = 0
         self.offset_y = 0
         self.is_scaling = is_scaling
+        # when batching, actions without a result are queued and sent together by flush_actions()
+        self.batch_actions = batch_actions
+        self.pending_actions = []
         self.width, self.height = self.get_screen_size()
         print(f"screen size: {self.width}, {self.height}")
 
@@ -105,7 +112,11 @@ class ComputerTool(BaseAnthropicTool):
                                "Escape": "esc"}
 
 
-    async def __call__(
+    async def __call__(self, **kwargs):
+        # every action blocks on HTTP to the VM, so it runs in a worker thread and the caller's event loop stays free
+        return await asyncio.to_thread(self.execute, **kwargs)
+
+    def execute(
         self,
         *,
         action: Action,
@@ -141,11 +152,12 @@ class ComputerTool(BaseAnthropicTool):
             print(f"mouse move to {x}, {y}")
             
             if action == "mouse_move":
-                self.send_to_vm(f"pyautogui.moveTo({x}, {y})")
+                self.send_action("move", x=x, y=y)
                 return ToolResult(output=f"Moved mouse to ({x}, {y})")
             elif action == "left_click_drag":
-                current_x, current_y = self.send_to_vm("pyautogui.position()")
-                self.send_to_vm(f"pyautogui.dragTo({x}, {y}, duration=0.5)")
+                position = self.send_action("position")
+                current_x, current_y = position["x"], position["y"]
+                self.send_action("drag", x=x, y=y, duration=0.5)
                 return ToolResult(output=f"Dragged mouse from ({current_x}, {current_y}) to ({x}, {y})")
 
         if action in ("key", "type"):
@@ -157,24 +169,17 @@ class ComputerTool(BaseAnthropicTool):
                 raise ToolError(output=f"{text} must be a string")
 
             if action == "key":
-                # Handle key combinations
-                keys = text.split('+')
-                for key in keys:
-                    key = self.key_conversion.get(key.strip(), key.strip())
-                    key = key.lower()
-                    self.send_to_vm(f"pyautogui.keyDown('{key}')")  # Press down each key
-                for key in reversed(keys):
-                    key = self.key_conversion.get(key.strip(), key.strip())
-                    key = key.lower()
-                    self.send_to_vm(f"pyautogui.keyUp('{key}')")    # Release each key in reverse order
+                # Handle key combinations, the server presses them in order and releases in reverse
+                keys = [self.key_conversion.get(key.strip(), key.strip()).lower() for key in text.split('+')]
+                self.send_action("keys", keys=keys)
                 return ToolResult(output=f"Pressed keys: {text}")
             
             elif action == "type":
                 # default click before type TODO: check if this is needed
-                self.send_to_vm("pyautogui.click()")
-                self.send_to_vm(f"pyautogui.typewrite('{text}', interval={TYPING_DELAY_MS / 1000})")
-                self.send_to_vm("pyautogui.press('enter')")
-                screenshot_base64 = (await self.screenshot()).base64_image
+                self.send_action("click")
+                self.send_action("type", text=text, interval=TYPING_DELAY_MS / 1000)
+                self.send_action("keys", keys=["enter"])
+                screenshot_base64 = self.screenshot().base64_image
                 return ToolResult(output=text, base64_image=screenshot_base64)
 
         if action in (
@@ -192,78 +197,104 @@ class ComputerTool(BaseAnthropicTool):
                 raise ToolError(f"coordinate is not accepted for {action}")
 
             if action == "screenshot":
-                return await self.screenshot()
+                return self.screenshot()
             elif action == "cursor_position":
-                x, y = self.send_to_vm("pyautogui.position()")
-                x, y = self.scale_coordinates(ScalingSource.COMPUTER, x, y)
+                position = self.send_action("position")
+                x, y = self.scale_coordinates(ScalingSource.COMPUTER, position["x"], position["y"])
                 return ToolResult(output=f"X={x},Y={y}")
             else:
                 if action == "left_click":
-                    self.send_to_vm("pyautogui.click()")
+                    self.send_action("click")
                 elif action == "right_click":
-                    self.send_to_vm("pyautogui.rightClick()")
+                    self.send_action("click", button="right")
                 elif action == "middle_click":
-                    self.send_to_vm("pyautogui.middleClick()")
+                    self.send_action("click", button="middle")
                 elif action == "double_click":
-                    self.send_to_vm("pyautogui.doubleClick()")
+                    self.send_action("click", clicks=2)
                 elif action == "left_press":
-                    self.send_to_vm("pyautogui.mouseDown()")
+                    self.send_action("mouse_down")
+                    # a batch runs back to back on the VM, so the press is sent before the hold starts
+                    self.flush_actions()
                     time.sleep(1)
-                    self.send_to_vm("pyautogui.mouseUp()")
+                    self.send_action("mouse_up")
                 return ToolResult(output=f"Performed {action}")
         if action in ("scroll_up", "scroll_down"):
             if action == "scroll_up":
-                self.send_to_vm("pyautogui.scroll(100)")
+                self.send_action("scroll", amount=100)
             elif action == "scroll_down":
-                self.send_to_vm("pyautogui.scroll(-100)")
+                self.send_action("scroll", amount=-100)
             return ToolResult(output=f"Performed {action}")
         if action == "hover":
             return ToolResult(output=f"Performed {action}")
         if action == "wait":
-            time.sleep(1)
+            self.flush_actions()
+            wait_for_screen_stable(timeout=5.0, vm_url=self.vm_url)
             return ToolResult(output=f"Performed {action}")
         raise ToolError(f"Invalid action: {action}")
 
-    def send_to_vm(self, action: str):
+    def send_action(self, action: str, **params):
         """
-        Executes a python command on the server. Only return tuple of x,y when action is "pyautogui.position()"
+        Executes a typed action (see ACTION_SCHEMA in the VM server) inside the VM server process and returns its result dict.
+        The server only responds once the action has finished, so no settle delay is needed here.
+        In batch mode actions that return nothing are queued instead; queries flush the queue first.
         """
-        prefix = "import pyautogui; pyautogui.FAILSAFE = False;"
-        command_list = ["python", "-c", f"{prefix} {action}"]
-        parse = action == "pyautogui.position()"
-        if parse:
-            command_list[-1] = f"{prefix} print({action})"
-
+        if action in ("position", "size"):
+            self.flush_actions()
+        elif self.batch_actions:
+            self.pending_actions.append({"action": action, **params})
+            return {}
         try:
-            print(f"sending to vm: {command_list}")
-            response = requests.post(
-                f"http://localhost:5000/execute", 
-                headers={'Content-Type': 'application/json'},
-                json={"command": command_list},
+            print(f"sending to vm: {action} {params}")
+            response = http_pool.post(
+                f"{self.vm_url}/action",
+                json={"action": action, **params},
                 timeout=90
             )
-            time.sleep(0.7) # avoid async error as actions take time to complete
-            print(f"action executed")
             if response.status_code != 200:
-                raise ToolError(f"Failed to execute command. Status code: {response.status_code}")
-            if parse:
-                output = response.json()['output'].strip()
-                match = re.search(r'Point\(x=(\d+),\s*y=(\d+)\)', output)
-                if not match:
-                    raise ToolError(f"Could not parse coordinates from output: {output}")
-                x, y = map(int, match.groups())
-                return x, y
+                raise ToolError(f"Failed to execute {action}. Status code: {response.status_code}, {response.text}")
+            require_newer_frame(response.json().get('frame_grab'), self.vm_url)
+            return response.json()['result']
         except requests.exceptions.RequestException as e:
-            raise ToolError(f"An error occurred while trying to execute the command: {str(e)}")
+            raise ToolError(f"An error occurred while trying to execute {action}: {str(e)}")
 
-    async def screenshot(self):
+    def flush_actions(self):
+        """Send all queued actions to the VM in a single request and return the per-action results."""
+        if not self.pending_actions:
+            return []
+        actions, self.pending_actions = self.pending_actions, []
+        try:
+            response = http_pool.post(f"{self.vm_url}/actions", json={"actions": actions}, timeout=90)
+        except requests.exceptions.RequestException as e:
+            raise ToolError(f"An error occurred while trying to execute {len(actions)} actions: {str(e)}")
+        if response.status_code != 200:
+            raise ToolError(f"Failed to execute actions. Status code: {response.status_code}, {response.text}")
+        results = response.json()["results"]
+        require_newer_frame(response.json().get("frame_grab"), self.vm_url)
+        print("actions executed: " + ", ".join(f"{r['action']} {r['elapsed'] * 1000:.0f}ms" for r in results))
+        failed = [r for r in results if r["status"] != "success"]
+        if failed:
+            raise ToolError(f"Action {failed[0]['action']} failed: {failed[0]['message']}")
+        if len(results) < len(actions):
+            raise ToolError(f"Only {len(results)} of {len(actions)} actions were executed")
+        return results
+
+    def discard_actions(self):
+        """Drop queued actions without running them, e.g. when the agent was stopped in the middle of a step."""
+        if self.pending_actions:
+            print(f"discarding {len(self.pending_actions)} queued actions")
+            self.pending_actions = []
+
+    def screenshot(self):
+        self.flush_actions()
         if not hasattr(self, 'target_dimension'):
             screenshot = self.padding_image(screenshot)
             self.target_dimension = MAX_SCALING_TARGETS["WXGA"]
         width, height = self.target_dimension["width"], self.target_dimension["height"]
-        screenshot, path = get_screenshot(resize=True, target_width=width, target_height=height)
-        time.sleep(0.7) # avoid async error as actions take time to complete
-        return ToolResult(base64_image=base64.b64encode(path.read_bytes()).decode())
+        # the VM resizes and png-encodes, so the bytes go straight into the tool result without touching disk
+        # capture once the UI has settled after the last action rather than after a fixed delay
+        wait_for_screen_stable(vm_url=self.vm_url)
+        data, _ = fetch_screenshot(format="png", width=width, height=height, vm_url=self.vm_url)
+        return ToolResult(base64_image=base64.b64encode(data).decode())
 
     def padding_image(self, screenshot):
         """Pad the screenshot to 16:10 aspect ratio, when the aspect ratio is not 16:10."""
@@ -309,21 +340,5 @@ class ComputerTool(BaseAnthropicTool):
 
     def get_screen_size(self):
         """Return width and height of the screen"""
-        try:
-            response = requests.post(
-                f"http://localhost:5000/execute",
-                headers={'Content-Type': 'application/json'},
-                json={"command": ["python", "-c", "import pyautogui; print(pyautogui.size())"]},
-                timeout=90
-            )
-            if response.status_code != 200:
-                raise ToolError(f"Failed to get screen size. Status code: {response.status_code}")
-            
-            output = response.json()['output'].strip()
-            match = re.search(r'Size\(width=(\d+),\s*height=(\d+)\)', output)
-            if not match:
-                raise ToolError(f"Could not parse screen size from output: {output}")
-            width, height = map(int, match.groups())
-            return width, height
-        except requests.exceptions.RequestException as e:
-            raise ToolError(f"An error occurred while trying to get screen size: {str(e)}")
\ No newline at end of file
+        size = self.send_action("size")
+        return size["width"], size["height"]
@@ -0,0 +1,111 @@
+"""
+Shared keep-alive HTTP clients for the agent stack (VM server, omniparser server, LLM endpoints).
+
+Every call goes through one pooled requests.Session (or one httpx.AsyncClient per event loop for async
+code), so a step reuses its TCP connections instead of opening a new one per screenshot, action and parse.
+"""
+import asyncio
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_CONFIG = {
+    "pool_size": 16,          # connections kept alive per host
+    "connect_timeout": 5.0,
+    "read_timeout": 120.0,
+    "llm_read_timeout": None,  # LLM completions (o1, R1) can think for minutes, None waits for them
+    "retries": 2,             # connection errors on any method; 502/503/504 only on GET
+    "backoff_factor": 0.2,
+}
+
+_session = None
+# httpx connections belong to the event loop that opened them, so every loop gets its own client
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def configure_http(**config):
+    """Update HTTP_CONFIG; the clients are rebuilt on their next use."""
+    global _session
+    unknown = set(config) - set(HTTP_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown http config keys: {sorted(unknown)}")
+    with _lock:
+        HTTP_CONFIG.update(config)
+        if _session is not None:
+            _session.close()
+        _session = None
+        # the old async clients may still be in use by running loops, let them be garbage collected there
+        _async_clients.clear()
+
+
+def default_timeout():
+    return (HTTP_CONFIG["connect_timeout"], HTTP_CONFIG["read_timeout"])
+
+
+def llm_timeout():
+    """(connect, read) timeout for LLM completion requests, separate from the VM and parse timeouts."""
+    return (HTTP_CONFIG["connect_timeout"], HTTP_CONFIG["llm_read_timeout"])
+
+
+def get_session() -> requests.Session:
+    """The shared pooled session. Actions are POSTs, so read errors are never retried to avoid running them twice."""
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                total=HTTP_CONFIG["retries"],
+                connect=HTTP_CONFIG["retries"],
+                read=0,
+                status=HTTP_CONFIG["retries"],
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(["GET", "HEAD"]),
+                backoff_factor=HTTP_CONFIG["backoff_factor"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_CONFIG["pool_size"], max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Session request with the configured (connect, read) timeout unless one is given."""
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get_async_client():
+    """The running event loop's httpx.AsyncClient, with the same pool size, timeouts and connection retries."""
+    import httpx
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=HTTP_CONFIG["pool_size"], max_keepalive_connections=HTTP_CONFIG["pool_size"]),
+                timeout=httpx.Timeout(HTTP_CONFIG["read_timeout"], connect=HTTP_CONFIG["connect_timeout"]),
+                transport=httpx.AsyncHTTPTransport(retries=HTTP_CONFIG["retries"]),
+            )
+            _async_clients[loop] = client
+        return client
+
+
+async def aclose_async_client():
+    """Close the running loop's client, call it before closing a loop that used get_async_client()."""
+    with _lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
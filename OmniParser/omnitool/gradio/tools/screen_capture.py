@@ -1,29 +1,261 @@
 from pathlib import Path
 from uuid import uuid4
+import time
+import asyncio
+import base64
+import threading
 import requests
 from PIL import Image
 from .base import BaseAnthropicTool, ToolError
+from . import http_pool
 from io import BytesIO
 
 OUTPUT_DIR = "./tmp/outputs"
+VM_URL = "http://localhost:5000"
 
-def get_screenshot(resize: bool = False, target_width: int = 1920, target_height: int = 1080):
-    """Capture screenshot by requesting from HTTP endpoint - returns native resolution unless resized"""
-    output_dir = Path(OUTPUT_DIR)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    path = output_dir / f"screenshot_{uuid4().hex}.png"
-    
+def _screenshot_params(format, width, height, region, quality, compress_level, fingerprint=False):
+    params = {"format": format}
+    if fingerprint:
+        params["fingerprint"] = 1
+    if width and height:
+        params["width"], params["height"] = width, height
+    if region:
+        params["region"] = ",".join(str(v) for v in region)
+    if quality is not None:
+        params["quality"] = quality
+    if compress_level is not None:
+        params["compress_level"] = compress_level
+    return params
+
+def fetch_screenshot(format: str = "png", width: int | None = None, height: int | None = None, region: tuple[int, int, int, int] | None = None, quality: int | None = None, compress_level: int | None = None, fingerprint: bool = False, vm_url: str = VM_URL):
+    """
+    Request an encoded screenshot from the VM, resized/cropped there. Returns (bytes, params) without decoding it.
+    With fingerprint, params["fingerprint"] is the VM's fingerprint of this very frame (None from older VM servers).
+    """
+    params = _screenshot_params(format, width, height, region, quality, compress_level, fingerprint)
+    try:
+        response = http_pool.get(f'{vm_url}/screenshot', params=params)
+    except requests.exceptions.RequestException as e:
+        raise ToolError(f"Failed to capture screenshot: {str(e)}")
+    if response.status_code != 200:
+        raise ToolError(f"Failed to capture screenshot: HTTP {response.status_code}")
+    if format == "raw":
+        params["width"], params["height"] = int(response.headers["X-Width"]), int(response.headers["X-Height"])
+    if fingerprint:
+        params["fingerprint"] = response.headers.get("X-Fingerprint")
+    return response.content, params
+
+async def fetch_screenshot_async(format: str = "png", width: int | None = None, height: int | None = None, region: tuple[int, int, int, int] | None = None, quality: int | None = None, compress_level: int | None = None, vm_url: str = VM_URL):
+    """Awaitable fetch_screenshot on the shared async client."""
+    import httpx
+    params = _screenshot_params(format, width, height, region, quality, compress_level)
+    try:
+        response = await http_pool.get_async_client().get(f'{vm_url}/screenshot', params=params)
+    except httpx.HTTPError as e:
+        raise ToolError(f"Failed to capture screenshot: {str(e)}")
+    if response.status_code != 200:
+        raise ToolError(f"Failed to capture screenshot: HTTP {response.status_code}")
+    if format == "raw":
+        params["width"], params["height"] = int(response.headers["X-Width"]), int(response.headers["X-Height"])
+    return response.content, params
+
+def wait_for_screen_stable(timeout: float = 3.0, interval: float = 0.15, threshold: float = 1.0, stable_frames: int = 2, vm_url: str = VM_URL):
+    """Block until the VM screen stops changing (or timeout), instead of sleeping a fixed worst-case delay."""
+    try:
+        response = http_pool.post(f'{vm_url}/wait_stable', json={"timeout": timeout, "interval": interval, "threshold": threshold, "stable_frames": stable_frames}, timeout=timeout + 10)
+        if response.status_code == 200:
+            result = response.json()
+            require_newer_frame(result.get("frame_grab"), vm_url)
+            return result
+        print(f"wait_stable failed: HTTP {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        print(f"wait_stable failed: {e}")
+    # older VM servers have no /wait_stable, fall back to the previous fixed delay
+    time.sleep(min(timeout, 0.7))
+    return {"stable": False, "elapsed": min(timeout, 0.7)}
+
+async def wait_for_screen_stable_async(timeout: float = 3.0, interval: float = 0.15, threshold: float = 1.0, stable_frames: int = 2, vm_url: str = VM_URL):
+    """Awaitable wait_for_screen_stable; other tasks keep running while the VM watches the screen."""
+    import httpx
     try:
-        response = requests.get('http://localhost:5000/screenshot')
+        response = await http_pool.get_async_client().post(f'{vm_url}/wait_stable', json={"timeout": timeout, "interval": interval, "threshold": threshold, "stable_frames": stable_frames}, timeout=timeout + 10)
+        if response.status_code == 200:
+            result = response.json()
+            require_newer_frame(result.get("frame_grab"), vm_url)
+            return result
+        print(f"wait_stable failed: HTTP {response.status_code}")
+    except httpx.HTTPError as e:
+        print(f"wait_stable failed: {e}")
+    await asyncio.sleep(min(timeout, 0.7))
+    return {"stable": False, "elapsed": min(timeout, 0.7)}
+
+def screen_fingerprint(vm_url: str = VM_URL):
+    """
+    The VM's fingerprint of the current screen, comparable with fetch_screenshot(fingerprint=True). The VM
+    hashes the grab without the cursor and with the text caret blanked, so neither makes it change.
+    """
+    try:
+        response = http_pool.get(f'{vm_url}/fingerprint')
+    except requests.exceptions.RequestException as e:
+        raise ToolError(f"Failed to fingerprint the screen: {str(e)}")
+    if response.status_code != 200:
+        raise ToolError(f"Failed to fingerprint the screen: HTTP {response.status_code}")
+    return response.json()["fingerprint"]
+
+class FrameBuffer:
+    """
+    Holds the latest VM frame, kept current by long-polling /frames in a background thread.
+    Only the changed tiles cross the wire after the first keyframe, and latest() never waits on the VM
+    unless the frame it holds predates the last action or wait_stable (see require_after).
+    """
+
+    def __init__(self, poll_timeout: float = 10.0, format: str = "png", vm_url: str = VM_URL):
+        self.vm_url = vm_url
+        self.poll_timeout = poll_timeout
+        self.format = format
+        self.frame = None
+        self.seq = 0
+        # the VM grab the frame is current as of, and the grab latest() has to get past
+        self.grab = 0
+        self.required_grab = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def require_after(self, grab: int):
+        """Frames from VM grabs up to `grab` (the frame_grab of an action or wait_stable response) are stale."""
+        with self.lock:
+            self.required_grab = max(self.required_grab, grab)
+
+    def _poll(self, timeout: float, after: int | None = None):
+        params = {"since": self.seq, "timeout": timeout, "format": self.format}
+        if after is not None:
+            params["after"] = after
+        response = http_pool.get(f'{self.vm_url}/frames', params=params, timeout=timeout + 10)
         if response.status_code != 200:
-            raise ToolError(f"Failed to capture screenshot: HTTP {response.status_code}")
-        
-        # (1280, 800)
-        screenshot = Image.open(BytesIO(response.content))
-        
-        if resize and screenshot.size != (target_width, target_height):
+            raise ToolError(f"HTTP {response.status_code}")
+        self._apply(response.json())
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self._poll(self.poll_timeout)
+            except Exception as e:
+                print(f"frame stream error: {e}")
+                self.stopped.wait(1.0)
+
+    def _apply(self, update: dict):
+        with self.lock:
+            # latest() polls alongside the background thread, an answer overtaken by a newer frame is skipped,
+            # keyframes included, so seq never goes back behind a grab require_after() already waited for
+            if update["changed"] and (self.frame is None or update["seq"] > self.seq):
+                if update["keyframe"] or self.frame is None or self.frame.size != (update["width"], update["height"]):
+                    self.frame = Image.new("RGB", (update["width"], update["height"]))
+                for tile in update["tiles"]:
+                    self.frame.paste(Image.open(BytesIO(base64.b64decode(tile["data"]))), (tile["x"], tile["y"]))
+                self.seq = update["seq"]
+            self.grab = max(self.grab, update.get("grab", 0))
+            if self.frame is not None:
+                self.ready.set()
+
+    def latest(self, timeout: float | None = 10.0):
+        """
+        Copy of the newest frame and its seq. Waits until the first frame has arrived, and until one grabbed
+        after the last action or wait_stable is here; that one is requested right away rather than waiting
+        for the background poll. Raises ToolError if none arrives within timeout.
+        """
+        if not self.ready.wait(timeout):
+            raise ToolError("No frame received from the VM frame stream")
+        deadline = time.time() + (timeout or self.poll_timeout)
+        while True:
+            with self.lock:
+                required = self.required_grab
+                if self.grab > required or not required:
+                    return self.frame.copy(), self.seq
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ToolError("No frame newer than the last action arrived from the VM frame stream")
+            try:
+                self._poll(remaining, after=required)
+            except requests.exceptions.RequestException as e:
+                raise ToolError(f"Frame stream request failed: {e}")
+
+# one frame stream per VM, so sessions driving different VMs each get their own
+_frame_buffers = {}
+_frame_buffers_lock = threading.Lock()
+
+def require_newer_frame(frame_grab: int | None, vm_url: str = VM_URL):
+    """Called with the frame_grab of a VM response: streamed frames up to it no longer show the current screen."""
+    frame_buffer = _frame_buffers.get(vm_url)
+    # older VM servers send no frame_grab
+    if frame_buffer is not None and frame_grab is not None:
+        frame_buffer.require_after(frame_grab)
+
+def start_frame_stream(vm_url: str = VM_URL, **kwargs):
+    """Start the VM's shared background frame stream; get_screenshot serves full-screen captures from it afterwards."""
+    with _frame_buffers_lock:
+        if vm_url not in _frame_buffers:
+            _frame_buffers[vm_url] = FrameBuffer(vm_url=vm_url, **kwargs)
+        return _frame_buffers[vm_url].start()
+
+def frame_stream_running(vm_url: str = VM_URL):
+    return vm_url in _frame_buffers
+
+def stop_frame_stream(vm_url: str = VM_URL):
+    with _frame_buffers_lock:
+        frame_buffer = _frame_buffers.pop(vm_url, None)
+    if frame_buffer is not None:
+        frame_buffer.stop()
+
+def get_screenshot(resize: bool = False, target_width: int = 1920, target_height: int = 1080, save: bool = True, format: str = "png", vm_url: str = VM_URL, output_dir: str = OUTPUT_DIR, **capture_args):
+    """Capture screenshot by requesting from HTTP endpoint - returns native resolution unless resized
+
+    The resize happens on the VM, so less data crosses the wire. With save=False nothing is written
+    to disk and the returned path is None.
+    """
+    try:
+        data, screenshot = None, None
+        frame_buffer = _frame_buffers.get(vm_url)
+        if frame_buffer is not None and not capture_args:
+            # full-screen capture served from the streamed frame, no request to the VM
+            try:
+                screenshot, _ = frame_buffer.latest()
+            except ToolError as e:
+                print(f"frame stream: {e}, capturing directly")
+        if screenshot is None:
+            if resize:
+                capture_args.update(width=target_width, height=target_height)
+            data, params = fetch_screenshot(format=format, vm_url=vm_url, **capture_args)
+            # (1280, 800)
+            if format == "raw":
+                screenshot = Image.frombytes("RGB", (params["width"], params["height"]), data)
+            else:
+                screenshot = Image.open(BytesIO(data))
+
+        resized_locally = resize and screenshot.size != (target_width, target_height)
+        if resized_locally:
             screenshot = screenshot.resize((target_width, target_height))
-        screenshot.save(path)
+        if not save:
+            return screenshot, None
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        path = output_dir / f"screenshot_{uuid4().hex}.png"
+        if data is not None and format == "png" and not resized_locally:
+            # already png encoded by the VM, write it as is
+            path.write_bytes(data)
+        else:
+            screenshot.save(path)
         return screenshot, path
     except Exception as e:
-        raise ToolError(f"Failed to capture screenshot: {str(e)}")
\ No newline at end of file
+        raise ToolError(f"Failed to capture screenshot: {str(e)}")
@@ -0,0 +1,169 @@
+'''
+Fake OmniBox VM for offline runs: the real VM control server (omnibox/.../server/main.py) with pyautogui
+replaced by a simulated screen, so every endpoint (/action, /actions, /screenshot, /wait_stable, /frames)
+behaves like the real one. The screen shows canned screenshots from --screens (or generated ones) and
+advances to the next one once per screen-changing action (click, mouse_up, keys, type, scroll) run through
+/action or /actions, settling after --settle seconds; a key combo or a batch item counts once however many
+pyautogui calls it makes.
+/execute is disabled, shell commands would run on this machine.
+
+    python fake_vm_server.py --port 5000 --screens ./screens --settle 0.3
+'''
+import argparse
+import glob
+import importlib.util
+import os
+import sys
+import threading
+import time
+import types
+
+from PIL import Image, ImageDraw
+
+# typed actions (ACTION_SCHEMA in main.py) after which the screen shows something new
+SCREEN_ACTIONS = {'click', 'mouse_up', 'keys', 'type', 'scroll'}
+
+VM_SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'omnibox', 'vm', 'win11setup', 'setupscripts', 'server', 'main.py')
+
+
+class FakeScreen:
+    """Canned screens and a cursor; the VM server's actions advance the screen, its pyautogui calls move the cursor."""
+
+    def __init__(self, screens: list, settle: float = 0.0, action_latency: float = 0.0):
+        self.screens = screens
+        self.settle = settle
+        self.action_latency = action_latency
+        self.index = 0
+        self.changed_at = 0.0
+        self.cursor = (screens[0].width // 2, screens[0].height // 2)
+        self.actions = 0
+        self.lock = threading.Lock()
+
+    def act(self):
+        time.sleep(self.action_latency)
+
+    def advance(self):
+        with self.lock:
+            self.actions += 1
+            self.index = (self.index + 1) % len(self.screens)
+            self.changed_at = time.time()
+
+    def current(self):
+        with self.lock:
+            # the previous screen stays up until the new one has settled, like an app that is still redrawing
+            if time.time() - self.changed_at < self.settle:
+                return self.screens[(self.index - 1) % len(self.screens)]
+            return self.screens[self.index]
+
+    def pyautogui_module(self):
+        """Module with the pyautogui functions main.py uses."""
+        module = types.ModuleType('pyautogui')
+        module.FAILSAFE, module.PAUSE = False, 0
+
+        def move_to(x, y, duration=0.0):
+            self.cursor = (int(x), int(y))
+            self.act()
+
+        def click(x=None, y=None, clicks=1, button='left'):
+            if x is not None and y is not None:
+                self.cursor = (int(x), int(y))
+            self.act()
+
+        def screenshot(region=None):
+            image = self.current().copy()
+            if region:
+                x, y, width, height = region
+                image = image.crop((x, y, x + width, y + height))
+            return image
+
+        module.moveTo = move_to
+        module.dragTo = lambda x, y, duration=0.0, button='left': move_to(x, y)
+        module.click = click
+        module.mouseDown = lambda button='left': self.act()
+        module.mouseUp = lambda button='left': self.act()
+        module.keyDown = lambda key: None
+        module.keyUp = lambda key: self.act()
+        module.typewrite = lambda text, interval=0.0: self.act()
+        module.scroll = lambda amount: self.act()
+        module.position = lambda: self.cursor
+        module.size = lambda: self.screens[0].size
+        module.screenshot = screenshot
+        return module
+
+
+def generated_screens(count: int, size=(1920, 1080)):
+    """Distinct synthetic screens: a background colour per screen and a grid of labelled buttons."""
+    screens = []
+    for i in range(count):
+        image = Image.new('RGB', size, ((40 + 53 * i) % 256, (90 + 31 * i) % 256, (140 + 17 * i) % 256))
+        draw = ImageDraw.Draw(image)
+        for row in range(6):
+            for col in range(8):
+                x, y = 80 + col * 220, 120 + row * 150
+                draw.rectangle((x, y, x + 180, y + 60), fill=(235, 235, 235), outline=(20, 20, 20))
+                draw.text((x + 12, y + 22), f'screen {i} button {row * 8 + col}', fill=(0, 0, 0))
+        screens.append(image)
+    return screens
+
+
+def load_screens(folder: str):
+    paths = sorted(p for p in glob.glob(os.path.join(folder, '*')) if p.lower().endswith(('.png', '.jpg', '.jpeg')))
+    if not paths:
+        raise ValueError(f'no png/jpg screenshots in {folder}')
+    screens = [Image.open(p).convert('RGB') for p in paths]
+    # the server reports one screen size, canned screenshots are scaled to the first one
+    return [s if s.size == screens[0].size else s.resize(screens[0].size) for s in screens]
+
+
+def load_vm_server(fake_screen: FakeScreen, port: int, log_file: str):
+    """Import the real VM server with the fake pyautogui; it parses sys.argv on import."""
+    sys.modules['pyautogui'] = fake_screen.pyautogui_module()
+    argv, sys.argv = sys.argv, [VM_SERVER_PATH, '--port', str(port), '--log_file', log_file]
+    try:
+        spec = importlib.util.spec_from_file_location('omnibox_vm_server', VM_SERVER_PATH)
+        server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(server)
+    finally:
+        sys.argv = argv
+    run_action = server.run_action
+
+    def run_and_advance(name, params):
+        # /action and /actions call this once per typed action, under the control lock, before frame_grab is read
+        result = run_action(name, params)
+        if name in SCREEN_ACTIONS:
+            fake_screen.advance()
+        return result
+    server.run_action = run_and_advance
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OmniBox VM serving canned screenshots')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--screens', type=str, default=None, help='folder of png/jpg screenshots, generated screens if omitted')
+    parser.add_argument('--generated_screens', type=int, default=8, help='how many screens to generate without --screens')
+    parser.add_argument('--settle', type=float, default=0.2, help='seconds before a new screen replaces the previous one')
+    parser.add_argument('--action_latency', type=float, default=0.0, help='seconds every mouse/keyboard action takes')
+    parser.add_argument('--log_file', type=str, default=os.devnull)
+    args = parser.parse_args()
+
+    screens = load_screens(args.screens) if args.screens else generated_screens(args.generated_screens)
+    fake_screen = FakeScreen(screens, settle=args.settle, action_latency=args.action_latency)
+    server = load_vm_server(fake_screen, args.port, args.log_file)
+
+    def execute_disabled():
+        return server.jsonify({'status': 'error', 'message': '/execute is disabled on the fake VM'}), 403
+    server.app.view_functions['execute_command'] = execute_disabled
+
+    @server.app.route('/fake/state', methods=['GET'])
+    def fake_state():
+        return server.jsonify({'screen': fake_screen.index, 'screens': len(screens), 'actions': fake_screen.actions, 'cursor': list(fake_screen.cursor)})
+
+    print(f'fake VM on {args.host}:{args.port} with {len(screens)} screens of {screens[0].size}')
+    server.WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    server.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
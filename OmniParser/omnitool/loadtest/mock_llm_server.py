@@ -0,0 +1,278 @@
+'''
+Local stand-in for the LLM providers (and optionally the OmniParser server), so the agent loops can run
+and be load-tested without network access or a GPU. Responses are rule-based by default: the planner
+clicks one of the listed elements and reports the task done after --task_steps actions. A --script file
+gives canned responses instead.
+
+    python mock_llm_server.py --port 8100 --latency 0.8 --jitter 0.2
+
+Point the clients at it with:
+    OAI_BASE_URL=http://127.0.0.1:8100/v1            OpenAI-compatible calls (gpt, o1, o3-mini, qwen)
+    GROQ_BASE_URL=http://127.0.0.1:8100              Groq (R1), read by the groq SDK
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8100         Anthropic computer use, read by the anthropic SDK
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8100        Gemini in the CUA app's AIReasoner
+and, with --parse, the OmniParser url at 127.0.0.1:8100 (POST /parse/).
+
+The script file is a JSON object with lists of responses per kind, used in turn:
+    {"planner": ["```json {...} ```", ...], "plan": [...], "ledger": [...], "gemini": [...],
+     "anthropic": [[{"type": "text", "text": "..."}, {"type": "tool_use", "name": "computer", "input": {...}}], ...]}
+'''
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from io import BytesIO
+
+from flask import Flask, request, jsonify
+from PIL import Image
+from werkzeug.serving import WSGIRequestHandler
+
+parser = argparse.ArgumentParser(description='Mock LLM provider for offline agent runs')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8100)
+parser.add_argument('--latency', type=float, default=0.5, help='seconds every LLM response takes')
+parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added uniformly to every latency')
+parser.add_argument('--task_steps', type=int, default=5, help='actions before the rule-based planner reports the task done')
+parser.add_argument('--script', type=str, default=None, help='JSON file with canned responses per kind')
+parser.add_argument('--parse', action='store_true', help='also serve POST /parse/ like the OmniParser server')
+parser.add_argument('--parse_latency', type=float, default=0.3, help='seconds every /parse/ takes')
+parser.add_argument('--parse_stall_rate', type=float, default=0.0, help='fraction of parses that stall, for tail latency tests')
+parser.add_argument('--parse_stall', type=float, default=2.0, help='extra seconds a stalled parse takes')
+parser.add_argument('--parse_elements', type=int, default=40, help='elements per parsed screen')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+app = Flask(__name__)
+
+CHARS_PER_TOKEN = 4
+script = {}
+script_position = defaultdict(int)
+stats = defaultdict(lambda: {'requests': 0, 'seconds': 0.0})
+stats_lock = threading.Lock()
+# like the real server, parses run one at a time and /probe/ reports how many are waiting or running
+parse_lock = threading.Lock()
+parse_queue_depth = 0
+
+
+def simulate_latency(kind, latency):
+    delay = max(0.0, latency + random.uniform(-args.jitter, args.jitter))
+    time.sleep(delay)
+    with stats_lock:
+        stats[kind]['requests'] += 1
+        stats[kind]['seconds'] += delay
+
+
+def scripted(kind):
+    """Next canned response of this kind, or None when the script has none."""
+    responses = script.get(kind)
+    if not responses:
+        return None
+    with stats_lock:
+        response = responses[script_position[kind] % len(responses)]
+        script_position[kind] += 1
+    return response
+
+
+def tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def message_text(content):
+    """Text of an OpenAI/Anthropic message content (string or list of parts), images skipped."""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for part in content or []:
+        if isinstance(part, dict):
+            if part.get('type') == 'text':
+                parts.append(part.get('text', ''))
+            elif part.get('type') == 'tool_result':
+                parts.append(message_text(part.get('content')))
+    # the agents send some strings as one text part per character, parts are concatenated like the providers do
+    return ''.join(parts)
+
+
+def actions_taken(texts):
+    """Actions already in the history: executed responses, plus the lines of a compacted action log."""
+    count = sum(text.count('Next Action: ') for text in texts)
+    for text in texts:
+        if text.startswith('Actions taken in earlier steps'):
+            count += len(re.findall(r'^\d+\. ', text, re.M))
+            omitted = re.search(r'\((\d+) earlier actions omitted\)', text)
+            count += int(omitted.group(1)) if omitted else 0
+    return count
+
+
+def pick(ids, step):
+    return ids[(step * 7 + args.seed) % len(ids)] if ids else None
+
+
+def planner_response(text, history, step):
+    """VLMAgent / VLMOrchestratedAgent action JSON: click a listed element until task_steps actions were taken."""
+    if step >= args.task_steps:
+        decision = {"Reasoning": "The task looks complete.", "Next Action": "None"}
+    else:
+        # a delta screen description may list no elements, then any element listed earlier will do
+        box_id = pick([int(i) for i in re.findall(r'ID: (\d+)', text) or re.findall(r'ID: (\d+)', history)], step)
+        decision = {"Reasoning": f"Mock step {step + 1}: clicking the next element.", "Next Action": "left_click"}
+        if box_id is not None:
+            decision["Box ID"] = box_id
+    return f"```json\n{json.dumps(decision, indent=4)}\n```"
+
+
+def plan_response():
+    plan = {f"step {i + 1}": f"mock sub-goal {i + 1}" for i in range(args.task_steps)}
+    return f"```json\n{json.dumps(plan, indent=4)}\n```"
+
+
+def ledger_response(step):
+    done = step >= args.task_steps
+    ledger = {
+        "is_request_satisfied": {"reason": "mock ledger", "answer": done},
+        "is_in_loop": {"reason": "mock ledger", "answer": False},
+        "is_progress_being_made": {"reason": "mock ledger", "answer": True},
+        "instruction_or_question": {"reason": "mock ledger", "answer": "Continue with the next sub-goal."},
+    }
+    return f"```json\n{json.dumps(ledger, indent=4)}\n```"
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+@app.route('/openai/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    """OpenAI-compatible chat completions, also what Groq and dashscope speak."""
+    data = request.json
+    messages = data.get('messages', [])
+    texts = [message_text(m.get('content')) for m in messages]
+    everything = '\n'.join(texts)
+    step = actions_taken(texts)
+    if 'devise a short bullet-point plan' in texts[-1]:
+        kind, text = 'plan', scripted('plan') or plan_response()
+    elif 'Is the request fully satisfied?' in texts[-1]:
+        kind, text = 'ledger', scripted('ledger') or ledger_response(step)
+    else:
+        kind, text = 'planner', scripted('planner') or planner_response(texts[-1], everything, step)
+    simulate_latency(kind, args.latency)
+    prompt_tokens, completion_tokens = tokens(everything), tokens(text)
+    return jsonify({
+        'id': f'chatcmpl-mock-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()),
+        'model': data.get('model', 'mock'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+    })
+
+
+@app.route('/v1/messages', methods=['POST'])
+def anthropic_messages():
+    """Anthropic messages API with the computer tool: move and click a few times, then finish."""
+    data = request.json
+    messages = data.get('messages', [])
+    turn = sum(1 for m in messages if m.get('role') == 'assistant')
+    content = scripted('anthropic')
+    if content is None:
+        if turn >= 2 * args.task_steps:
+            content = [{'type': 'text', 'text': 'The task looks complete.'}]
+        elif turn % 2 == 0:
+            rng = random.Random(args.seed + turn)
+            content = [{'type': 'text', 'text': f'Mock step {turn // 2 + 1}: moving to the next element.'},
+                       {'type': 'tool_use', 'name': 'computer', 'input': {'action': 'mouse_move', 'coordinate': [rng.randrange(1920), rng.randrange(1080)]}}]
+        else:
+            content = [{'type': 'tool_use', 'name': 'computer', 'input': {'action': 'left_click'}}]
+    content = [dict(block, id=f'toolu_mock_{uuid.uuid4().hex}') if block.get('type') == 'tool_use' and 'id' not in block else block for block in content]
+    simulate_latency('anthropic', args.latency)
+    output = json.dumps(content)
+    return jsonify({
+        'id': f'msg_mock_{uuid.uuid4().hex}', 'type': 'message', 'role': 'assistant', 'model': data.get('model', 'mock'),
+        'content': content, 'stop_reason': 'tool_use' if any(b['type'] == 'tool_use' for b in content) else 'end_turn',
+        'stop_sequence': None,
+        'usage': {'input_tokens': tokens(json.dumps(messages)), 'output_tokens': tokens(output)},
+    })
+
+
+@app.route('/v1beta/models/<model_call>', methods=['POST'])
+def gemini_generate_content(model_call):
+    """Gemini generateContent (REST transport), as sent by AIReasoner for one-shot prompts and chat turns."""
+    if not model_call.endswith(':generateContent'):
+        return jsonify({'error': {'code': 404, 'message': f'{model_call} is not supported by the mock'}}), 404
+    data = request.json
+    contents = data.get('contents', [])
+    texts = ['\n'.join(part.get('text', '') for part in content.get('parts', [])) for content in contents]
+    latest = texts[-1] if texts else ''
+    text = scripted('gemini')
+    if text is None:
+        match = re.search(r'CURRENT STEP: (\d+)/(\d+)', latest)
+        step = int(match.group(1)) - 1 if match else 0
+        element_id = pick([int(i) for i in re.findall(r'Element (\d+):', latest) or re.findall(r'Element (\d+):', '\n'.join(texts))], step)
+        text = json.dumps({
+            "target_element_id": element_id, "reasoning": f"Mock step {step + 1}.", "action": "click",
+            "step_description": f"Click element {element_id}", "completed": step + 1 >= args.task_steps, "confidence": "high",
+        })
+    simulate_latency('gemini', args.latency)
+    prompt_tokens = tokens(json.dumps(contents))
+    return jsonify({
+        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+        'usageMetadata': {'promptTokenCount': prompt_tokens, 'candidatesTokenCount': tokens(text), 'totalTokenCount': prompt_tokens + tokens(text)},
+    })
+
+
+@app.route('/parse/', methods=['POST'])
+def parse():
+    """OmniParser stand-in: the same elements for the same screenshot, the screenshot itself as the SoM image."""
+    if not args.parse:
+        return jsonify({'status': 'error', 'message': 'start the mock with --parse to serve /parse/'}), 404
+    global parse_queue_depth
+    data = request.json
+    image_base64 = data['base64_image']
+    width, height = Image.open(BytesIO(base64.b64decode(image_base64))).size
+    rng = random.Random(hashlib.md5(image_base64.encode()).hexdigest())
+    elements = []
+    for i in range(args.parse_elements):
+        x, y = rng.random() * 0.9, rng.random() * 0.9
+        kind = rng.choice(['text', 'icon'])
+        element = {'type': kind, 'bbox': [x, y, x + 0.06, y + 0.03], 'interactivity': kind == 'icon',
+                   'content': f'mock {kind} {rng.randrange(1000)}', 'source': 'box_ocr_content_ocr' if kind == 'text' else 'box_yolo_content_yolo'}
+        if data.get('session_id'):
+            element['track_id'] = i
+        elements.append(element)
+    # like the real server, a parse still queued when its client's timeout passes is dropped with a 504
+    timeout = data.get('timeout')
+    with stats_lock:
+        parse_queue_depth += 1
+    try:
+        if not parse_lock.acquire(timeout=timeout if timeout else -1):
+            return jsonify({'detail': 'deadline passed before the parse started'}), 504
+        try:
+            start = time.time()
+            stalled = random.random() < args.parse_stall_rate
+            simulate_latency('parse', args.parse_latency + (args.parse_stall if stalled else 0.0))
+        finally:
+            parse_lock.release()
+    finally:
+        with stats_lock:
+            parse_queue_depth -= 1
+    return jsonify({'som_image_base64': image_base64, 'parsed_content_list': elements, 'latency': time.time() - start, 'width': width, 'height': height})
+
+
+@app.route('/probe/', methods=['GET'])
+def probe():
+    return jsonify({'message': 'Mock LLM server ready', 'queue_depth': parse_queue_depth})
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Requests served and mean simulated latency per kind of call."""
+    with stats_lock:
+        return jsonify({kind: {'requests': s['requests'], 'mean_latency': s['seconds'] / s['requests']} for kind, s in stats.items() if s['requests']})
+
+
+if __name__ == '__main__':
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(host=args.host, port=args.port, threaded=True)
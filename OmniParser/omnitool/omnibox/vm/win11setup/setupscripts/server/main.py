@@ -3,11 +3,18 @@ import logging
 import argparse
 import shlex
 import subprocess
+import time
+import base64
+import ctypes
+import hashlib
+from collections import deque
+import numpy as np
 from flask import Flask, request, jsonify, send_file
+from werkzeug.serving import WSGIRequestHandler
 import threading
 import traceback
 import pyautogui
-from PIL import Image
+from PIL import Image, ImageChops, ImageDraw, ImageStat
 from io import BytesIO
 
 parser = argparse.ArgumentParser()
@@ -23,6 +30,75 @@ app = Flask(__name__)
 
 computer_control_lock = threading.Lock()
 
+# the server process drives the mouse and keyboard directly, so keep pyautogui's per-call pause off
+pyautogui.FAILSAFE = False
+pyautogui.PAUSE = 0
+
+# typed actions accepted by /action: name -> (required fields, optional fields with defaults)
+ACTION_SCHEMA = {
+    'move': (['x', 'y'], {'duration': 0.0}),
+    'click': ([], {'x': None, 'y': None, 'button': 'left', 'clicks': 1}),
+    'mouse_down': ([], {'button': 'left'}),
+    'mouse_up': ([], {'button': 'left'}),
+    'drag': (['x', 'y'], {'duration': 0.5, 'button': 'left'}),
+    'keys': (['keys'], {}),
+    'type': (['text'], {'interval': 0.0}),
+    'scroll': (['amount'], {}),
+    'position': ([], {}),
+    'size': ([], {}),
+}
+
+
+def validate_action(data):
+    """Check an action dict against ACTION_SCHEMA and return (name, params with defaults filled in)."""
+    if not isinstance(data, dict) or data.get('action') not in ACTION_SCHEMA:
+        raise ValueError(f"'action' must be one of {sorted(ACTION_SCHEMA)}")
+    name = data['action']
+    required, optional = ACTION_SCHEMA[name]
+    missing = [field for field in required if field not in data]
+    if missing:
+        raise ValueError(f"{name} requires {missing}")
+    unknown = set(data) - set(required) - set(optional) - {'action'}
+    if unknown:
+        raise ValueError(f"{name} does not accept {sorted(unknown)}")
+    params = {**optional, **{k: v for k, v in data.items() if k != 'action'}}
+    if name == 'keys' and (not isinstance(params['keys'], list) or not all(isinstance(k, str) for k in params['keys'])):
+        raise ValueError("keys must be a list of key names")
+    if name == 'type' and not isinstance(params['text'], str):
+        raise ValueError("text must be a string")
+    return name, params
+
+
+def run_action(name, params):
+    """Execute a validated action in this process and return its result dict."""
+    if name == 'move':
+        pyautogui.moveTo(params['x'], params['y'], duration=params['duration'])
+    elif name == 'click':
+        pyautogui.click(x=params['x'], y=params['y'], clicks=params['clicks'], button=params['button'])
+    elif name == 'mouse_down':
+        pyautogui.mouseDown(button=params['button'])
+    elif name == 'mouse_up':
+        pyautogui.mouseUp(button=params['button'])
+    elif name == 'drag':
+        pyautogui.dragTo(params['x'], params['y'], duration=params['duration'], button=params['button'])
+    elif name == 'keys':
+        # press in order and release in reverse, so ['ctrl', 'c'] behaves as a combo
+        for key in params['keys']:
+            pyautogui.keyDown(key)
+        for key in reversed(params['keys']):
+            pyautogui.keyUp(key)
+    elif name == 'type':
+        pyautogui.typewrite(params['text'], interval=params['interval'])
+    elif name == 'scroll':
+        pyautogui.scroll(params['amount'])
+    elif name == 'position':
+        x, y = pyautogui.position()
+        return {'x': x, 'y': y}
+    elif name == 'size':
+        width, height = pyautogui.size()
+        return {'width': width, 'height': height}
+    return {}
+
 @app.route('/probe', methods=['GET'])
 def probe_endpoint():
     return jsonify({"status": "Probe successful", "message": "Service is operational"}), 200
@@ -60,22 +136,363 @@ def execute_command():
                 'message': str(e)
             }), 500
 
+@app.route('/action', methods=['POST'])
+def action_endpoint():
+    # same lock as /execute, actions never interleave
+    with computer_control_lock:
+        try:
+            name, params = validate_action(request.json)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        try:
+            result = run_action(name, params)
+            return jsonify({'status': 'success', 'result': result, 'frame_grab': frame_stream.grabs})
+        except Exception as e:
+            logger.error("\n" + traceback.format_exc() + "\n")
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+@app.route('/actions', methods=['POST'])
+def actions_endpoint():
+    """Run a list of typed actions in one round trip, stopping at the first failure unless stop_on_error is false."""
+    data = request.json or {}
+    actions = data.get('actions')
+    if not isinstance(actions, list):
+        return jsonify({'status': 'error', 'message': "'actions' must be a list"}), 400
+    try:
+        validated = [validate_action(action) for action in actions]
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    stop_on_error = data.get('stop_on_error', True)
+
+    results = []
+    with computer_control_lock:
+        for name, params in validated:
+            start = time.time()
+            try:
+                results.append({'action': name, 'status': 'success', 'result': run_action(name, params), 'elapsed': time.time() - start})
+            except Exception as e:
+                logger.error("\n" + traceback.format_exc() + "\n")
+                results.append({'action': name, 'status': 'error', 'message': str(e), 'elapsed': time.time() - start})
+                if stop_on_error:
+                    break
+    status = 'success' if all(r['status'] == 'success' for r in results) else 'error'
+    # streamed frames from later grabs show the screen after these actions
+    return jsonify({'status': status, 'results': results, 'frame_grab': frame_stream.grabs})
+
+SCREENSHOT_FORMATS = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp', 'raw': 'application/octet-stream'}
+_cursor_sprite = None
+
+
+def get_cursor_sprite():
+    """cursor.png scaled down once and kept in memory, instead of reloaded for every screenshot."""
+    global _cursor_sprite
+    if _cursor_sprite is None:
+        cursor = Image.open(os.path.join(os.path.dirname(__file__), "cursor.png"))
+        # make the cursor smaller
+        cursor = cursor.resize((int(cursor.width / 1.5), int(cursor.height / 1.5)))
+        cursor.load()
+        _cursor_sprite = cursor
+    return _cursor_sprite
+
+
+class GUITHREADINFO(ctypes.Structure):
+    _fields_ = [('cbSize', ctypes.c_uint32), ('flags', ctypes.c_uint32), ('hwndActive', ctypes.c_void_p),
+                ('hwndFocus', ctypes.c_void_p), ('hwndCapture', ctypes.c_void_p), ('hwndMenuOwner', ctypes.c_void_p),
+                ('hwndMoveSize', ctypes.c_void_p), ('hwndCaret', ctypes.c_void_p), ('rcCaret', ctypes.c_long * 4)]
+
+
+def caret_rect():
+    """Screen rect (x0, y0, x1, y1) of the text caret in the foreground window, None without one (or off Windows)."""
+    user32 = getattr(getattr(ctypes, 'windll', None), 'user32', None)
+    if user32 is None:
+        return None
+    info = GUITHREADINFO(cbSize=ctypes.sizeof(GUITHREADINFO))
+    if not user32.GetGUIThreadInfo(0, ctypes.byref(info)) or not info.hwndCaret:
+        return None
+    # rcCaret is in the caret window's client coordinates
+    left, top, right, bottom = info.rcCaret
+    origin = (ctypes.c_long * 2)(left, top)
+    user32.ClientToScreen(ctypes.c_void_p(info.hwndCaret), ctypes.byref(origin))
+    return origin[0], origin[1], origin[0] + right - left, origin[1] + bottom - top
+
+
+def frame_fingerprint(screenshot, region=None):
+    """
+    Hash of a grab taken without the cursor sprite, with the text caret blanked out, so a blinking caret
+    or a moved mouse does not count as a screen change. Clients compare it to tell whether the screen
+    still shows a frame they already parsed.
+    """
+    # convert returns a copy, the caller's grab is left as it is
+    screenshot = screenshot.convert('RGB')
+    caret = caret_rect()
+    if caret is not None:
+        x0, y0, x1, y1 = caret
+        if region:
+            x0, y0, x1, y1 = x0 - region[0], y0 - region[1], x1 - region[0], y1 - region[1]
+        # a pixel of margin, some carets are drawn slightly wider than reported
+        ImageDraw.Draw(screenshot).rectangle((x0 - 1, y0 - 1, x1, y1), fill=(0, 0, 0))
+    return hashlib.md5(screenshot.tobytes()).hexdigest()
+
+
+def parse_region(region):
+    """'x,y,w,h' query value -> tuple of ints, or None."""
+    if not region:
+        return None
+    values = [int(v) for v in region.split(',')]
+    if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+        raise ValueError("region must be x,y,width,height with positive width and height")
+    return tuple(values)
+
+
 @app.route('/screenshot', methods=['GET'])
-def capture_screen_with_cursor():    
-    cursor_path = os.path.join(os.path.dirname(__file__), "cursor.png")
-    screenshot = pyautogui.screenshot()
-    cursor_x, cursor_y = pyautogui.position()
-    cursor = Image.open(cursor_path)
-    # make the cursor smaller
-    cursor = cursor.resize((int(cursor.width / 1.5), int(cursor.height / 1.5)))
-    screenshot.paste(cursor, (cursor_x, cursor_y), cursor)
-    
-
-    # Convert PIL Image to bytes and send
+def capture_screen_with_cursor():
+    """
+    Query parameters, all optional:
+    format: png (default), jpeg, webp or raw (RGB bytes, size in X-Width/X-Height headers)
+    quality: jpeg/webp quality, default 85
+    compress_level: png zlib level 0-9, default 6; lower is faster and larger
+    width, height: resize the capture to this size on the VM
+    region: x,y,w,h to capture only part of the screen
+    cursor: 0 to leave the cursor out
+    fingerprint: 1 to return frame_fingerprint of this very grab in the X-Fingerprint header
+    """
+    fmt = request.args.get('format', 'png').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in SCREENSHOT_FORMATS:
+        return jsonify({'status': 'error', 'message': f"format must be one of {sorted(SCREENSHOT_FORMATS)}"}), 400
+    try:
+        region = parse_region(request.args.get('region'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+
+    screenshot = pyautogui.screenshot(region=region)
+    # taken before the cursor is pasted in
+    fingerprint = frame_fingerprint(screenshot, region) if request.args.get('fingerprint') == '1' else None
+    if request.args.get('cursor', '1') != '0':
+        cursor_x, cursor_y = pyautogui.position()
+        if region:
+            cursor_x, cursor_y = cursor_x - region[0], cursor_y - region[1]
+        cursor = get_cursor_sprite()
+        screenshot.paste(cursor, (cursor_x, cursor_y), cursor)
+    if width and height and screenshot.size != (width, height):
+        screenshot = screenshot.resize((width, height))
+
+    if fmt == 'raw':
+        screenshot = screenshot.convert('RGB')
+        response = app.response_class(screenshot.tobytes(), mimetype=SCREENSHOT_FORMATS[fmt])
+        response.headers['X-Width'], response.headers['X-Height'] = screenshot.width, screenshot.height
+    else:
+        # Convert PIL Image to bytes and send
+        img_io = BytesIO()
+        if fmt == 'png':
+            screenshot.save(img_io, 'PNG', compress_level=request.args.get('compress_level', 6, type=int))
+        else:
+            screenshot.convert('RGB').save(img_io, fmt.upper(), quality=request.args.get('quality', 85, type=int))
+        img_io.seek(0)
+        response = send_file(img_io, mimetype=SCREENSHOT_FORMATS[fmt])
+    if fingerprint is not None:
+        response.headers['X-Fingerprint'] = fingerprint
+    return response
+
+
+@app.route('/fingerprint', methods=['GET'])
+def fingerprint_endpoint():
+    """frame_fingerprint of the current screen, to check it against the X-Fingerprint of an earlier screenshot."""
+    return jsonify({'fingerprint': frame_fingerprint(pyautogui.screenshot())})
+
+
+def grab_thumbnail(size=(160, 100)):
+    """Small grayscale capture, enough to tell whether the screen is still changing."""
+    return pyautogui.screenshot().convert('L').resize(size)
+
+
+def frame_difference(frame1, frame2):
+    """Mean absolute pixel difference between two thumbnails, 0-255."""
+    return ImageStat.Stat(ImageChops.difference(frame1, frame2)).mean[0]
+
+
+@app.route('/wait_stable', methods=['POST'])
+def wait_stable_endpoint():
+    """
+    Grab a thumbnail every `interval` seconds and return once `stable_frames` consecutive pairs differ by
+    at most `threshold`, or when `timeout` seconds have passed.
+    """
+    data = request.json or {}
+    interval = float(data.get('interval', 0.15))
+    threshold = float(data.get('threshold', 1.0))
+    timeout = float(data.get('timeout', 3.0))
+    stable_frames = int(data.get('stable_frames', 2))
+
+    start = time.time()
+    previous = grab_thumbnail()
+    frames, matches, difference = 1, 0, None
+    while time.time() - start < timeout:
+        time.sleep(interval)
+        current = grab_thumbnail()
+        frames += 1
+        difference = frame_difference(previous, current)
+        matches = matches + 1 if difference <= threshold else 0
+        if matches >= stable_frames:
+            break
+        previous = current
+    return jsonify({'stable': matches >= stable_frames, 'elapsed': time.time() - start, 'frames': frames, 'difference': difference, 'frame_grab': frame_stream.grabs})
+
+class FrameStream:
+    """
+    Captures the screen in a background thread and remembers which tiles changed in each new frame,
+    so /frames can send a client only the regions that differ from the frame it already has.
+    The thread starts on the first /frames request and stops after `idle_timeout` seconds without one.
+    """
+
+    def __init__(self, interval=0.1, tile_size=64, history=50, idle_timeout=30.0):
+        self.interval = interval
+        self.tile_size = tile_size
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.keyframe_seq = 0
+        # (seq, dirty rects) for the most recent frames, older clients get a keyframe
+        self.deltas = deque(maxlen=history)
+        self.last_request = 0
+        self.thread = None
+        # grabs started so far, and the grab the current frame comes from
+        self.grabs = 0
+        self.grab = 0
+
+    def touch(self):
+        with self.condition:
+            self.last_request = time.time()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # decided under the lock touch() takes: a request either keeps this thread running or,
+                # once it is gone, starts a new one
+                if time.time() - self.last_request >= self.idle_timeout:
+                    self.thread = None
+                    # the next client must start from a keyframe, nothing tracked changes while stopped
+                    self.frame = None
+                    return
+                self.grabs += 1
+                grab = self.grabs
+            start = time.time()
+            screenshot = pyautogui.screenshot()
+            cursor_x, cursor_y = pyautogui.position()
+            cursor = get_cursor_sprite()
+            screenshot.paste(cursor, (cursor_x, cursor_y), cursor)
+            frame = np.asarray(screenshot.convert('RGB'))
+            with self.condition:
+                if self.frame is None or self.frame.shape != frame.shape:
+                    self.seq += 1
+                    self.keyframe_seq = self.seq
+                    self.deltas.clear()
+                    self.frame = frame
+                else:
+                    rects = self.dirty_rects(self.frame, frame)
+                    if rects:
+                        self.seq += 1
+                        self.deltas.append((self.seq, rects))
+                        self.frame = frame
+                # the frame is current as of this grab even when nothing changed, /frames?after= waits for that
+                self.grab = grab
+                self.condition.notify_all()
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+    def dirty_rects(self, previous, current):
+        """Changed tiles as (x, y, w, h), horizontally adjacent tiles in a row merged into one rect."""
+        t = self.tile_size
+        h, w = current.shape[:2]
+        changed = np.any(previous != current, axis=2)
+        rows, cols = -(-h // t), -(-w // t)
+        padded = np.zeros((rows * t, cols * t), dtype=bool)
+        padded[:h, :w] = changed
+        tiles = padded.reshape(rows, t, cols, t).any(axis=(1, 3))
+        rects = []
+        for ty in range(rows):
+            tx = 0
+            while tx < cols:
+                if not tiles[ty, tx]:
+                    tx += 1
+                    continue
+                run = tx
+                while run < cols and tiles[ty, run]:
+                    run += 1
+                x, y = tx * t, ty * t
+                rects.append((x, y, min(run * t, w) - x, min(y + t, h) - y))
+                tx = run
+        return rects
+
+    def wait_for_update(self, since, timeout, after=None):
+        """
+        Block until there is a frame newer than `since`, or with `after` until a grab later than `after` was
+        processed, changed or not. Returns (seq, grab, frame, rects or None for a keyframe); frame is None if
+        the client's frame is still current.
+        """
+        def ready():
+            return self.frame is not None and (self.seq > since or (after is not None and self.grab > after))
+
+        with self.condition:
+            self.condition.wait_for(ready, timeout=timeout)
+            if self.frame is None or self.seq <= since:
+                return since, self.grab, None, []
+            oldest = self.deltas[0][0] if self.deltas else self.seq + 1
+            if since < self.keyframe_seq or since < oldest - 1:
+                return self.seq, self.grab, self.frame, None
+            rects = [rect for seq, delta in self.deltas if seq > since for rect in delta]
+            return self.seq, self.grab, self.frame, rects
+
+
+frame_stream = FrameStream()
+
+
+def encode_image(image, fmt, quality):
     img_io = BytesIO()
-    screenshot.save(img_io, 'PNG')
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+    if fmt == 'png':
+        image.save(img_io, 'PNG', compress_level=1)
+    else:
+        image.save(img_io, fmt.upper(), quality=quality)
+    return base64.b64encode(img_io.getvalue()).decode('ascii')
+
+
+@app.route('/frames', methods=['GET'])
+def frames_endpoint():
+    """
+    Long-poll for screen changes. `since` is the seq of the frame the client holds (0 for none); the response
+    comes as soon as a newer frame exists, or after `timeout` seconds with changed=false.
+    Changed regions are sent as tiles cut from the newest frame; keyframe=true means one tile with the whole screen.
+    `grab` is the capture the newest frame is current as of. With `after` (a frame_grab from /action, /actions or
+    /wait_stable) the response also comes once a later capture was taken, so the client knows its frame postdates it.
+    """
+    since = request.args.get('since', 0, type=int)
+    after = request.args.get('after', type=int)
+    timeout = min(request.args.get('timeout', 10.0, type=float), 60.0)
+    fmt = request.args.get('format', 'png').lower()
+    if fmt not in ('png', 'jpeg', 'webp'):
+        return jsonify({'status': 'error', 'message': "format must be png, jpeg or webp"}), 400
+    quality = request.args.get('quality', 85, type=int)
+
+    frame_stream.touch()
+    seq, grab, frame, rects = frame_stream.wait_for_update(since, timeout, after)
+    if frame is None:
+        return jsonify({'seq': seq, 'grab': grab, 'changed': False})
+    height, width = frame.shape[:2]
+    keyframe = rects is None
+    if keyframe:
+        rects = [(0, 0, width, height)]
+    tiles = [{'x': x, 'y': y, 'w': w, 'h': h, 'data': encode_image(Image.fromarray(frame[y:y+h, x:x+w]), fmt, quality)} for x, y, w, h in rects]
+    return jsonify({'seq': seq, 'grab': grab, 'changed': True, 'keyframe': keyframe, 'width': width, 'height': height, 'tiles': tiles})
 
 if __name__ == '__main__':
+    # HTTP/1.1 keeps client connections alive between requests instead of reconnecting for every action
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="127.0.0.1", port=args.port)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+# OmniParser/, for the util package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.parse_deadline import ParseDeadline, acquire_before
+
+
+def test_acquire_times_out_while_lock_is_held():
+    async def run():
+        lock = asyncio.Lock()
+        await lock.acquire()
+        acquired = await acquire_before(lock, ParseDeadline(0.05))
+        assert not acquired
+        lock.release()
+        # the abandoned acquire must not have taken the lock
+        await asyncio.sleep(0)
+        assert not lock.locked()
+        assert await acquire_before(lock, ParseDeadline(0.05))
+        lock.release()
+
+    asyncio.run(run())
+
+
+def test_acquire_racing_its_timeout_never_leaks_the_lock():
+    async def run():
+        loop = asyncio.get_running_loop()
+        for _ in range(50):
+            lock = asyncio.Lock()
+            await lock.acquire()
+            # released right as the waiting acquire times out
+            loop.call_later(0.01, lock.release)
+            if await acquire_before(lock, ParseDeadline(0.01)):
+                lock.release()
+            for _ in range(3):
+                await asyncio.sleep(0)
+            assert not lock.locked()
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_releases_an_acquired_lock():
+    async def run():
+        lock = asyncio.Lock()
+        await lock.acquire()
+        waiter = asyncio.ensure_future(acquire_before(lock, ParseDeadline(10)))
+        await asyncio.sleep(0)
+        # the lock is handed to the waiter, which is cancelled before it resumes
+        lock.release()
+        waiter.cancel()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert waiter.cancelled()
+        assert not lock.locked()
+
+    asyncio.run(run())
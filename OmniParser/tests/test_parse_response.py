@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# OmniParser/, for the util package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.parse_deadline import ParseDeadlineExceeded, parse_response_json
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+def test_dropped_parse_raises_deadline_exceeded():
+    response = FakeResponse(504, {"detail": "deadline passed before the parse started"})
+    with pytest.raises(ParseDeadlineExceeded, match="504"):
+        parse_response_json(response)
+
+
+def test_other_error_status_is_reported():
+    with pytest.raises(ValueError, match="HTTP 500"):
+        parse_response_json(FakeResponse(500, {"detail": "boom"}))
+
+
+def test_parsed_screen_is_returned():
+    body = {"som_image_base64": "", "parsed_content_list": [], "latency": 0.1}
+    assert parse_response_json(FakeResponse(200, body)) is body
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+# peak memory per 64x64 crop during florence generate, from the ~4 GB for a batch of 128 measurement
+DEFAULT_BYTES_PER_ITEM = 32 * 1024 ** 2
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'omniparser', 'caption_batch_size.json')
+# a tuned size older than this is ignored, the OOM it came from may have been another process holding memory
+DEFAULT_CACHE_TTL = 7 * 24 * 3600
+_cache_lock = threading.Lock()
+
+
+def is_oom_error(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in str(e).lower()
+
+
+def available_memory(device):
+    """Free bytes on the device, or None when it can't be measured."""
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def device_key(model):
+    device = model.device
+    if device.type == 'cuda':
+        # the same GPU model comes with different memory sizes
+        name = f"{torch.cuda.get_device_name(device)}|{torch.cuda.get_device_properties(device).total_memory}"
+    else:
+        name = device.type
+    return f"{model.config.name_or_path}|{name}"
+
+
+def load_tuned_batch_size(key, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL):
+    """The tuned batch size saved for key, None when there is none or it expired."""
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    # entries without a timestamp come from older versions and are treated as expired
+    if not isinstance(entry, dict) or (ttl is not None and time.time() - entry.get('time', 0) > ttl):
+        return None
+    return entry.get('batch_size')
+
+
+def save_tuned_batch_size(key, batch_size, cache_path=DEFAULT_CACHE_PATH):
+    """Save the tuned batch size for key, or remove the entry when batch_size is None."""
+    with _cache_lock:
+        try:
+            with open(cache_path) as f:
+                tuned = json.load(f)
+        except (OSError, ValueError):
+            tuned = {}
+        if batch_size is None:
+            tuned.pop(key, None)
+        else:
+            tuned[key] = {'batch_size': batch_size, 'time': time.time()}
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(tuned, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+
+class CaptionBatchSizer(object):
+    """Picks the caption batch size from free device memory and halves it on OOM instead of failing.
+
+    The size that last ran out of memory caps later batches and is remembered per model/device in
+    cache_path for cache_ttl seconds, so a restarted server does not hit the same OOM first. The cap
+    doubles again after grow_after full batches without OOM, and is dropped once it no longer limits
+    the size probed from free memory, so a transient OOM does not cap batching for good. Pass batch_size
+    to start from a fixed size without probing; pass cache_path=None to keep the tuning in memory only.
+    """
+
+    def __init__(self, model, batch_size=None, max_batch_size=512, min_batch_size=1, bytes_per_item=DEFAULT_BYTES_PER_ITEM, memory_fraction=0.8, cache_path=DEFAULT_CACHE_PATH, cache_ttl=DEFAULT_CACHE_TTL, grow_after=20):
+        self.device = model.device
+        self.key = device_key(model)
+        self.fixed_batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.bytes_per_item = bytes_per_item
+        self.memory_fraction = memory_fraction
+        self.cache_path = cache_path
+        self.grow_after = grow_after
+        self.batches_since_oom = 0
+        self.tuned_batch_size = load_tuned_batch_size(self.key, cache_path, cache_ttl) if cache_path else None
+        if self.tuned_batch_size:
+            print(f'caption batch size for {self.key}: {self.tuned_batch_size} (tuned)')
+
+    def memory_batch_size(self):
+        """Largest batch that fits in the currently free memory (or the fixed size), before the tuned cap."""
+        if self.fixed_batch_size:
+            batch_size = self.fixed_batch_size
+        else:
+            free = available_memory(self.device)
+            if free is None:
+                batch_size = 128
+            else:
+                batch_size = int(free * self.memory_fraction // self.bytes_per_item)
+        return max(self.min_batch_size, min(batch_size, self.max_batch_size))
+
+    def probe(self):
+        """Largest batch that fits in the currently free memory, capped by the tuned and max sizes."""
+        batch_size = self.memory_batch_size()
+        if self.tuned_batch_size:
+            batch_size = min(batch_size, self.tuned_batch_size)
+        return max(self.min_batch_size, batch_size)
+
+    def _set_tuned(self, batch_size):
+        self.tuned_batch_size = batch_size
+        self.batches_since_oom = 0
+        if self.cache_path:
+            save_tuned_batch_size(self.key, batch_size, self.cache_path)
+
+    def _grow(self):
+        """Raise the cap after grow_after full batches without OOM, drop it once free memory is the limit."""
+        self.batches_since_oom += 1
+        if not self.tuned_batch_size or self.batches_since_oom < self.grow_after:
+            return
+        batch_size = self.tuned_batch_size * 2
+        if batch_size >= self.memory_batch_size():
+            print(f'caption batch size cap of {self.tuned_batch_size} dropped, sized from free memory again')
+            self._set_tuned(None)
+        else:
+            print(f'caption batch size cap raised from {self.tuned_batch_size} to {batch_size}')
+            self._set_tuned(batch_size)
+
+    def run(self, items, fn, deadline=None):
+        """Call fn on consecutive batches of items and concatenate the returned lists, retrying smaller batches on OOM.
+
+        With a ParseDeadline, every batch first checks it, so an abandoned parse stops after the current batch.
+        """
+        batch_size = self.probe()
+        results = []
+        i = 0
+        while i < len(items):
+            if deadline is not None:
+                deadline.check(f'caption batch at crop {i}/{len(items)}')
+            batch = items[i:i+batch_size]
+            try:
+                results.extend(fn(batch))
+            except RuntimeError as e:
+                if not is_oom_error(e) or batch_size <= self.min_batch_size:
+                    raise
+                if self.device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                batch_size = max(self.min_batch_size, len(batch) // 2)
+                print(f'caption batch of {len(batch)} ran out of memory, retrying with {batch_size}')
+                self._set_tuned(batch_size)
+                continue
+            i += len(batch)
+            # a short last batch says nothing about whether the capped size still fits
+            if len(batch) == batch_size:
+                self._grow()
+        return results
+
+
+class CaptionCache(object):
+    """Captions of recently seen icon crops, keyed by the crop's pixels, so icons that stay on screen across
+    parses (taskbar, toolbars, window buttons) are captioned once. One cache belongs to one caption model
+    and prompt; max_items bounds it, least recently used crops are dropped first.
+    """
+
+    def __init__(self, max_items=4096):
+        self.max_items = max_items
+        self.captions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(crop):
+        pixels = np.asarray(crop)
+        return hashlib.md5(pixels.tobytes() + str(pixels.shape).encode()).hexdigest()
+
+    def run(self, crops, fn, batch_sizer, deadline=None):
+        """batch_sizer.run(fn) over the crops not cached yet, each distinct crop once; results for all crops in order.
+
+        fn returns (caption, generated tokens) per crop. Reused captions, from the cache or from an identical
+        crop earlier in this parse, count 0 tokens, so the token stats only show what this parse generated.
+        """
+        keys = [self.key(crop) for crop in crops]
+        results = {}
+        with self.lock:
+            for key in keys:
+                if key in self.captions:
+                    self.captions.move_to_end(key)
+                    results[key] = self.captions[key]
+        # dict keeps the first crop of every uncached key, duplicates within this parse are captioned once
+        pending = {key: crop for key, crop in zip(keys, crops) if key not in results}
+        captioned = batch_sizer.run(list(pending.values()), fn, deadline=deadline)
+        with self.lock:
+            self.hits += len(keys) - len(pending)
+            self.misses += len(pending)
+            for key, caption in zip(pending, captioned):
+                results[key] = self.captions[key] = caption
+            while len(self.captions) > self.max_items:
+                self.captions.popitem(last=False)
+        output = []
+        for key in keys:
+            if key in pending:
+                output.append(results[key])
+                del pending[key]
+            else:
+                output.append((results[key][0], 0))
+        return output
@@ -0,0 +1,155 @@
+"""
+Element diffs between consecutive parses, for describing the screen as a delta instead of the full list.
+
+Elements of the new parse are matched to the previous one by bbox IoU and content similarity and keep the
+previous element's ID, so IDs are stable across steps; the planner then only needs the added, changed and
+removed elements. A full list is sent on the first step, every `full_every` steps and when most of the
+screen changed, since a delta would not be shorter then. When the parse server tracks elements, their
+track_id is used as the stable ID as is, so the IDs also match the SoM labels.
+
+Used by the gradio agents (omnitool/gradio) and the CUA app's AIReasoner (omniparserserver/), each with
+the element line layout and headers of its own prompt.
+"""
+import math
+from difflib import SequenceMatcher
+
+from util.element_serializer import BOX_LINE, format_element, serialize_elements
+
+FULL_HEADER = "Here is the list of all detected bounding boxes by IDs on the current screen and their description (IDs stay the same across steps while an element stays on screen):\n"
+DELTA_HEADER = "Screen changes since the previous step (elements not listed are unchanged and keep their IDs):\n"
+
+
+def box_iou(a, b) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def content_similarity(a, b) -> float:
+    a, b = str(a or "").strip().lower(), str(b or "").strip().lower()
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def match_elements(previous: list, current: list, iou_threshold: float = 0.5, content_threshold: float = 0.8, max_shift: float = 0.05):
+    """
+    Greedy one-to-one matching of current to previous elements, best pairs first. A pair is a candidate when
+    the boxes overlap by iou_threshold, or when the content is similar and the box moved less than max_shift
+    (screen ratio), e.g. a list that scrolled slightly. Returns (previous index, current index) pairs.
+    """
+    candidates = []
+    for p, old in enumerate(previous):
+        for c, new in enumerate(current):
+            iou = box_iou(old["bbox"], new["bbox"])
+            if iou < iou_threshold:
+                # geometry first, the string comparison is the expensive part
+                shift = math.hypot((old["bbox"][0] + old["bbox"][2] - new["bbox"][0] - new["bbox"][2]) / 2,
+                                   (old["bbox"][1] + old["bbox"][3] - new["bbox"][1] - new["bbox"][3]) / 2)
+                if shift > max_shift:
+                    continue
+            similarity = content_similarity(old.get("content"), new.get("content"))
+            if iou >= iou_threshold or similarity >= content_threshold:
+                candidates.append((iou + similarity, p, c))
+    candidates.sort(reverse=True)
+    used_previous, used_current, pairs = set(), set(), []
+    for _, p, c in candidates:
+        if p in used_previous or c in used_current:
+            continue
+        used_previous.add(p)
+        used_current.add(c)
+        pairs.append((p, c))
+    return pairs
+
+
+class ElementDiffer:
+    """
+    Keeps the previous parse and its stable IDs; update() diffs a new parse against it. line_format and the
+    headers set how describe() writes the elements (see util.element_serializer for the line layouts).
+    """
+
+    def __init__(self, iou_threshold: float = 0.5, content_threshold: float = 0.8, full_every: int = 10, max_change_ratio: float = 0.5,
+                 line_format: str = BOX_LINE, full_header: str = FULL_HEADER, delta_header: str = DELTA_HEADER):
+        self.iou_threshold = iou_threshold
+        self.content_threshold = content_threshold
+        self.full_every = full_every
+        self.max_change_ratio = max_change_ratio
+        self.line_format = line_format
+        self.full_header = full_header
+        self.delta_header = delta_header
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.ids = []
+        self.next_id = 0
+        self.steps_since_full = 0
+
+    def update(self, elements: list) -> dict:
+        """
+        Match elements against the previous parse. Returns a dict with the stable id of every element ("ids"),
+        the indices of added/changed/unchanged elements, the removed stable ids, and whether to send the full list.
+        """
+        ids = [None] * len(elements)
+        added, changed, unchanged, removed = [], [], [], []
+        if self.previous:
+            if elements and all("track_id" in e for e in elements) and all("track_id" in e for _, e in self.previous):
+                # matched by the server already
+                positions = {e["track_id"]: p for p, (_, e) in enumerate(self.previous)}
+                pairs = [(positions[e["track_id"]], c) for c, e in enumerate(elements) if e["track_id"] in positions]
+            else:
+                pairs = match_elements([e for _, e in self.previous], elements, self.iou_threshold, self.content_threshold)
+            for p, c in pairs:
+                previous_id, previous_element = self.previous[p]
+                ids[c] = previous_id
+                same_content = content_similarity(previous_element.get("content"), elements[c].get("content")) == 1.0
+                if same_content and box_iou(previous_element["bbox"], elements[c]["bbox"]) >= 0.9:
+                    unchanged.append(c)
+                else:
+                    changed.append(c)
+            matched = {p for p, _ in pairs}
+            removed = [self.previous[p][0] for p in range(len(self.previous)) if p not in matched]
+        for c in range(len(elements)):
+            if ids[c] is None:
+                if "track_id" in elements[c]:
+                    ids[c] = elements[c]["track_id"]
+                    self.next_id = max(self.next_id, ids[c] + 1)
+                else:
+                    ids[c] = self.next_id
+                    self.next_id += 1
+                added.append(c)
+
+        changes = len(added) + len(changed) + len(removed)
+        full = self.previous is None or self.steps_since_full + 1 >= self.full_every or changes > self.max_change_ratio * max(len(elements), 1)
+        self.steps_since_full = 0 if full else self.steps_since_full + 1
+        self.previous = list(zip(ids, elements))
+        self.ids = ids
+        return {"ids": ids, "added": added, "changed": changed, "unchanged": unchanged, "removed": removed, "full": full}
+
+    def request_full(self):
+        """Send the full list on the next update, e.g. after the history holding the earlier lists was compacted."""
+        self.steps_since_full = self.full_every
+
+    def index_of(self, stable_id: int) -> int | None:
+        """Index in the latest parsed_content_list of the element with this stable id, None if it is gone."""
+        return self.ids.index(stable_id) if stable_id in self.ids else None
+
+    def describe(self, elements: list, diff: dict, token_budget: int | None = None, coordinates: bool = False) -> str:
+        """Full element list or delta text for the prompt, using the stable ids."""
+        if diff["full"]:
+            screen_info, _ = serialize_elements([dict(e, idx=i) for e, i in zip(elements, diff["ids"])], token_budget,
+                                                coordinates=coordinates, line_format=self.line_format)
+            return self.full_header + screen_info
+        text = self.delta_header
+        if diff["added"]:
+            text += "Added:\n" + "".join(format_element(elements[c], diff["ids"][c], coordinates, self.line_format) + "\n" for c in diff["added"])
+        if diff["changed"]:
+            text += "Changed (now):\n" + "".join(format_element(elements[c], diff["ids"][c], coordinates, self.line_format) + "\n" for c in diff["changed"])
+        if diff["removed"]:
+            text += "Removed IDs: " + ", ".join(str(i) for i in sorted(diff["removed"])) + "\n"
+        if not (diff["added"] or diff["changed"] or diff["removed"]):
+            text += "No changes.\n"
+        text += f"{len(diff['unchanged'])} elements unchanged.\n"
+        return text
@@ -0,0 +1,91 @@
+"""
+Token-budgeted serialization of the parsed screen elements for planner prompts, used by the gradio agents
+(omnitool/gradio) and the CUA app's AIReasoner (omniparserserver/).
+
+Busy screens produce hundreds of elements; serialize_elements keeps the most useful ones (OCR text,
+confident and interactive icons, elements near the last action) within a token budget. Elements keep
+their original IDs (the server's track_id when the parse was tracked, otherwise the list index), and
+element_index maps the ID the model answers with back to parsed_content_list.
+"""
+import math
+
+CHARS_PER_TOKEN = 4
+MAX_CONTENT_CHARS = 80
+
+# line layouts of the two apps' prompts: the gradio planner's "ID: 3, Text: ..." and the CUA reasoner's "Element 3: ..."
+BOX_LINE = "ID: {id}, {kind}: {content}"
+ELEMENT_LINE = "Element {id}: {content}"
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough local token count (~4 characters per token for English/BPE tokenizers), no tokenizer needed."""
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def element_center(element: dict):
+    x1, y1, x2, y2 = element["bbox"]
+    return (x1 + x2) / 2, (y1 + y2) / 2
+
+
+def element_id(element: dict, idx: int) -> int:
+    """ID shown to the model: the persistent track_id when the server tracks elements, else the list index."""
+    return element.get("track_id", element.get("idx", idx))
+
+
+def element_index(elements: list, box_id: int) -> int | None:
+    """Position in parsed_content_list of the element the model referred to by ID, None if no element has it."""
+    if elements and "track_id" in elements[0]:
+        return next((i for i, element in enumerate(elements) if element["track_id"] == box_id), None)
+    return box_id if 0 <= box_id < len(elements) else None
+
+
+def element_priority(element: dict, last_action_point: tuple | None = None) -> float:
+    """Higher is kept first: OCR text, then confident/interactive icons, boosted near the last action."""
+    if element.get("type") == "text":
+        priority = 2.0
+    else:
+        priority = 1.0 + element.get("conf", 0.5)
+    if element.get("interactivity"):
+        priority += 0.5
+    if last_action_point is not None and element.get("bbox") is not None:
+        x, y = element_center(element)
+        distance = math.hypot(x - last_action_point[0], y - last_action_point[1])
+        # bbox coordinates are screen ratios, so this fades out over roughly a tenth of the screen
+        priority += 1.0 / (1.0 + 10 * distance)
+    return priority
+
+
+def format_element(element: dict, idx: int, coordinates: bool = False, line_format: str = BOX_LINE) -> str:
+    content = str(element.get("content") or "").strip().replace("\n", " ")
+    if len(content) > MAX_CONTENT_CHARS:
+        content = content[:MAX_CONTENT_CHARS - 3] + "..."
+    kind = "Text" if element.get("type") == "text" else "Icon"
+    line = line_format.format(id=idx, kind=kind, content=content)
+    if coordinates and element.get("bbox") is not None:
+        # center as integer percentages of the screen, much shorter than the four float bbox values
+        x, y = element_center(element)
+        line += f" @{round(x * 100)},{round(y * 100)}"
+    return line
+
+
+def serialize_elements(elements: list, token_budget: int | None = None, last_action_point: tuple | None = None,
+                       coordinates: bool = False, line_format: str = BOX_LINE):
+    """
+    Serialize elements as one line each within token_budget (None keeps all of them).
+    Returns (text, stats) where stats has total/kept element counts and the estimated tokens.
+    """
+    lines = {}
+    for idx, element in enumerate(elements):
+        lines[element_id(element, idx)] = (format_element(element, element_id(element, idx), coordinates, line_format), element)
+    order = sorted(lines, key=lambda i: element_priority(lines[i][1], last_action_point), reverse=True)
+    kept, tokens = [], 0
+    for i in order:
+        line_tokens = estimate_tokens(lines[i][0]) + 1
+        if token_budget is not None and tokens + line_tokens > token_budget:
+            continue
+        kept.append(i)
+        tokens += line_tokens
+    # back to ID order, which follows the parser's reading order
+    text = "".join(lines[i][0] + "\n" for i in sorted(kept))
+    stats = {"total": len(elements), "kept": len(kept), "tokens": tokens, "budget": token_budget}
+    return text, stats
@@ -0,0 +1,130 @@
+import threading
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# cost of a pair that fails the IoU / content gate, never part of an accepted match
+NO_MATCH = 1e6
+
+
+def pairwise_iou(a, b):
+    """IoU matrix between two (N, 4) / (M, 4) xyxy box arrays."""
+    ix = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    iy = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    intersection = ix * iy
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.0)
+
+
+def content_similarity(a, b):
+    a, b = str(a or '').strip().lower(), str(b or '').strip().lower()
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def assign_pairs(cost):
+    """Minimum cost one-to-one assignment, Hungarian when scipy is installed and greedy otherwise."""
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(cost)
+        return [(r, c) for r, c in zip(rows.tolist(), cols.tolist()) if cost[r, c] < NO_MATCH]
+    order = np.argsort(cost, axis=None)
+    used_rows, used_cols, pairs = set(), set(), []
+    for flat in order.tolist():
+        r, c = divmod(flat, cost.shape[1])
+        if cost[r, c] >= NO_MATCH:
+            break
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        pairs.append((r, c))
+    return pairs
+
+
+class ElementTracker:
+    """
+    Persistent element ids across the parses of one screen session. Each new element is matched to the
+    tracked elements of the previous parses by bbox IoU and caption/OCR similarity and keeps their track_id;
+    unmatched elements get a new one. Tracks that miss a few parses (e.g. a flickering tooltip or an OCR
+    miss) stay matchable for max_missed parses before their id is retired.
+    """
+    def __init__(self, iou_threshold=0.3, content_threshold=0.8, max_shift=0.05, max_missed=2):
+        self.iou_threshold = iou_threshold
+        self.content_threshold = content_threshold
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def match_cost(self, elements):
+        boxes = np.array([e['bbox'] for e in elements], dtype=np.float64).reshape(-1, 4)
+        track_boxes = np.array([t['bbox'] for t in self.tracks], dtype=np.float64).reshape(-1, 4)
+        iou = pairwise_iou(track_boxes, boxes)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        shift = np.linalg.norm(track_centers[:, None, :] - centers[None, :, :], axis=-1)
+        cost = np.full(iou.shape, NO_MATCH)
+        # content is only compared for boxes that overlap or barely moved, the string comparison is the slow part
+        for t, e in zip(*np.nonzero((iou >= self.iou_threshold) | (shift <= self.max_shift))):
+            if self.tracks[t]['type'] != elements[e].get('type'):
+                continue
+            similarity = content_similarity(self.tracks[t]['content'], elements[e].get('content'))
+            if iou[t, e] >= self.iou_threshold or similarity >= self.content_threshold:
+                cost[t, e] = 2.0 - iou[t, e] - similarity
+        return cost
+
+    def assign(self, elements):
+        """Set 'track_id' on every element (in place) and return the elements."""
+        with self.lock:
+            matched = {}
+            if self.tracks and elements:
+                for t, e in assign_pairs(self.match_cost(elements)):
+                    matched[e] = t
+            seen = set()
+            for e, element in enumerate(elements):
+                if e in matched:
+                    track = self.tracks[matched[e]]
+                    track.update(bbox=list(element['bbox']), content=element.get('content'), missed=0)
+                    seen.add(matched[e])
+                else:
+                    track = {'track_id': self.next_id, 'bbox': list(element['bbox']), 'content': element.get('content'), 'type': element.get('type'), 'missed': 0}
+                    self.next_id += 1
+                    self.tracks.append(track)
+                    seen.add(len(self.tracks) - 1)
+                element['track_id'] = track['track_id']
+            for t, track in enumerate(self.tracks):
+                if t not in seen:
+                    track['missed'] += 1
+            self.tracks = [t for t in self.tracks if t['missed'] <= self.max_missed]
+        return elements
+
+
+class ElementTrackerRegistry:
+    """One ElementTracker per client session id, least recently used sessions are dropped past max_sessions."""
+    def __init__(self, max_sessions=64, **tracker_args):
+        self.max_sessions = max_sessions
+        self.tracker_args = tracker_args
+        self.trackers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            tracker = self.trackers.pop(session_id, None) or ElementTracker(**self.tracker_args)
+            self.trackers[session_id] = tracker
+            while len(self.trackers) > self.max_sessions:
+                self.trackers.popitem(last=False)
+            return tracker
+
+    def reset(self, session_id):
+        with self.lock:
+            self.trackers.pop(session_id, None)
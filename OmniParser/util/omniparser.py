@@ -1,4 +1,7 @@
 from util.utils import get_som_labeled_img, get_caption_model_processor, get_yolo_model, check_ocr_box
+from util.caption_batcher import CaptionBatchSizer, CaptionCache, DEFAULT_CACHE_PATH
+from util.element_tracker import ElementTrackerRegistry
+from util.parse_deadline import ParseDeadline
 import torch
 from PIL import Image
 import io
@@ -11,9 +14,26 @@ class Omniparser(object):
 
         self.som_model = get_yolo_model(model_path=config['som_model_path'])
         self.caption_model_processor = get_caption_model_processor(model_name=config['caption_model_name'], model_name_or_path=config['caption_model_path'], device=device)
+        # 'auto' sizes caption batches from free memory and remembers the size that fits across restarts
+        batch_size = config.get('caption_batch_size', 128)
+        if batch_size == 'auto':
+            self.caption_batch_size = 128
+            self.caption_batch_sizer = CaptionBatchSizer(self.caption_model_processor['model'], cache_path=config.get('batch_size_cache') or DEFAULT_CACHE_PATH)
+        else:
+            self.caption_batch_size = int(batch_size)
+            self.caption_batch_sizer = CaptionBatchSizer(self.caption_model_processor['model'], batch_size=self.caption_batch_size, cache_path=None)
+        # captions of recently seen icon crops, reused across parses; 0 turns the cache off
+        caption_cache_size = config.get('caption_cache_size', 4096)
+        self.caption_cache = CaptionCache(max_items=caption_cache_size) if caption_cache_size else None
+        # per-session element trackers, parses with a session_id get persistent track_ids
+        self.element_trackers = ElementTrackerRegistry()
         print('Omniparser initialized!!!')
 
-    def parse(self, image_base64: str):
+    def parse(self, image_base64: str, session_id: str = None, deadline: ParseDeadline = None):
+        """SoM image and elements of the screenshot. With a deadline the parse stops between stages once it
+        is cancelled or expired, raising ParseCancelled."""
+        if deadline is not None:
+            deadline.check('ocr')
         image_bytes = base64.b64decode(image_base64)
         image = Image.open(io.BytesIO(image_bytes))
         print('image size:', image.size)
@@ -27,6 +47,6 @@ class Omniparser(object):
         }
 
         (text, ocr_bbox), _ = check_ocr_box(image, display_img=False, output_bb_format='xyxy', easyocr_args={'text_threshold': 0.8}, use_paddleocr=False)
-        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image, self.som_model, BOX_TRESHOLD = self.config['BOX_TRESHOLD'], output_coord_in_ratio=True, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=self.caption_model_processor, ocr_text=text,use_local_semantics=True, iou_threshold=0.7, scale_img=False, batch_size=128)
+        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image, self.som_model, BOX_TRESHOLD = self.config['BOX_TRESHOLD'], output_coord_in_ratio=True, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=self.caption_model_processor, ocr_text=text,use_local_semantics=True, iou_threshold=0.7, scale_img=False, batch_size=self.caption_batch_size, batch_sizer=self.caption_batch_sizer, caption_preset=self.config.get('caption_preset'), caption_skip_policy=self.config.get('caption_skip_policy'), max_elements=self.config.get('max_elements'), score_budget=self.config.get('score_budget'), element_tracker=self.element_trackers.get(session_id) if session_id else None, deadline=deadline, caption_cache=self.caption_cache)
 
         return dino_labled_img, parsed_content_list
\ No newline at end of file
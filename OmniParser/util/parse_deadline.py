@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+
+class ParseCancelled(Exception):
+    """Raised between pipeline stages when nobody is waiting for the parse any more."""
+
+
+class ParseDeadlineExceeded(Exception):
+    """The parse did not finish before the caller's deadline; another replica would not make it in time either."""
+
+
+def parse_response_json(response) -> dict:
+    """
+    JSON of a /parse/ response (requests or httpx). The server answers 504 when it dropped the parse because
+    its deadline passed, raised as ParseDeadlineExceeded; other error statuses raise ValueError.
+    """
+    if response.status_code == 504:
+        raise ParseDeadlineExceeded(f"HTTP 504: {response.text[:200]}")
+    if response.status_code != 200:
+        raise ValueError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+
+class ParseDeadline(object):
+    """Deadline and cancellation flag of one parse request, checked between the pipeline's stages.
+
+    timeout is the time in seconds the client waits for the result, counted from when the request
+    arrived; None means no deadline. cancel() is called from another thread, e.g. when the client
+    disconnects, and takes effect at the next check.
+    """
+
+    def __init__(self, timeout=None):
+        self.start = time.time()
+        self.deadline = self.start + timeout if timeout else None
+        self.cancelled = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason='cancelled'):
+        self.reason = reason
+        self.cancelled.set()
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def check(self, stage):
+        """Raise ParseCancelled if the parse was cancelled or its deadline passed before this stage."""
+        if self.cancelled.is_set():
+            raise ParseCancelled(f'{self.reason} before {stage}')
+        if self.expired():
+            raise ParseCancelled(f'deadline passed {time.time() - self.deadline:.2f}s ago, before {stage}')
+
+
+async def acquire_before(lock, deadline):
+    """Acquire an asyncio lock unless deadline (a ParseDeadline) passes first; True if it was acquired.
+
+    asyncio.wait_for(lock.acquire(), timeout) on Python < 3.12 can time out just as the acquire
+    succeeds, and the lock then stays held with nobody to release it. Here an abandoned acquire
+    always releases the lock if it got it after all, also when the caller itself is cancelled.
+    """
+    if deadline.deadline is None:
+        await lock.acquire()
+        return True
+    acquire = asyncio.ensure_future(lock.acquire())
+    try:
+        await asyncio.wait({acquire}, timeout=max(0.0, deadline.deadline - time.time()))
+    except BaseException:
+        _abandon(acquire, lock)
+        raise
+    if acquire.done():
+        return acquire.result()
+    _abandon(acquire, lock)
+    return False
+
+
+def _abandon(acquire, lock):
+    """Cancel a lock.acquire() task nobody waits for, releasing the lock if it got it anyway."""
+    acquire.cancel()
+    acquire.add_done_callback(lambda task: _release_if_acquired(task, lock))
+
+
+def _release_if_acquired(task, lock):
+    if not task.cancelled() and task.exception() is None:
+        lock.release()
@@ -0,0 +1,254 @@
+"""
+Client-side load balancing over several OmniParser servers, used by the omnitool agents
+(omnitool/gradio) and the CUA app's ScreenParser (omniparserserver/).
+
+A parse goes to the replica with the least outstanding work: the parses this process has in flight there,
+or the queue depth the server last reported on /probe/ if that is higher. A failed parse is retried on
+another replica, and a parse that takes longer than the usual tail latency is hedged with a second copy
+on an idle replica, whichever answers first is used.
+
+Parses with a session_id stay on one replica, since the element tracker of the session lives there. They
+move only when that replica fails, and are never hedged (a second copy would advance another tracker).
+
+Every parse() has one deadline for all its attempts. Each request tells the server the time that is left
+(the server drops the parse once it passes) and waits no longer than that itself; a parse that ran out of
+time is not retried.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+
+from util.parse_deadline import ParseDeadlineExceeded, parse_response_json
+
+
+class ParserReplica:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.queue_depth = 0
+        self.down_until = 0.0
+        self.parses = 0
+        self.latencies = deque(maxlen=50)
+
+    @property
+    def available(self) -> bool:
+        return time.time() >= self.down_until
+
+    def load(self) -> int:
+        # the server's queue includes this process's parses, so the larger of the two is the best guess
+        return max(self.outstanding, self.queue_depth)
+
+    def mean_latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+
+class ParserPool:
+    """
+    Parse requests over the replicas in urls (base urls such as http://10.0.0.2:8000). `http` is anything
+    with requests-style get/post (a requests.Session, omnitool's http_pool), a new session if omitted.
+    hedge_after: seconds before a parse is hedged, None to use the hedge_quantile of recent parse latencies
+    (at least min_hedge_after, and only once hedge_samples latencies were seen). hedge=False disables it.
+    """
+
+    def __init__(self, urls: list, http=None, retries: int = 2, timeout: float = 60.0, hedge: bool = True,
+                 hedge_after: float | None = None, hedge_quantile: float = 0.95, hedge_samples: int = 20, min_hedge_after: float = 0.2,
+                 probe_interval: float = 1.0, probe_timeout: float = 1.0, cooldown: float = 5.0):
+        if not urls:
+            raise ValueError("at least one parse server url is needed")
+        self.replicas = [ParserReplica(url) for url in urls]
+        self.http = http or requests.Session()
+        self.retries = retries
+        self.timeout = timeout
+        self.hedge = hedge and len(self.replicas) > 1
+        self.hedge_after = hedge_after
+        self.hedge_quantile = hedge_quantile
+        self.hedge_samples = hedge_samples
+        self.min_hedge_after = min_hedge_after
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.cooldown = cooldown
+        self.sessions = {}
+        self.recent_latencies = deque(maxlen=200)
+        self.stats = {"parses": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(self.replicas), thread_name_prefix="parser-pool")
+        self.stopped = threading.Event()
+        self.probe_thread = None
+
+    def start(self):
+        """Start probing the replicas in the background; parse() calls it on first use."""
+        with self.lock:
+            if self.probe_thread is not None and not self.stopped.is_set():
+                return self
+            self.stopped.clear()
+            self.probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+        # the first round runs here, so the first parses already skip replicas that are down
+        self.probe_all()
+        self.probe_thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _probe_loop(self):
+        while not self.stopped.wait(self.probe_interval):
+            self.probe_all()
+
+    def probe_all(self):
+        for replica in self.replicas:
+            try:
+                response = self.http.get(f"{replica.url}/probe/", timeout=self.probe_timeout)
+                if response.status_code != 200:
+                    raise ValueError(f"HTTP {response.status_code}")
+                with self.lock:
+                    # servers without a queue_depth report only whether they are up
+                    replica.queue_depth = int(response.json().get("queue_depth", 0))
+                    replica.down_until = 0.0
+            except Exception as e:
+                with self.lock:
+                    if replica.available:
+                        print(f"parse server {replica.url} is down: {e}")
+                    replica.down_until = time.time() + self.cooldown
+
+    def pick(self, exclude: set = frozenset(), session_id: str | None = None) -> ParserReplica | None:
+        """Least loaded available replica not in exclude, the session's replica while it is usable."""
+        with self.lock:
+            if session_id is not None:
+                pinned = self.sessions.get(session_id)
+                if pinned is not None and pinned.available and pinned.url not in exclude:
+                    return pinned
+            candidates = [r for r in self.replicas if r.url not in exclude]
+            if not candidates:
+                return None
+            # when every replica looks down, still try one rather than failing without a request
+            available = [r for r in candidates if r.available] or candidates
+            replica = min(available, key=lambda r: (r.load(), r.mean_latency()))
+            if session_id is not None:
+                if session_id in self.sessions and self.sessions[session_id] is not replica:
+                    print(f"parse session {session_id} moved to {replica.url}, its element ids restart there")
+                self.sessions[session_id] = replica
+            return replica
+
+    def hedge_delay(self) -> float | None:
+        if self.hedge_after is not None:
+            return self.hedge_after
+        with self.lock:
+            latencies = sorted(self.recent_latencies)
+        if len(latencies) < self.hedge_samples:
+            return None
+        return max(self.min_hedge_after, latencies[min(len(latencies) - 1, int(self.hedge_quantile * len(latencies)))])
+
+    def parse(self, payload: dict) -> dict:
+        """
+        POST payload to /parse/ on the best replica and return the response json, with retries and hedging.
+        The whole call takes at most self.timeout seconds, or payload["timeout"] if that is shorter.
+        """
+        if self.probe_thread is None:
+            self.start()
+        deadline = time.time() + min(payload.get("timeout") or self.timeout, self.timeout)
+        session_id = payload.get("session_id")
+        tried, last_error = set(), None
+        for attempt in range(self.retries + 1):
+            if time.time() >= deadline:
+                break
+            replica = self.pick(tried, session_id)
+            if replica is None:
+                break
+            tried.add(replica.url)
+            if attempt:
+                self._count("retries")
+            try:
+                if self.hedge and session_id is None:
+                    result = self._hedged(replica, payload, tried, deadline)
+                else:
+                    result = self._request(replica, payload, deadline)
+                self._count("parses")
+                return result
+            except ParseDeadlineExceeded as e:
+                print(f"parse on {replica.url} ran out of time: {e}")
+                self._count("failures")
+                raise
+            except Exception as e:
+                last_error = e
+                print(f"parse on {replica.url} failed: {e}")
+        self._count("failures")
+        raise RuntimeError(f"parse failed on {len(tried)} of {len(self.replicas)} parse servers: {last_error}")
+
+    def _hedged(self, replica: ParserReplica, payload: dict, tried: set, deadline: float) -> dict:
+        """Run the parse on replica; past the hedge delay, also on the next best one and take the first answer."""
+        delay = self.hedge_delay()
+        primary = self.executor.submit(self._request, replica, payload, deadline)
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        backup_replica = self.pick(tried)
+        # a hedge on a busy replica would only queue behind its parses and slow those down
+        if backup_replica is None or not backup_replica.available or backup_replica.load() > 0:
+            return primary.result()
+        tried.add(backup_replica.url)
+        self._count("hedges")
+        backup = self.executor.submit(self._request, backup_replica, payload, deadline)
+        pending, error = {primary, backup}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self._count("hedge_wins")
+                    # the slower copy keeps running on its server, its result is dropped
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _request(self, replica: ParserReplica, payload: dict, deadline: float) -> dict:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ParseDeadlineExceeded("deadline passed before the request was sent")
+        with self.lock:
+            replica.outstanding += 1
+        start = time.time()
+        try:
+            # the server gets the same budget, so it drops the parse when this request stops waiting for it
+            response = self.http.post(f"{replica.url}/parse/", json=dict(payload, timeout=remaining), timeout=remaining)
+        except requests.Timeout:
+            # slow, not down; a probe takes it out if it stopped answering
+            raise ParseDeadlineExceeded(f"no answer within {remaining:.1f}s")
+        except Exception:
+            self._mark_down(replica)
+            raise
+        finally:
+            with self.lock:
+                replica.outstanding -= 1
+                # the last probe may have counted this parse, the server's queue is one shorter now
+                replica.queue_depth = max(0, replica.queue_depth - 1)
+        # a server error takes the replica out until a probe finds it up again, a rejected request does not;
+        # neither does a 504, the server dropped the parse because the deadline passed and is itself fine
+        if response.status_code >= 500 and response.status_code != 504:
+            self._mark_down(replica)
+        result = parse_response_json(response)
+        latency = time.time() - start
+        with self.lock:
+            replica.parses += 1
+            replica.latencies.append(latency)
+            self.recent_latencies.append(latency)
+        return result
+
+    def _mark_down(self, replica: ParserReplica):
+        with self.lock:
+            replica.down_until = time.time() + self.cooldown
+
+    def _count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            replicas = {r.url: {"outstanding": r.outstanding, "queue_depth": r.queue_depth, "available": r.available,
+                                "parses": r.parses, "mean_latency": r.mean_latency()} for r in self.replicas}
+        return dict(self.stats, replicas=replicas)
+
@@ -27,6 +27,7 @@ paddle_ocr = PaddleOCR(
 
 import time
 import base64
+import hashlib
 
 import os
 import ast
@@ -38,6 +39,7 @@ from torchvision.transforms import ToPILImage
 import supervision as sv
 import torchvision.transforms as T
 from util.box_annotator import BoxAnnotator 
+from util.caption_batcher import CaptionBatchSizer
 
 
 def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None):
@@ -71,9 +73,50 @@ def get_yolo_model(model_path):
     return model
 
 
+# generation settings for icon captioning, picked per deployment with the `caption_preset` config key.
+# huggingface generate already ends a batch once every row has produced eos, so tight max_new_tokens
+# and few beams are what bound the wasted decode steps on short captions.
+CAPTION_GENERATION_PRESETS = {
+    'greedy': {'max_new_tokens': 20, 'num_beams': 1, 'do_sample': False},
+    'greedy_short': {'max_new_tokens': 10, 'num_beams': 1, 'do_sample': False},
+    'beam': {'max_new_tokens': 20, 'num_beams': 3, 'no_repeat_ngram_size': 2, 'early_stopping': True, 'do_sample': False},
+    'blip2_beam': {'max_length': 100, 'num_beams': 5, 'no_repeat_ngram_size': 2, 'early_stopping': True, 'num_return_sequences': 1},
+}
+
+
+def get_caption_generation_args(model, preset=None):
+    """Resolve a preset name (or a dict of generate kwargs) into generate kwargs, defaulting per model family."""
+    if preset is None:
+        preset = 'greedy' if 'florence' in model.config.name_or_path else 'blip2_beam'
+    if isinstance(preset, dict):
+        return dict(preset)
+    if preset not in CAPTION_GENERATION_PRESETS:
+        raise ValueError(f"Unknown caption preset {preset}, expected one of {list(CAPTION_GENERATION_PRESETS)}")
+    return dict(CAPTION_GENERATION_PRESETS[preset])
+
+
+def count_generated_tokens(generated_ids, tokenizer):
+    """Number of non-special tokens in each generated row, i.e. the decode steps that produced caption text."""
+    special_ids = torch.tensor(tokenizer.all_special_ids, device=generated_ids.device)
+    return (~torch.isin(generated_ids, special_ids)).sum(dim=1).tolist()
+
+
+def run_caption_batches(crops, caption_batch, batch_sizer, caption_cache=None, deadline=None):
+    """(caption, tokens) per crop, through the caption cache when there is one."""
+    if caption_cache is None:
+        return batch_sizer.run(crops, caption_batch, deadline=deadline)
+    captions = caption_cache.run(crops, caption_batch, batch_sizer, deadline=deadline)
+    print(f'caption cache: {caption_cache.hits} crops reused, {caption_cache.misses} captioned so far')
+    return captions
+
+
 @torch.inference_mode()
-def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128):
+def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128, generation_preset=None, caption_stats=None, batch_sizer=None, deadline=None, caption_cache=None):
     # Number of samples per batch, --> 128 roughly takes 4 GB of GPU memory for florence v2 model
+    # batch_sizer: optional CaptionBatchSizer picking the batch size from free memory, overrides batch_size
+    # caption_stats: optional dict, filled with 'tokens_per_crop' and 'batch_latency' for reporting
+    # deadline: optional ParseDeadline, checked before every caption batch
+    # caption_cache: optional CaptionCache, crops captioned in earlier parses are not sent to the model again
     to_pil = ToPILImage()
     if starting_idx:
         non_ocr_boxes = filtered_boxes[starting_idx:]
@@ -96,33 +139,50 @@ def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_
             prompt = "<CAPTION>"
         else:
             prompt = "The image shows"
-    
-    generated_texts = []
+    generation_args = get_caption_generation_args(model, generation_preset)
+
+    batch_latency = []
     device = model.device
-    for i in range(0, len(croped_pil_image), batch_size):
+
+    def caption_batch(batch):
         start = time.time()
-        batch = croped_pil_image[i:i+batch_size]
-        t1 = time.time()
         if model.device.type == 'cuda':
             inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt", do_resize=False).to(device=device, dtype=torch.float16)
         else:
             inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
         if 'florence' in model.config.name_or_path:
-            generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"],max_new_tokens=20,num_beams=1, do_sample=False)
+            generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"], **generation_args)
         else:
-            generated_ids = model.generate(**inputs, max_length=100, num_beams=5, no_repeat_ngram_size=2, early_stopping=True, num_return_sequences=1) # temperature=0.01, do_sample=True,
+            generated_ids = model.generate(**inputs, **generation_args) # temperature=0.01, do_sample=True,
+        tokens = count_generated_tokens(generated_ids, processor.tokenizer)
         generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
         generated_text = [gen.strip() for gen in generated_text]
-        generated_texts.extend(generated_text)
-    
+        batch_latency.append(time.time() - start)
+        return list(zip(generated_text, tokens))
+
+    if batch_sizer is None:
+        # fixed size, still halved for this call if it runs out of memory
+        batch_sizer = CaptionBatchSizer(model, batch_size=batch_size, cache_path=None)
+    captions = run_caption_batches(croped_pil_image, caption_batch, batch_sizer, caption_cache, deadline)
+    generated_texts = [text for text, _ in captions]
+    tokens_per_crop = [tokens for _, tokens in captions]
+
+    if caption_stats is not None:
+        caption_stats['tokens_per_crop'] = tokens_per_crop
+        caption_stats['batch_latency'] = batch_latency
+    if tokens_per_crop:
+        print(f'caption tokens: {sum(tokens_per_crop)} over {len(tokens_per_crop)} crops, max {max(tokens_per_crop)}, batches: {len(batch_latency)}')
     return generated_texts
 
 
 
-def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor):
+@torch.inference_mode()
+def get_parsed_content_icon_phi3v(filtered_boxes, starting_idx, image_source, caption_model_processor, batch_size=32, caption_stats=None, batch_sizer=None, max_new_tokens=25, deadline=None, caption_cache=None):
+    # caption_stats / batch_sizer / deadline / caption_cache: same reporting, memory-bounded batching, cancellation
+    # and crop caching as get_parsed_content_icon
     to_pil = ToPILImage()
-    if ocr_bbox:
-        non_ocr_boxes = filtered_boxes[len(ocr_bbox):]
+    if starting_idx:
+        non_ocr_boxes = filtered_boxes[starting_idx:]
     else:
         non_ocr_boxes = filtered_boxes
     croped_pil_image = []
@@ -133,42 +193,55 @@ def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, captio
         croped_pil_image.append(to_pil(cropped_image))
 
     model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    tokenizer = processor.tokenizer
     device = model.device
     messages = [{"role": "user", "content": "<|image_1|>\ndescribe the icon in one sentence"}] 
     prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-
-    batch_size = 5  # Number of samples per batch
-    generated_texts = []
-
-    for i in range(0, len(croped_pil_image), batch_size):
-        images = croped_pil_image[i:i+batch_size]
-        image_inputs = [processor.image_processor(x, return_tensors="pt") for x in images]
-        inputs ={'input_ids': [], 'attention_mask': [], 'pixel_values': [], 'image_sizes': []}
-        texts = [prompt] * len(images)
-        for i, txt in enumerate(texts):
-            input = processor._convert_images_texts_to_inputs(image_inputs[i], txt, return_tensors="pt")
-            inputs['input_ids'].append(input['input_ids'])
-            inputs['attention_mask'].append(input['attention_mask'])
-            inputs['pixel_values'].append(input['pixel_values'])
-            inputs['image_sizes'].append(input['image_sizes'])
-        max_len = max([x.shape[1] for x in inputs['input_ids']])
-        for i, v in enumerate(inputs['input_ids']):
-            inputs['input_ids'][i] = torch.cat([processor.tokenizer.pad_token_id * torch.ones(1, max_len - v.shape[1], dtype=torch.long), v], dim=1)
-            inputs['attention_mask'][i] = torch.cat([torch.zeros(1, max_len - v.shape[1], dtype=torch.long), inputs['attention_mask'][i]], dim=1)
-        inputs_cat = {k: torch.concatenate(v).to(device) for k, v in inputs.items()}
-
-        generation_args = { 
-            "max_new_tokens": 25, 
-            "temperature": 0.01, 
-            "do_sample": False, 
-        } 
-        generate_ids = model.generate(**inputs_cat, eos_token_id=processor.tokenizer.eos_token_id, **generation_args) 
-        # # remove input tokens 
-        generate_ids = generate_ids[:, inputs_cat['input_ids'].shape[1]:]
+    # tokenized once; every row is the same prompt with its own image's placeholder tokens where the tag was,
+    # which is what the processor builds for a single prompt (one BOS, image 1 as -1 ids)
+    prefix_ids, suffix_ids = [tokenizer(chunk, add_special_tokens=False).input_ids for chunk in prompt.split('<|image_1|>')]
+    if getattr(tokenizer, 'add_bos_token', False) and tokenizer.bos_token_id is not None:
+        prefix_ids = [tokenizer.bos_token_id] + prefix_ids
+
+    batch_latency = []
+    def caption_batch(batch):
+        start = time.time()
+        # one image processor call for the whole batch, it pads every image to the same number of crops
+        images = processor.image_processor(batch, return_tensors="pt")
+        rows = [prefix_ids + [-1] * int(num_tokens) + suffix_ids for num_tokens in images['num_img_tokens']]
+        # generation continues from the end of every row, so shorter prompts are padded on the left;
+        # the tokenizer is shared with the processor's other users, so only for this call
+        padding_side, tokenizer.padding_side = tokenizer.padding_side, 'left'
+        try:
+            padded = tokenizer.pad({'input_ids': rows}, padding=True, return_tensors="pt")
+        finally:
+            tokenizer.padding_side = padding_side
+        max_len = padded['input_ids'].shape[1]
+
+        generate_ids = model.generate(
+            input_ids=padded['input_ids'].to(device),
+            attention_mask=padded['attention_mask'].to(device),
+            pixel_values=images['pixel_values'].to(device),
+            image_sizes=images['image_sizes'].to(device),
+            eos_token_id=tokenizer.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+        )
+        # remove input tokens 
+        generate_ids = generate_ids[:, max_len:]
+        tokens = count_generated_tokens(generate_ids, tokenizer)
         response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
         response = [res.strip('\n').strip() for res in response]
-        generated_texts.extend(response)
-
+        batch_latency.append(time.time() - start)
+        return list(zip(response, tokens))
+
+    if batch_sizer is None:
+        batch_sizer = CaptionBatchSizer(model, batch_size=batch_size, cache_path=None)
+    captions = run_caption_batches(croped_pil_image, caption_batch, batch_sizer, caption_cache, deadline)
+    generated_texts = [text for text, _ in captions]
+    if caption_stats is not None:
+        caption_stats['tokens_per_crop'] = [tokens for _, tokens in captions]
+        caption_stats['batch_latency'] = batch_latency
     return generated_texts
 
 def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
@@ -297,14 +370,149 @@ def remove_overlap_new(boxes, iou_threshold, ocr_bbox=None):
                             continue
                 if not box_added:
                     if ocr_labels:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr', 'conf': box1_elem.get('conf')})
                     else:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo', 'conf': box1_elem.get('conf')})
             else:
-                filtered_boxes.append(box1)
+                filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo', 'conf': box1_elem.get('conf')})
     return filtered_boxes # torch.tensor(filtered_boxes)
 
 
+# per-box rules deciding whether an icon needs the caption model, every rule is off unless set
+DEFAULT_CAPTION_SKIP_POLICY = {
+    'min_area': 0,              # icons smaller than this many pixels are not captioned
+    'min_confidence': None,     # icons detected below this yolo confidence are not captioned
+    'ocr_coverage': None,       # icons whose area is covered by ocr text at least this much reuse that text
+    'dedupe_crops': False,      # icons with pixel-identical crops are captioned once
+    'nested_in_parent': None,   # icons inside a larger captioned icon by at least this ratio reuse its caption
+}
+
+
+def apply_caption_skip_policy(boxes_elem, image_source, policy=None):
+    '''
+    Decide per icon box whether it needs the caption model, before any captioning happens.
+    Skipped boxes get 'caption_skip_reason' and a non-None content so they are not sent to the model.
+
+    returns [(box_elem, source_elem), ...] for boxes that should copy the caption of source_elem once captioned
+    '''
+    policy = {**DEFAULT_CAPTION_SKIP_POLICY, **(policy or {})}
+    h, w = image_source.shape[:2]
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def crop_key(box):
+        xmin, xmax = int(box[0]*w), int(box[2]*w)
+        ymin, ymax = int(box[1]*h), int(box[3]*h)
+        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
+        if cropped_image.size == 0:
+            return None
+        # same 64x64 view the florence captioner sees
+        return hashlib.md5(cv2.resize(cropped_image, (64, 64)).tobytes()).hexdigest()
+
+    text_boxes = [elem for elem in boxes_elem if elem['type'] == 'text']
+    pending = [elem for elem in boxes_elem if elem['content'] is None]
+    # larger boxes first, so a parent is always decided before the boxes nested in it
+    pending = sorted(pending, key=lambda elem: box_area(elem['bbox']), reverse=True)
+    shared_captions = []
+    captioned = []
+    seen_crops = {}
+    for elem in pending:
+        box = elem['bbox']
+        area = box_area(box)
+        if area * w * h < policy['min_area']:
+            elem['caption_skip_reason'] = 'min_area'
+            elem['content'] = ''
+            continue
+        if policy['min_confidence'] is not None and elem.get('conf') is not None and elem['conf'] < policy['min_confidence']:
+            elem['caption_skip_reason'] = 'low_confidence'
+            elem['content'] = ''
+            continue
+        if policy['ocr_coverage'] is not None and area > 0:
+            overlapping = [t for t in text_boxes if intersection_area(box, t['bbox']) > 0]
+            coverage = sum(intersection_area(box, t['bbox']) for t in overlapping) / area
+            if coverage >= policy['ocr_coverage']:
+                elem['caption_skip_reason'] = 'ocr_coverage'
+                elem['content'] = ' '.join(t['content'] for t in overlapping)
+                continue
+        if policy['dedupe_crops']:
+            key = crop_key(box)
+            if key is not None and key in seen_crops:
+                elem['caption_skip_reason'] = 'duplicate_crop'
+                elem['content'] = ''
+                shared_captions.append((elem, seen_crops[key]))
+                continue
+            seen_crops[key] = elem
+        if policy['nested_in_parent'] is not None and area > 0:
+            parent = next((p for p in captioned if box_area(p['bbox']) > area and intersection_area(box, p['bbox']) / area >= policy['nested_in_parent']), None)
+            if parent is not None:
+                elem['caption_skip_reason'] = 'nested_in_parent'
+                elem['content'] = ''
+                shared_captions.append((elem, parent))
+                continue
+        captioned.append(elem)
+
+    skipped = [elem['caption_skip_reason'] for elem in pending if 'caption_skip_reason' in elem]
+    if skipped:
+        print('caption skipped:', {reason: skipped.count(reason) for reason in set(skipped)}, 'captioning:', len(captioned))
+    return shared_captions
+
+
+# how much each signal counts towards an element's score in rank_elements
+DEFAULT_ELEMENT_SCORE_WEIGHTS = {
+    'confidence': 1.0,  # yolo confidence for icons, ocr text counts as fully confident
+    'area': 0.5,        # sqrt of the screen fraction covered, so large panels don't dominate
+    'ocr': 0.5,         # element carries ocr text, either a text box or an icon with text inside
+}
+
+
+def rank_elements(boxes_elem, weights=None):
+    '''
+    Score every element in place ('score' key) by detection confidence, area and ocr overlap.
+    boxes are in ratio coordinates, so area is already a fraction of the screen.
+    '''
+    weights = {**DEFAULT_ELEMENT_SCORE_WEIGHTS, **(weights or {})}
+    for elem in boxes_elem:
+        box = elem['bbox']
+        area = max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+        has_ocr = elem['type'] == 'text' or elem.get('source') == 'box_yolo_content_ocr'
+        conf = 1.0 if elem['type'] == 'text' or elem.get('conf') is None else elem['conf']
+        elem['score'] = round(weights['confidence'] * conf + weights['area'] * min(1.0, area ** 0.5) + weights['ocr'] * has_ocr, 4)
+    return boxes_elem
+
+
+def truncate_elements(boxes_elem, max_elements=None, score_budget=None):
+    '''
+    Keep only the highest scoring elements, preserving their original order.
+    max_elements: keep at most this many elements
+    score_budget: keep the fewest top elements whose scores add up to this fraction (0-1] of the total score
+    '''
+    if max_elements is None and score_budget is None:
+        return boxes_elem
+    ranked = sorted(range(len(boxes_elem)), key=lambda i: boxes_elem[i]['score'], reverse=True)
+    if max_elements is not None:
+        ranked = ranked[:max_elements]
+    if score_budget is not None:
+        total = sum(elem['score'] for elem in boxes_elem)
+        kept, running = [], 0
+        for i in ranked:
+            if running >= score_budget * total:
+                break
+            kept.append(i)
+            running += boxes_elem[i]['score']
+        ranked = kept
+    keep = set(ranked)
+    print(f'kept {len(keep)} of {len(boxes_elem)} elements')
+    return [elem for i, elem in enumerate(boxes_elem) if i in keep]
+
+
 def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     transform = T.Compose(
         [
@@ -340,7 +548,7 @@ def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor
     xywh = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xywh").numpy()
     detections = sv.Detections(xyxy=xyxy)
 
-    labels = [f"{phrase}" for phrase in range(boxes.shape[0])]
+    labels = [f"{phrase}" for phrase in phrases]
 
     box_annotator = BoxAnnotator(text_scale=text_scale, text_padding=text_padding,text_thickness=text_thickness,thickness=thickness) # 0.8 for mobile/web, 0.3 for desktop # 0.4 for mind2web
     annotated_frame = image_source.copy()
@@ -400,7 +608,7 @@ def int_box_area(box, w, h):
     area = (int_box[2] - int_box[0]) * (int_box[3] - int_box[1])
     return area
 
-def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128):
+def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128, caption_preset=None, caption_skip_policy=None, max_elements=None, score_budget=None, batch_sizer=None, element_tracker=None, deadline=None, caption_cache=None):
     """Process either an image path or Image object
     
     Args:
@@ -414,6 +622,9 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     if not imgsz:
         imgsz = (h, w)
     # print('image size:', w, h)
+    # an abandoned parse stops between stages (detection, each caption batch), before the tracker is updated
+    if deadline is not None:
+        deadline.check('icon detection')
     xyxy, logits, phrases = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
     xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
     image_source = np.asarray(image_source)
@@ -428,9 +639,14 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
         ocr_bbox = None
 
     ocr_bbox_elem = [{'type': 'text', 'bbox':box, 'interactivity':False, 'content':txt, 'source': 'box_ocr_content_ocr'} for box, txt in zip(ocr_bbox, ocr_text) if int_box_area(box, w, h) > 0] 
-    xyxy_elem = [{'type': 'icon', 'bbox':box, 'interactivity':True, 'content':None} for box in xyxy.tolist() if int_box_area(box, w, h) > 0]
+    xyxy_elem = [{'type': 'icon', 'bbox':box, 'interactivity':True, 'content':None, 'conf':conf} for box, conf in zip(xyxy.tolist(), logits.tolist()) if int_box_area(box, w, h) > 0]
     filtered_boxes = remove_overlap_new(boxes=xyxy_elem, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox_elem)
-    
+    # rank before captioning so a top-k cut also bounds the caption work
+    filtered_boxes = truncate_elements(rank_elements(filtered_boxes), max_elements=max_elements, score_budget=score_budget)
+    shared_captions = []
+    if caption_skip_policy:
+        shared_captions = apply_caption_skip_policy(filtered_boxes, image_source, caption_skip_policy)
+
     # sort the filtered_boxes so that the one with 'content': None is at the end, and get the index of the first 'content': None
     filtered_boxes_elem = sorted(filtered_boxes, key=lambda x: x['content'] is None)
     # get the index of the first 'content': None
@@ -439,13 +655,20 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     print('len(filtered_boxes):', len(filtered_boxes), starting_idx)
 
     # get parsed icon local semantics
+    if deadline is not None:
+        deadline.check('captioning')
     time1 = time.time()
     if use_local_semantics:
         caption_model = caption_model_processor['model']
-        if 'phi3_v' in caption_model.config.model_type: 
-            parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor)
+        caption_stats = {}
+        if starting_idx == -1:
+            # every box already has content, nothing to caption
+            parsed_content_icon = []
+        elif 'phi3_v' in caption_model.config.model_type: 
+            parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, starting_idx, image_source, caption_model_processor, batch_size=batch_size, caption_stats=caption_stats, batch_sizer=batch_sizer, deadline=deadline, caption_cache=caption_cache)
         else:
-            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size)
+            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size, generation_preset=caption_preset, caption_stats=caption_stats, batch_sizer=batch_sizer, deadline=deadline, caption_cache=caption_cache)
+        caption_tokens = caption_stats.get('tokens_per_crop', [])
         ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
         icon_start = len(ocr_text)
         parsed_content_icon_ls = []
@@ -453,6 +676,10 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
         for i, box in enumerate(filtered_boxes_elem):
             if box['content'] is None:
                 box['content'] = parsed_content_icon.pop(0)
+                if caption_tokens:
+                    box['caption_tokens'] = caption_tokens.pop(0)
+        for box, source_box in shared_captions:
+            box['content'] = source_box['content']
         for i, txt in enumerate(parsed_content_icon):
             parsed_content_icon_ls.append(f"Icon Box ID {str(i+icon_start)}: {txt}")
         parsed_content_merged = ocr_text + parsed_content_icon_ls
@@ -464,6 +691,10 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     filtered_boxes = box_convert(boxes=filtered_boxes, in_fmt="xyxy", out_fmt="cxcywh")
 
     phrases = [i for i in range(len(filtered_boxes))]
+    if element_tracker is not None:
+        # persistent ids across the session's parses, also used as the SoM labels
+        element_tracker.assign(filtered_boxes_elem)
+        phrases = [box['track_id'] for box in filtered_boxes_elem]
     
     # draw boxes
     if draw_bbox_config: